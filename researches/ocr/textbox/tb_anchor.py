@@ -0,0 +1,327 @@
+import os, sys, copy, glob, argparse
+sys.path.append(os.path.expanduser("~/Documents/sroie2019"))
+import torch
+import torch.nn as nn
+import omni_torch.utils as util
+import researches.ocr.textbox.tb_preset as preset
+import researches.ocr.textbox.tb_model as model
+import researches.ocr.textbox.tb_data as tb_data
+from researches.ocr.textbox.tb_utils import calculate_anchor_number, match_batch, pad_targets, Priors
+
+cfg = model.cfg
+args = util.get_args(preset.PRESET)
+
+
+def anchor_table(cfg, i):
+    """(box_height, box_ratio) of each anchor of the i-th output level, in the order of create_prior"""
+    assert len(cfg['box_height'][i]) == 1, "calculate_anchor_number assumes one box height per level"
+    anchors = [(cfg['box_height'][i][0], ratio) for ratio in cfg['box_ratios'][i]]
+    if cfg['big_box']:
+        anchors += [(cfg['box_height_large'][i][0], ratio) for ratio in cfg['box_ratios_large'][i]]
+    return anchors
+
+
+def load_gt_boxes(img_file, size, gt_ext="txt"):
+    """
+    Ground truth boxes of img_file normalized to [0, 1], after the longer side of the image
+    is resized to size and the image is padded into a square as tb_quantize.load_image does.
+    Only the header of the image is read.
+    """
+    from PIL import Image
+    with Image.open(img_file) as img:
+        w, h = img.size
+    scale = size / max(h, w)
+    h_re, w_re = round(h * scale), round(w * scale)
+    top, left = (size - h_re) // 2, (size - w_re) // 2
+    gt_boxes = []
+    for coord in tb_data.parse_file(os.path.splitext(img_file)[0] + "." + gt_ext):
+        gt_boxes.append([(min(coord[::2]) * scale + left) / size, (min(coord[1::2]) * scale + top) / size,
+                         (max(coord[::2]) * scale + left) / size, (max(coord[1::2]) * scale + top) / size])
+    return torch.Tensor(gt_boxes).view(-1, 4)
+
+
+class AnchorProfiler(object):
+    """
+    Run the matcher of MultiBoxLoss over ground truth boxes and count the positive matches
+    of every anchor (box_height, box_ratio) of every output level.
+    Matching only depends on the prior boxes and the ground truth, so no image is needed,
+    the super wide matching is drawn at random as during training.
+    Args:
+        net: (SSD) model whose cfg is profiled, only used once to get the prior boxes.
+        input_size: (int) size of the square input image.
+    """
+    def __init__(self, net, input_size):
+        self.cfg = net.cfg
+        sample = torch.zeros(1, 3, input_size, input_size, device=next(net.parameters()).device)
+        self.slices = model.level_slices(net, sample)
+        with torch.no_grad():
+            prior = net(sample, is_train=False)[2].cpu()
+        self.priors = Priors(prior, 1.0)
+        self.anchor_numbers = [calculate_anchor_number(self.cfg, i) for i in range(len(self.slices))]
+        self.counts = [torch.zeros(n, dtype=torch.long) for n in self.anchor_numbers]
+        self.num_images = 0
+
+    def update(self, gt_boxes):
+        """
+        Args:
+            gt_boxes: (list) normalized ground truth boxes of each image, each of Shape: [num_obj, 4].
+        """
+        targets = [torch.cat([box, box.new_zeros(box.size(0), 1)], dim=1) for box in gt_boxes if box.size(0) > 0]
+        if len(targets) == 0:
+            return
+        targets, valid = pad_targets(targets)
+        _, conf_t = match_batch(self.cfg, self.cfg['overlap_thresh'], targets[:, :, :-1], targets[:, :, -1],
+                                valid, self.priors, self.cfg['variance'], 1.0)
+        pos = conf_t > 0
+        for i, level in enumerate(self.slices):
+            self.counts[i] += pos[:, level].reshape(pos.size(0), -1, self.anchor_numbers[i]).sum(dim=(0, 1))
+        self.num_images += len(targets)
+
+    def print_summary(self):
+        total = max(sum([int(count.sum()) for count in self.counts]), 1)
+        print("Positive matches of %d images:"%(self.num_images))
+        for i, count in enumerate(self.counts):
+            print("%s: %d (%.2f%%)"%(self.cfg['conv_output'][i], int(count.sum()), 100 * float(count.sum()) / total))
+            for (height, ratio), n in zip(anchor_table(self.cfg, i), count.tolist()):
+                print("    height %3s ratio %5s: %8d (%.2f%%)"%(height, ratio, n, 100 * n / total))
+
+    def used_anchors(self, min_share=0.005, min_keep=1):
+        """
+        Return:
+            index (list) of the anchors kept at each level, an anchor is kept when its share
+            of all positive matches is at least min_share, and the min_keep most matched
+            anchors of each level are always kept
+        """
+        total = max(sum([int(count.sum()) for count in self.counts]), 1)
+        keep = []
+        for count in self.counts:
+            top = set(count.argsort(descending=True)[:min_keep].tolist())
+            keep.append([a for a, n in enumerate(count.tolist()) if n / total >= min_share or a in top])
+        return keep
+
+
+def reduce_cfg(cfg, keep):
+    """Copy of cfg with only the anchors in keep (see AnchorProfiler.used_anchors)"""
+    cfg = copy.deepcopy(cfg)
+    for i, anchors in enumerate(keep):
+        num_small = len(cfg['box_ratios'][i])
+        cfg['box_ratios'][i] = [cfg['box_ratios'][i][a] for a in anchors if a < num_small]
+        if cfg['big_box']:
+            cfg['box_ratios_large'][i] = [cfg['box_ratios_large'][i][a - num_small] for a in anchors
+                                          if a >= num_small]
+    return cfg
+
+
+def slice_conv(conv, out_index=None, in_index=None):
+    """Copy of the Conv2d with only the output / input channels in out_index / in_index"""
+    weight, bias = conv.weight.data, None if conv.bias is None else conv.bias.data
+    if out_index is not None:
+        weight = weight[out_index]
+        bias = None if bias is None else bias[out_index]
+    if in_index is not None:
+        weight = weight[:, in_index]
+    sliced = nn.Conv2d(weight.size(1), weight.size(0), conv.kernel_size, stride=conv.stride,
+                       padding=conv.padding, dilation=conv.dilation, bias=bias is not None,
+                       padding_mode=conv.padding_mode).to(weight.device)
+    sliced.weight.data.copy_(weight)
+    if bias is not None:
+        sliced.bias.data.copy_(bias)
+    return sliced
+
+
+def slice_batch_norm(bn, index):
+    sliced = nn.BatchNorm2d(len(index), eps=bn.eps, momentum=bn.momentum, affine=bn.affine,
+                            track_running_stats=bn.track_running_stats).to(bn.running_mean.device)
+    for name in ["weight", "bias", "running_mean", "running_var"]:
+        if getattr(bn, name) is not None:
+            getattr(sliced, name).data.copy_(getattr(bn, name).data[index])
+    return sliced.train(bn.training)
+
+
+def slice_block(block, out_index=None, in_index=None):
+    """
+    Slice the output channels of the last Conv2d (and the BatchNorm2d after it) and the input
+    channels of the first Conv2d of a conv block (Sequential), in place.
+    """
+    convs = [i for i, layer in enumerate(block) if type(layer) is nn.Conv2d]
+    assert len(convs) > 0, "no Conv2d in the block, the heads must be float models"
+    if in_index is not None:
+        block[convs[0]] = slice_conv(block[convs[0]], in_index=in_index)
+    if out_index is not None:
+        last = convs[-1]
+        block[last] = slice_conv(block[last], out_index=out_index)
+        for i in range(last + 1, len(block)):
+            if isinstance(block[i], nn.BatchNorm2d):
+                block[i] = slice_batch_norm(block[i], out_index)
+    return block
+
+
+def channel_index(anchors, channels):
+    """Output channels of the anchors when each anchor has channels consecutive outputs"""
+    return torch.tensor([a * channels + c for a in anchors for c in range(channels)], dtype=torch.long)
+
+
+def prune_anchors(net, keep):
+    """
+    Remove the anchors not in keep from a trained SSD without retraining. The prior boxes of
+    the removed anchors disappear and their output channels are sliced out of the conf heads.
+    The loc heads still predict every original anchor, since their output is also the input
+    of conf_concate, only the channels of the kept anchors are output (see SSD.forward).
+    So the remaining priors keep their predictions exactly.
+    Args:
+        net: (SSD) float model (BatchNorm may be folded).
+        keep: (list) index of the anchors kept at each output level, see AnchorProfiler.used_anchors.
+    Return:
+        the pruned model, whose cfg is reduced accordingly
+    """
+    cfg = reduce_cfg(net.cfg, keep)
+    if net.cfg.get('loc_anchor_index'):
+        # Pruned again, keep refers to the anchors left by the last pruning
+        keep_loc = [[previous[a] for a in anchors] for previous, anchors in zip(net.cfg['loc_anchor_index'], keep)]
+    else:
+        cfg['loc_anchor_number'] = [calculate_anchor_number(net.cfg, i) for i in range(len(keep))]
+        keep_loc = keep
+    cfg['loc_anchor_index'] = keep_loc
+    for i, anchors in enumerate(keep):
+        if net.connect_loc_to_conf:
+            slice_block(net.conf_concate[i], out_index=channel_index(anchors, net.num_classes))
+        else:
+            slice_block(net.conf_layers[i][-1], out_index=channel_index(anchors, net.num_classes))
+        device = next(net.loc_layers[i].parameters()).device
+        net.register_buffer("loc_index_%d"%(i), channel_index(keep_loc[i], 4).to(device), persistent=False)
+    net.cfg = cfg
+    net.prior_cache.clear()
+    if net.fix_size:
+        net.prior = net.create_prior()
+    return net
+
+
+def kept_priors(slices, keep, anchor_numbers):
+    """Index of the priors of the unpruned model which are kept by prune_anchors"""
+    index = []
+    for level, anchors, n in zip(slices, keep, anchor_numbers):
+        cells = torch.arange(level.start, level.stop, n).unsqueeze(1)
+        index.append((cells + torch.tensor(anchors, dtype=torch.long).unsqueeze(0)).view(-1))
+    return torch.cat(index)
+
+
+def save_pruned(net, path):
+    """
+    Save the reduced cfg and the channels of the heads (see tb_prune.prune_heads) together
+    with the state_dict, the pruned structure differs from model.cfg
+    """
+    torch.save({"cfg": net.cfg, "head_channels": getattr(net, "head_channels", {}),
+                "state_dict": net.state_dict()}, path)
+
+
+def load_pruned(path, device="cpu"):
+    from researches.ocr.textbox.tb_prune import resize_heads
+    checkpoint = torch.load(os.path.expanduser(path), map_location="cpu", weights_only=False)
+    net = model.create_empty_ssd(checkpoint["cfg"], connect_loc_to_conf=True, fix_size=False,
+                                 incep_conf=True, incep_loc=True)
+    resize_heads(net, checkpoint.get("head_channels", {}))
+    net.load_state_dict(checkpoint["state_dict"], assign=True)
+    return model.assert_materialized(net).to(device).eval()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Textbox Detector Anchor Profiler')
+    parser.add_argument(
+        "-mp",
+        "--model_prefix",
+        type=str,
+        help="prefix of the model to be pruned",
+        default="ft_003_3"
+    )
+    parser.add_argument(
+        "-nth",
+        "--nth_best_model",
+        type=int,
+        help="1 represent the latest model",
+        default=1
+    )
+    parser.add_argument(
+        "-tdr",
+        "--train_dataset_root",
+        type=str,
+        help="folder of the training images and ground truth files",
+        default="~/Pictures/dataset/ocr/SROIE2019"
+    )
+    parser.add_argument(
+        "-ext",
+        "--extension",
+        type=str,
+        help="extention of image",
+        default="jpg"
+    )
+    parser.add_argument(
+        "-gt_ext",
+        "--ground_truth_extension",
+        type=str,
+        help="extention of ground truth files",
+        default="txt"
+    )
+    parser.add_argument(
+        "-sz",
+        "--image_size",
+        type=int,
+        help="images are resized and padded to this size",
+        default=768
+    )
+    parser.add_argument(
+        "-bs",
+        "--batch_size",
+        type=int,
+        help="number of images matched at once",
+        default=8
+    )
+    parser.add_argument(
+        "-ms",
+        "--min_share",
+        type=float,
+        help="anchors with a smaller share of all positive matches are pruned",
+        default=0.005
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="path to save the pruned model, which can be loaded by tb_test.py -pm",
+        default="~/Pictures/dataset/ocr/_text_detection/pruned.pth"
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    opt = parse_arguments()
+    root_path = os.path.expanduser(opt.train_dataset_root)
+    img_list = sorted(glob.glob(root_path + "/*.%s"%(opt.extension)))
+    if len(img_list) == 0:
+        raise FileNotFoundError("No image found in %s"%(root_path))
+    from researches.ocr.textbox.tb_test import load_net
+    net = load_net(opt.model_prefix, "cpu", nth=opt.nth_best_model)
+
+    profiler = AnchorProfiler(net, opt.image_size)
+    for start in range(0, len(img_list), opt.batch_size):
+        profiler.update([load_gt_boxes(img_file, opt.image_size, opt.ground_truth_extension)
+                         for img_file in img_list[start: start + opt.batch_size]])
+    profiler.print_summary()
+    keep = profiler.used_anchors(min_share=opt.min_share)
+    reduced = reduce_cfg(net.cfg, keep)
+    print("Reduced cfg:\n    'box_ratios': %s\n    'box_ratios_large': %s"%(reduced['box_ratios'],
+                                                                          reduced['box_ratios_large']))
+
+    # The kept priors predict exactly as before
+    sample = torch.randn(1, 3, opt.image_size, opt.image_size)
+    with torch.no_grad():
+        loc_ref, conf_ref, prior_ref = net(sample, is_train=False)
+        index = kept_priors(profiler.slices, keep, profiler.anchor_numbers)
+        pruned = prune_anchors(net, keep)
+        loc, conf, prior = pruned(sample, is_train=False)
+    diff = max(float((loc - loc_ref[:, index]).abs().max()), float((conf - conf_ref[:, index]).abs().max()),
+               float((prior - prior_ref[index]).abs().max()))
+    print("Priors: %d -> %d, max output difference: %.2e"%(prior_ref.size(0), prior.size(0), diff))
+    output = os.path.expanduser(opt.output)
+    save_pruned(pruned, output)
+    print("Pruned model saved to %s"%(output))
@@ -47,14 +47,40 @@ def parse_arguments():
         help="batch size inside each GPU during training",
         default=1
     )
+    parser.add_argument(
+        "-bpgd",
+        "--batch_size_per_gpu_dynamic",
+        type=int,
+        help="batch size inside each GPU during training with dynamic input shape (-fs off), "
+             "the batches are grouped by aspect ratio and padded to buckets",
+        default=4
+    )
     parser.add_argument(
         "-lt",
         "--loading_threads",
         type=int,
         help="loading_threads correspond to each GPU during both training and validation, "
-             "e.g. You have 4 GPU and set -lt 2, so 8 threads will be used to load data",
+             "e.g. You have 4 GPU and set -lt 2, so 8 threads will be used to load data. "
+             "-lt 0 loads in the main process, where the fix_size batches are collated into "
+             "reused pinned buffers (cheap loading needed, e.g. -shr and -fua)",
         default=2
     )
+    parser.add_argument(
+        "-shr",
+        "--shard_root",
+        type=str,
+        help="read the training sources packed by tb_data.py from this folder, "
+             "instead of decoding the images in every epoch",
+        default=None
+    )
+    parser.add_argument(
+        "-shm",
+        "--shard_max_height",
+        type=int,
+        help="max_height the shards of -shr were packed with (tb_data.py -mh), "
+             "shards packed otherwise or older than their source are not used",
+        default=0
+    )
     parser.add_argument(
         "-d",
         "--datasets",
@@ -87,6 +113,19 @@ def parse_arguments():
         help="higher bound of zoom rate",
         default=1.6
     )
+    parser.add_argument(
+        "-fua",
+        "--fused_augmentation",
+        action="store_true",
+        help="compose the augmentation of fix_size mode into a single warpAffine",
+    )
+    parser.add_argument(
+        "-bta",
+        "--batch_augmentation",
+        action="store_true",
+        help="augment the collated batches (on GPU) instead of each image in the workers, "
+             "the full resolution images are sent to GPU as uint8, on CPU -fua is faster",
+    )
 
     ##############
     #          MODEL         #
@@ -114,7 +153,34 @@ def parse_arguments():
              "be treated as negative value.",
         default=0.45
     )
-    
+
+    ##############
+    #         PRUNING        #
+    ##############
+    parser.add_argument(
+        "-pr",
+        "--prune_ratios",
+        nargs='+',
+        type=float,
+        help="if set, prune the channels of the loc and conf heads of -mpf model with each ratio "
+             "instead of training, and report the latency / f1-score trade-off",
+        default=[]
+    )
+    parser.add_argument(
+        "-pc",
+        "--prune_criterion",
+        type=str,
+        choices=["bn", "l1"],
+        help="rank the channels by the scale of BatchNorm or the L1 norm of the filters",
+        default="bn"
+    )
+    parser.add_argument(
+        "-pfe",
+        "--prune_finetune_epochs",
+        type=int,
+        help="epochs to fine tune each pruned model",
+        default=2
+    )
     
 
     args = parser.parse_args()
@@ -1,3 +1,7 @@
+import random
+import cv2, torch
+import numpy as np
+import torch.nn.functional as F
 from imgaug import augmenters
 
 def aug_sroie(args, bg_color=255):
@@ -24,6 +28,107 @@ def aug_sroie(args, bg_color=255):
     return aug_list
 
 
+def sroie_matrix(height, width, args, stages=(1536, 2048, 768), flip=0.33):
+    """
+    Sample the geometry of aug_sroie for an image of height x width and compose every step
+    into one matrix, which maps a point of the image to the point of the augmented image.
+    The steps and their random choices are the same as aug_sroie:
+    pad the height to stages[0] at a random position, resize the height to stages[1],
+    zoom around the center with augment_zoom_probability, crop a stages[2] x stages[2] area
+    at a random position, pad the width if it is not enough and flip.
+    Return:
+        the matrix (numpy array), Shape: [3, 3] and the frame of the resized image in the
+        augmented image (x1, y1, x2, y2), the zoom pushes the content out of this frame.
+    """
+    stage_0, stage_1, stage_2 = stages
+    def translate(x, y):
+        return np.array([[1, 0, x], [0, 1, y], [0, 0, 1]], dtype=np.float64)
+    def scale(x, y):
+        return np.array([[x, 0, 0], [0, y, 0], [0, 0, 1]], dtype=np.float64)
+    # Pad the height to stage_0
+    pad = max(stage_0 - height, 0)
+    matrix = translate(0, int(round(pad * random.random())))
+    height = height + pad
+    # Resize its height to stage_1, width keeps the aspect ratio
+    new_width = max(int(round(width * stage_1 / height)), 1)
+    matrix = scale(new_width / width, stage_1 / height).dot(matrix)
+    height, width = stage_1, new_width
+    # Zoom around the center, the size does not change
+    if random.random() < args.augment_zoom_probability:
+        zoom = random.uniform(args.augment_zoom_lower_bound, args.augment_zoom_higher_bound)
+        matrix = translate(width / 2, height / 2).dot(scale(zoom, zoom)).dot(
+            translate(-width / 2, -height / 2)).dot(matrix)
+    # Crop a stage_2 x stage_2 area, or pad the side which is not enough
+    x0 = random.randint(0, width - stage_2) if width > stage_2 else -int(round((stage_2 - width) * random.random()))
+    y0 = random.randint(0, height - stage_2) if height > stage_2 else -int(round((stage_2 - height) * random.random()))
+    post = translate(-x0, -y0)
+    # Perform Flip
+    if random.random() < flip:
+        post = np.array([[-1, 0, stage_2], [0, 1, 0], [0, 0, 1]]).dot(post)
+    if random.random() < flip:
+        post = np.array([[1, 0, 0], [0, -1, stage_2], [0, 0, 1]]).dot(post)
+    frame, _ = warp_boxes([[0, 0, width, height]], post, stage_2)
+    return post.dot(matrix), frame[0] if frame.shape[0] > 0 else np.zeros(4)
+
+
+def warp_boxes(boxes, matrix, size, frame=None):
+    """
+    Transform boxes (numpy array of [x1, y1, x2, y2], Shape: [num_boxes, 4]) with the matrix
+    of sroie_matrix, clip them to the size x size image (or frame) and remove the ones outside of it.
+    Return:
+        the boxes and the index of the kept ones in the input
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    points = boxes.reshape(-1, 2).dot(matrix[:2, :2].T) + matrix[:2, 2]
+    points = points.reshape(-1, 4)
+    # A flip swaps the corners
+    boxes = np.concatenate([np.minimum(points[:, :2], points[:, 2:]),
+                            np.maximum(points[:, :2], points[:, 2:])], axis=1)
+    x1, y1, x2, y2 = (0, 0, size, size) if frame is None else frame
+    keep = np.where((boxes[:, 0] < x2) & (boxes[:, 1] < y2) & (boxes[:, 2] > x1) & (boxes[:, 3] > y1))[0]
+    boxes = boxes[keep]
+    boxes[:, 0::2] = np.clip(boxes[:, 0::2], x1, x2)
+    boxes[:, 1::2] = np.clip(boxes[:, 1::2], y1, y2)
+    return boxes, keep
+
+
+class FusedSroieAug(object):
+    """
+    aug_sroie with a single cv2.warpAffine: the pad, resize, zoom, crop, pad and flip steps
+    are composed into one matrix (see sroie_matrix) and only the final stage_2 x stage_2
+    window is sampled from the original image, instead of creating the padded, 2048 high
+    and zoomed intermediate images. The boxes are transformed by the same matrix.
+    Every area outside of the original image, or pushed out of the frame by the zoom,
+    is filled with bg_color, and the boxes are clipped to that frame.
+    """
+    def __init__(self, args, bg_color=255, stages=(1536, 2048, 768), flip=0.33):
+        self.args = args
+        self.bg_color = bg_color
+        self.stages = stages
+        self.flip = flip
+
+    def __call__(self, image, boxes):
+        """
+        Args:
+            image: (numpy array) Shape: [height, width] or [height, width, channel].
+            boxes: (numpy array) in pixel coordinate, Shape: [num_boxes, 4].
+        Return:
+            the augmented image, its boxes and the index of the kept boxes in the input
+        """
+        size = self.stages[2]
+        matrix, frame = sroie_matrix(image.shape[0], image.shape[1], self.args, self.stages, self.flip)
+        # The matrix maps the corner of pixels while warpAffine maps their centers
+        warp = matrix[:2].copy()
+        warp[:, 2] += warp[:, :2].sum(axis=1) * 0.5 - 0.5
+        border = [self.bg_color] * (image.shape[2] if image.ndim == 3 else 1)
+        image = cv2.warpAffine(image, warp, (size, size), flags=cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_CONSTANT, borderValue=border)
+        x1, y1, x2, y2 = [int(round(v)) for v in frame]
+        image[:y1], image[y2:], image[:, :x1], image[:, x2:] = self.bg_color, self.bg_color, self.bg_color, self.bg_color
+        boxes, keep = warp_boxes(boxes, matrix, size, frame)
+        return image, boxes, keep
+
+
 def aug_sroie_dynamic_1():
     """Perform image augmentation for dynamic input shape"""
     aug_list = []
@@ -47,6 +152,21 @@ def aug_sroie_dynamic_2():
     aug_list.append(augmenters.Flipud(0.33, name="vertical_flip"))
     return aug_list
 
+def sroie_dynamic_2_buckets():
+    """(height, width) buckets of the images created by aug_sroie_dynamic_2, see tb_data.BucketCollector"""
+    return [(512, width) for width in [256, 384, 512, 640, 768, 1024]]
+
+def sroie_dynamic_2_ratio(height, width):
+    """
+    Expected width / height of a height x width image after aug_sroie_dynamic_2: the height
+    is padded to 1536, the crop keeps about 48.5% of the height and 90% of the width.
+    """
+    return 0.9 * width / (0.485 * max(height, 1536))
+
+def sroie_dynamic_2_boundaries():
+    """Aspect ratios separating sroie_dynamic_2_buckets, to group the images by their bucket"""
+    return [width / height for height, width in sroie_dynamic_2_buckets()[:-1]]
+
 def sroie_refine():
     aug_list = []
     stage_0, stage_1, stage_2, stage_3 = 1536, 2048, 768, 512
@@ -69,4 +189,225 @@ def sroie_refine():
 
 def aug_sroie_test():
     aug_list = []
-    return aug_list
\ No newline at end of file
+    return aug_list
+
+
+def to_pixels(images, mean, std):
+    """uint8 pixels of normalized images, mean and std broadcast over the channel dimension"""
+    # + 0.5 rounds when the conversion truncates
+    return torch.addcmul(mean * 255 + 0.5, images, std * 255).clamp_(0, 255).to(torch.uint8)
+
+
+def from_pixels(images, mean, std):
+    """Normalize uint8 pixels like the data loader does, the inverse of to_pixels"""
+    return (images.float() / 255 - mean) / std
+
+
+# Batched augmentation of the collated images (see tb_data.RawCollector): the workers of
+# the data loader only decode the images, the geometry of the whole batch is sampled by one
+# grid_sample on the device of the images.
+# Each step samples a matrix per image which maps the points before the step to the points
+# after it, from the size of the images (tensors of Shape: [batch]) before the step.
+def batch_matrix(num, scale_x=1.0, scale_y=1.0, shift_x=0.0, shift_y=0.0):
+    matrix = torch.zeros(num, 3, 3, dtype=torch.float64)
+    matrix[:, 0, 0], matrix[:, 1, 1], matrix[:, 2, 2] = scale_x, scale_y, 1
+    matrix[:, 0, 2], matrix[:, 1, 2] = shift_x, shift_y
+    return matrix
+
+
+class BatchPadToFixedSize(object):
+    """Pad the side smaller than height (width) at a random position, None keeps the side"""
+    def __init__(self, height=None, width=None):
+        self.height, self.width = height, width
+
+    def __call__(self, heights, widths):
+        new_h = heights if self.height is None else heights.clamp(min=self.height)
+        new_w = widths if self.width is None else widths.clamp(min=self.width)
+        shift_y = ((new_h - heights) * torch.rand(heights.size(0), dtype=torch.float64)).round()
+        shift_x = ((new_w - widths) * torch.rand(widths.size(0), dtype=torch.float64)).round()
+        return batch_matrix(heights.size(0), shift_x=shift_x, shift_y=shift_y), new_h, new_w
+
+
+class BatchCropToFixedSize(object):
+    """Crop the side larger than height (width) at a random position"""
+    def __init__(self, height, width):
+        self.height, self.width = height, width
+
+    def __call__(self, heights, widths):
+        new_h, new_w = heights.clamp(max=self.height), widths.clamp(max=self.width)
+        shift_y = ((heights - new_h + 1) * torch.rand(heights.size(0), dtype=torch.float64)).floor()
+        shift_x = ((widths - new_w + 1) * torch.rand(widths.size(0), dtype=torch.float64)).floor()
+        return batch_matrix(heights.size(0), shift_x=-shift_x, shift_y=-shift_y), new_h, new_w
+
+
+class BatchResize(object):
+    """Resize the height, width=None keeps the aspect ratio"""
+    def __init__(self, height, width=None):
+        self.height, self.width = height, width
+
+    def __call__(self, heights, widths):
+        new_h = torch.full_like(heights, self.height)
+        if self.width is None:
+            new_w = (widths * self.height / heights).round().clamp(min=1)
+        else:
+            new_w = torch.full_like(widths, self.width)
+        return batch_matrix(heights.size(0), new_w / widths, new_h / heights), new_h, new_w
+
+
+class BatchAffine(object):
+    """
+    With probability p, zoom around the center by a factor in scale and translate by
+    translate_px pixels (sampled for each side), the size does not change.
+    """
+    def __init__(self, p=1.0, scale=(1.0, 1.0), translate_px=(0, 0)):
+        self.p, self.scale, self.translate_px = p, scale, translate_px
+
+    def __call__(self, heights, widths):
+        num = heights.size(0)
+        apply = (torch.rand(num, dtype=torch.float64) < self.p).double()
+        zoom = torch.empty(num, dtype=torch.float64).uniform_(*self.scale) * apply + (1 - apply)
+        low, high = self.translate_px
+        shift = torch.randint(low, high + 1, (2, num)).double() * apply
+        matrix = batch_matrix(num, zoom, zoom, shift_x=(1 - zoom) * widths / 2 + shift[0],
+                              shift_y=(1 - zoom) * heights / 2 + shift[1])
+        return matrix, heights, widths
+
+
+class BatchFlip(object):
+    """Flip horizontally (or vertically) with probability p"""
+    def __init__(self, p, vertical=False):
+        self.p, self.vertical = p, vertical
+
+    def __call__(self, heights, widths):
+        flip = (torch.rand(heights.size(0), dtype=torch.float64) < self.p).double()
+        length = heights if self.vertical else widths
+        if self.vertical:
+            matrix = batch_matrix(heights.size(0), scale_y=1 - 2 * flip, shift_y=flip * length)
+        else:
+            matrix = batch_matrix(heights.size(0), scale_x=1 - 2 * flip, shift_x=flip * length)
+        return matrix, heights, widths
+
+
+def transform_rects(rects, matrix):
+    """Transform rects (x1, y1, x2, y2) of Shape: [num, 4] by matrix of Shape: [num, 3, 3]"""
+    points = torch.stack([rects[:, 0::2], rects[:, 1::2]], dim=1)
+    points = matrix[:, :2, :2].matmul(points) + matrix[:, :2, 2:]
+    return torch.cat([points.min(dim=2)[0], points.max(dim=2)[0]], dim=1)
+
+
+class BatchAugment(object):
+    """
+    Compose the steps into one matrix per image and sample the output of all images with a
+    single grid_sample. Like the steps of imgaug, the content pushed out of the image by a
+    step (e.g. the zoom of BatchAffine) is lost, the area without content is filled with
+    pad_value and the boxes are clipped to the area with content.
+    Args:
+        steps: (list) the batched steps above.
+        size: (tuple) (height, width) of the output, which the steps should end with.
+        pad_value: (float) normalized value of the area without content, 0.5 is white with
+            the default normalization of tb_preset (mean 0.5, std 1.0).
+        mean, std: the normalization of the images, uint8 images (tb_data.RawCollector) are
+            normalized right after grid_sample.
+    """
+    def __init__(self, steps, size, pad_value=0.5, mean=(0.5, 0.5, 0.5), std=(1.0, 1.0, 1.0)):
+        self.steps = steps
+        self.size = size
+        self.pad_value = pad_value
+        self.mean = mean
+        self.std = std
+
+    def sample(self, sizes):
+        """
+        Args:
+            sizes: (tensor) (height, width) of each image, Shape: [batch, 2].
+        Return:
+            the matrix of each image, Shape: [batch, 3, 3] and its area with content in the
+            output, Shape: [batch, 4]
+        """
+        heights, widths = sizes[:, 0].double(), sizes[:, 1].double()
+        matrix = batch_matrix(sizes.size(0))
+        frame = torch.stack([torch.zeros_like(widths), torch.zeros_like(heights), widths, heights], dim=1)
+        for step in self.steps:
+            step_matrix, heights, widths = step(heights, widths)
+            matrix = step_matrix.matmul(matrix)
+            frame = transform_rects(frame, step_matrix)
+            frame = torch.max(frame, torch.zeros_like(frame))
+            frame = torch.min(frame, torch.stack([widths, heights, widths, heights], dim=1))
+        frame[:, 2:] = frame[:, 2:].clamp(max=self.size[1])
+        frame[:, 3] = frame[:, 3].clamp(max=self.size[0])
+        return matrix, frame
+
+    def __call__(self, images, targets, sizes):
+        """
+        Args:
+            images: (tensor) the padded batch of tb_data.RawCollector, uint8 pixels or
+                normalized float, Shape: [batch, channel, height, width].
+            targets: (list) of tensors of Shape: [num_boxes, 5], the boxes are normalized
+                w.r.t. the size of each image.
+            sizes: (tensor) (height, width) of each image, Shape: [batch, 2].
+        Return:
+            the augmented and normalized images of Shape: [batch, channel, size[0], size[1]] and
+            their targets, the images which lose all their boxes are removed from the batch
+        """
+        device = images.device
+        num, height, width = images.size(0), images.size(2), images.size(3)
+        out_h, out_w = self.size
+        sizes = sizes.cpu()
+        matrix, frame = self.sample(sizes)
+        # grid_sample maps the normalized coordinate of the output to the one of the input
+        to_output = batch_matrix(num, 2.0 / out_w, 2.0 / out_h, -1.0, -1.0)
+        to_input = batch_matrix(num, 2.0 / width, 2.0 / height, -1.0, -1.0)
+        theta = to_input.matmul(matrix.inverse()).matmul(to_output.inverse())[:, :2]
+        dtype = images.dtype if images.is_floating_point() else torch.float32
+        grid = F.affine_grid(theta.to(device, dtype), (num, images.size(1), out_h, out_w), align_corners=False)
+        output = F.grid_sample(images.to(dtype), grid, mode="bilinear", align_corners=False)
+        if not images.is_floating_point():
+            # Only the sampled output is normalized, not the full resolution input
+            channel = images.size(1)
+            output = from_pixels(output, output.new_tensor(self.mean[:channel]).view(-1, 1, 1),
+                                 output.new_tensor(self.std[:channel]).view(-1, 1, 1))
+        # Fill the area without content
+        ys = torch.arange(out_h, device=device, dtype=torch.float64).view(1, -1) + 0.5
+        xs = torch.arange(out_w, device=device, dtype=torch.float64).view(1, -1) + 0.5
+        frame_d = frame.to(device)
+        inside_y = (ys >= frame_d[:, 1:2]) & (ys < frame_d[:, 3:4])
+        inside_x = (xs >= frame_d[:, 0:1]) & (xs < frame_d[:, 2:3])
+        inside = (inside_y.unsqueeze(2) & inside_x.unsqueeze(1)).unsqueeze(1)
+        output = torch.where(inside, output, output.new_tensor(self.pad_value))
+
+        # Transform the boxes of the whole batch at once
+        counts = [t.size(0) for t in targets]
+        if sum(counts) == 0:
+            return output[:0], []
+        labels = torch.cat(targets, dim=0)
+        index = torch.cat([torch.full((c,), i, dtype=torch.long) for i, c in enumerate(counts)])
+        scale = torch.stack([sizes[:, 1], sizes[:, 0]] * 2, dim=1).double()[index]
+        boxes = transform_rects(labels[:, :4].detach().cpu().double() * scale, matrix[index])
+        box_frame = frame[index]
+        keep = (boxes[:, 0] < box_frame[:, 2]) & (boxes[:, 1] < box_frame[:, 3]) & \
+               (boxes[:, 2] > box_frame[:, 0]) & (boxes[:, 3] > box_frame[:, 1])
+        boxes = torch.max(torch.min(boxes, box_frame[:, [2, 3, 2, 3]]), box_frame[:, [0, 1, 0, 1]])
+        boxes = boxes / boxes.new_tensor([out_w, out_h, out_w, out_h])
+        labels = torch.cat([boxes.to(labels), labels[:, 4:]], dim=1)
+        keep_images, new_targets = [], []
+        for i, (target, kept) in enumerate(zip(labels.split(counts), keep.split(counts))):
+            if kept.any():
+                keep_images.append(i)
+                new_targets.append(target[kept.to(target.device)])
+        return output[torch.LongTensor(keep_images).to(device)], new_targets
+
+
+def batch_aug_sroie(args, pad_value=0.5, flip=0.33):
+    """The steps of aug_sroie on a whole batch"""
+    stage_0, stage_1, stage_2 = 1536, 2048, 768
+    steps = [
+        BatchPadToFixedSize(height=stage_0),
+        BatchResize(height=stage_1),
+        BatchAffine(p=args.augment_zoom_probability,
+                    scale=(args.augment_zoom_lower_bound, args.augment_zoom_higher_bound)),
+        BatchCropToFixedSize(height=stage_2, width=stage_2),
+        BatchPadToFixedSize(height=stage_2, width=stage_2),
+        BatchFlip(flip),
+        BatchFlip(flip, vertical=True),
+    ]
+    return BatchAugment(steps, (stage_2, stage_2), pad_value=pad_value, mean=args.img_mean, std=args.img_std)
@@ -0,0 +1,181 @@
+import os, sys, time, argparse
+sys.path.append(os.path.expanduser("~/Documents/sroie2019"))
+import torch
+from researches.ocr.textbox.tb_utils import *
+
+
+def random_text_boxes(num, device="cpu", seed=0):
+    """
+    Create candidate boxes which look like the output of the textbox detector,
+    e.g. many wide boxes jittered around a limited number of text lines.
+    """
+    gen = torch.Generator().manual_seed(seed)
+    lines = max(1, num // 15)
+    center = torch.rand(lines, 2, generator=gen)
+    size = torch.rand(lines, 2, generator=gen) * torch.Tensor([0.3, 0.02]) + torch.Tensor([0.02, 0.01])
+    pick = torch.randint(0, lines, (num,), generator=gen)
+    jitter = (torch.rand(num, 4, generator=gen) - 0.5) * 0.02
+    boxes = torch.cat([center[pick] - size[pick] / 2, center[pick] + size[pick] / 2], dim=1) + jitter
+    scores = torch.rand(num, generator=gen)
+    return boxes.clamp_(min=0, max=1).to(device), scores.to(device)
+
+
+def timeit(func, repeat=5):
+    """Return the average cost (in milliseconds) of calling func"""
+    func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        out = func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat * 1000, out
+
+
+def bench_nms(sizes=(100, 500, 1000, 1500, 3000, 5000), overlap=0.3, repeat=5, device="cpu"):
+    print("NMS on %s, overlap threshold: %s"%(device, overlap))
+    print("%10s | %12s | %12s | %8s | %s"%("candidates", "legacy (ms)", "batched (ms)", "speedup", "same keep"))
+    for num in sizes:
+        boxes, scores = random_text_boxes(num, device)
+        legacy_cost, (keep_l, count_l) = timeit(lambda: nms_legacy(boxes, scores, overlap, num), repeat)
+        new_cost, (keep_n, count_n) = timeit(lambda: nms(boxes, scores, overlap, num), repeat)
+        same = count_l == count_n and torch.equal(keep_l[:count_l], keep_n[:count_n])
+        print("%10d | %12.2f | %12.2f | %7.1fx | %s"%(num, legacy_cost, new_cost, legacy_cost / new_cost, same))
+    print("")
+
+
+def kernel_inputs(num_truths, num_priors, batch=1, seed=0):
+    """Ground truth boxes in point form, priors in center-offset form and regression offsets"""
+    truths = torch.stack([random_text_boxes(num_truths, seed=seed + i)[0] for i in range(batch)])
+    truths[..., 2:] = torch.max(truths[..., 2:], truths[..., :2] + 1e-3)
+    priors, _ = random_text_boxes(num_priors, seed=seed + batch)
+    priors = center_size(priors, 1.0).abs_() + 1e-3
+    loc = torch.randn(batch, num_priors, 4, generator=torch.Generator().manual_seed(seed)) * 0.1
+    return truths, Priors(priors), loc
+
+
+def kernel_calls(truths, priors, loc, variances=(0.1, 0.2)):
+    matched = truths[:, :1].expand(-1, priors.size(0), -1)
+    return {
+        "calibrate_prior": lambda: calibrate_prior(priors.center[:, 2] / priors.center[:, 3]),
+        "intersect": lambda: intersect(truths, priors.point),
+        "jaccard": lambda: jaccard(truths, priors.point),
+        "box_jaccard": lambda: box_jaccard(priors.center, truths[0]),
+        "super_wide_jaccard": lambda: super_wide_jaccard(truths, priors, 1.0),
+        "encode": lambda: encode(matched, priors.center, variances),
+        "decode": lambda: decode(loc, priors.center, variances),
+    }
+
+
+def bench_kernels(sizes=((32, 4000), (64, 8000), (128, 16000)), batch=4, repeat=5, device="cpu"):
+    """
+    Compare the eager box kernels with the TorchScript ones (tb_kernels).
+    The sizes are (num_truths, num_priors) around what a SROIE receipt produces.
+    """
+    backend = get_kernel_backend()
+    if set_kernel_backend("script") != "script":
+        print("TorchScript box kernels are not available, skipped\n")
+        set_kernel_backend(backend)
+        return
+    print("Box kernels on %s, batch size: %d"%(device, batch))
+    print("%20s | %14s | %10s | %11s | %8s | %s" %
+          ("kernel", "truths x priors", "eager (ms)", "script (ms)", "speedup", "max diff"))
+    for num_truths, num_priors in sizes:
+        truths, priors, loc = kernel_inputs(num_truths, num_priors, batch)
+        truths, priors, loc = truths.to(device), priors.to(device), loc.to(device)
+        calls = kernel_calls(truths, priors, loc)
+        for name, func in calls.items():
+            set_kernel_backend("eager")
+            eager_cost, eager_out = timeit(func, repeat)
+            set_kernel_backend("script")
+            # Let the profiling executor specialize the graph before timing
+            for _ in range(3):
+                func()
+            script_cost, script_out = timeit(func, repeat)
+            diff = float((eager_out - script_out).abs().max())
+            print("%20s | %6d x %6d | %10.2f | %11.2f | %7.1fx | %.2e" %
+                  (name, num_truths, num_priors, eager_cost, script_cost, eager_cost / script_cost, diff))
+    set_kernel_backend(backend)
+    print("")
+
+
+def bench_batch_augment(batch=4, repeat=5, device="cpu", seed=0):
+    """
+    Samples per second of the fix_size loading paths on the same receipts (3000 to 4000
+    pixels high), from the decoded images to the augmented 768 x 768 batch on device:
+        per image: FusedSroieAug on each image and stacking the normalized crops (-fua)
+        batch float / uint8: padding the full images by RawCollector (in the workers) and
+        BatchAugment on device (-bta), with float32 images as before or uint8 pixels
+    and the MB which are sent to device for each batch. With workers, the collate cost is
+    spread over them, the on device cost is paid by the training loop.
+    """
+    import types
+    import numpy as np
+    from researches.ocr.textbox.tb_augment import FusedSroieAug, batch_aug_sroie, to_pixels
+    from researches.ocr.textbox.tb_data import RawCollector
+    args = types.SimpleNamespace(augment_zoom_probability=0.5, augment_zoom_lower_bound=1.2,
+                                 augment_zoom_higher_bound=1.6, img_mean=(0.5, 0.5, 0.5), img_std=(1.0, 1.0, 1.0))
+    rng = np.random.RandomState(seed)
+    images = [rng.randint(0, 256, (rng.randint(3000, 4000), rng.randint(900, 1300), 3)).astype(np.uint8)
+              for _ in range(batch)]
+    boxes = np.array([[100, 100, 600, 140], [200, 900, 800, 950]], dtype=np.float32)
+    # What the workers of the data loader hand over: normalized float images and their targets
+    samples = [[(torch.from_numpy(img / 255.0 - 0.5).float().permute(2, 0, 1),
+                 torch.from_numpy(boxes / ([img.shape[1], img.shape[0]] * 2)).float(),
+                 torch.zeros(2))] for img in images]
+    fused, batch_aug = FusedSroieAug(args), batch_aug_sroie(args)
+
+    def per_image():
+        crops = [torch.from_numpy(fused(img, boxes)[0] / 255.0 - 0.5).float().permute(2, 0, 1) for img in images]
+        return torch.stack(crops).to(device)
+
+    def collate_float(samples):
+        # RawCollector before it moved uint8 pixels
+        height = max([s[0][0].size(1) for s in samples])
+        width = max([s[0][0].size(2) for s in samples])
+        padded = torch.full((batch, 3, height, width), 0.5)
+        for i, s in enumerate(samples):
+            padded[i, :, :s[0][0].size(1), :s[0][0].size(2)] = s[0][0]
+        sizes = torch.LongTensor([[s[0][0].size(1), s[0][0].size(2)] for s in samples])
+        return padded, [torch.cat([s[0][1], s[0][2].unsqueeze(-1)], dim=1) for s in samples], sizes
+
+    print("Loading paths of fix_size mode on %s, batch size: %d"%(device, batch))
+    print("%12s | %12s | %16s | %11s | %12s"%("path", "collate (ms)", "on device (ms)", "samples/sec", "MB to device"))
+    cost, _ = timeit(per_image, repeat)
+    print("%12s | %12.1f | %16s | %11.1f | %12.1f"%("per image", cost, "-", batch * 1000 / cost,
+                                                   batch * 3 * 768 * 768 * 4 / 2 ** 20))
+    for name, collate in [("batch float", collate_float), ("batch uint8", RawCollector())]:
+        collate_cost, (padded, targets, sizes) = timeit(lambda: collate(samples), repeat)
+        device_cost, _ = timeit(lambda: batch_aug(padded.to(device), targets, sizes), repeat)
+        print("%12s | %12.1f | %16.1f | %11.1f | %12.1f"%(
+            name, collate_cost, device_cost, batch * 1000 / (collate_cost + device_cost),
+            padded.numel() * padded.element_size() / 2 ** 20))
+    print("")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Textbox Micro-benchmark')
+    parser.add_argument(
+        "-dev",
+        "--device",
+        type=str,
+        help="device to run the benchmark on",
+        default="cpu"
+    )
+    parser.add_argument(
+        "-rpt",
+        "--repeat",
+        type=int,
+        help="how many times each function is called",
+        default=5
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    opt = parse_arguments()
+    bench_nms(repeat=opt.repeat, device=opt.device)
+    bench_kernels(repeat=opt.repeat, device=opt.device)
+    bench_batch_augment(repeat=opt.repeat, device=opt.device)
@@ -0,0 +1,249 @@
+import os, sys, time, glob, argparse
+sys.path.append(os.path.expanduser("~/Documents/sroie2019"))
+import cv2, torch
+import numpy as np
+import omni_torch.utils as util
+import researches.ocr.textbox.tb_preset as preset
+import researches.ocr.textbox.tb_model as model
+import researches.ocr.textbox.tb_data as tb_data
+from researches.ocr.textbox.tb_utils import solve_nms
+from researches.ocr.textbox.tb_postprocess import combine_boxes
+from researches.ocr.textbox.tb_eval import DetectionEvaluator
+
+cfg = model.cfg
+args = util.get_args(preset.PRESET)
+
+
+def pad_image(image, height, width, pad_value=255):
+    """Pad the image (numpy array) at the bottom and on the right to height x width"""
+    return cv2.copyMakeBorder(image, 0, height - image.shape[0], 0, width - image.shape[1],
+                              cv2.BORDER_CONSTANT, value=[pad_value] * 3)
+
+
+def detect_image(args, net, detector, image, stride=128, score_thres=0.1):
+    """
+    Run net on a single image (numpy array before normalization) padded to a multiple of stride.
+    Return:
+        boxes in pixel coordinate of the image (tensor), Shape: [num_boxes, 4]
+        and their scores (tensor), Shape: [num_boxes]
+    """
+    height, width = image.shape[0], image.shape[1]
+    pad_h, pad_w = tb_data.bucket_size(height, width, [], stride=stride)
+    image_t = torch.Tensor(util.normalize_image(args, pad_image(image, pad_h, pad_w)))
+    image_t = image_t.unsqueeze(0).permute(0, 3, 1, 2).to(next(net.parameters()).device)
+    with torch.no_grad():
+        loc_data, conf_data, prior_data = net(image_t, is_train=False)
+        det = detector(loc_data, conf_data, prior_data)[0]
+    det = det[(det[:, 0] == 1) & (det[:, 1] >= score_thres)].cpu()
+    return det[:, 2:] * torch.Tensor([pad_w, pad_h, pad_w, pad_h]), det[:, 1]
+
+
+def merge_regions(boxes, margin, height, width):
+    """
+    Expand each box (pixel coordinate) by margin and merge the overlapping ones until
+    the regions are disjoint.
+    Return:
+        regions (list) of [x1, y1, x2, y2] in integer pixel coordinate
+    """
+    regions = []
+    for box in boxes.tolist():
+        regions.append([max(int(box[0]) - margin, 0), max(int(box[1]) - margin, 0),
+                        min(int(np.ceil(box[2])) + margin, width), min(int(np.ceil(box[3])) + margin, height)])
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        for region in regions:
+            for other in result:
+                if region[0] < other[2] and other[0] < region[2] and region[1] < other[3] and other[1] < region[3]:
+                    other[:] = [min(region[0], other[0]), min(region[1], other[1]),
+                                max(region[2], other[2]), max(region[3], other[3])]
+                    merged = True
+                    break
+            else:
+                result.append(region)
+        regions = result
+    return regions
+
+
+def detect_cascade(args, net, detector, image, coarse_size=768, margin=32, coarse_thres=0.05,
+                   score_thres=0.1, nms_thres=0.3, max_coverage=0.6, stride=128):
+    """
+    Coarse to fine detection: a low resolution pass of net proposes the regions containing
+    text, then only these regions (expanded by margin) are detected again at full resolution.
+    Most of a receipt is blank paper, so the full resolution pass sees a fraction of it.
+    When the regions cover more than max_coverage of the image, the whole image is detected
+    at full resolution instead, which is cheaper than many overlapping crops.
+    Args:
+        image: (numpy array) full resolution image before normalization, Shape: [height, width, channel].
+        net: SSD model, the image is sent to the device of its parameters.
+        detector: Detect layer.
+        coarse_size: (int) longer side of the image in the coarse pass.
+        margin: (int) pixels added around each proposal at full resolution.
+        coarse_thres: (float) score threshold of the proposals, lower than score_thres
+            so that the coarse pass rather proposes too much than misses text.
+    Return:
+        text boxes normalized to [0, 1] w.r.t. the whole image (tensor), Shape: [num_boxes, 4],
+        their scores (tensor), Shape: [num_boxes] and the refined regions (list)
+    """
+    height, width = image.shape[0], image.shape[1]
+    scale = min(coarse_size / max(height, width), 1.0)
+    coarse = cv2.resize(image, (max(round(width * scale), 1), max(round(height * scale), 1)))
+    proposals, _ = detect_image(args, net, detector, coarse, stride=stride, score_thres=coarse_thres)
+    regions = merge_regions(proposals / scale, margin, height, width)
+
+    coverage = sum([(r[2] - r[0]) * (r[3] - r[1]) for r in regions]) / (height * width)
+    if coverage > max_coverage:
+        regions = [[0, 0, width, height]]
+    boxes, scores = [], []
+    for x1, y1, x2, y2 in regions:
+        box, score = detect_image(args, net, detector, image[y1: y2, x1: x2], stride=stride,
+                                  score_thres=score_thres)
+        box = box + torch.Tensor([x1, y1, x1, y1])
+        # Keep the boxes whose center lies in the region instead of its padding
+        center_x, center_y = (box[:, 0] + box[:, 2]) / 2, (box[:, 1] + box[:, 3]) / 2
+        inside = (center_x < x2) & (center_y < y2)
+        boxes.append(box[inside])
+        scores.append(score[inside])
+
+    if len(boxes) == 0:
+        return torch.zeros(0, 4), torch.zeros(0), regions
+    boxes, scores = torch.cat(boxes, dim=0), torch.cat(scores, dim=0)
+    if boxes.size(0) == 0:
+        return boxes, scores, regions
+    boxes = boxes / torch.Tensor([width, height, width, height])
+    boxes[:, 0::2] = boxes[:, 0::2].clamp(min=0, max=1)
+    boxes[:, 1::2] = boxes[:, 1::2].clamp(min=0, max=1)
+    # Boxes near the border of a region may be detected again by a neighbouring region
+    scores, order = scores.sort(descending=True)
+    boxes = boxes[order]
+    keep = solve_nms(boxes.unsqueeze(0), torch.ones_like(scores, dtype=torch.bool).unsqueeze(0), nms_thres)[0]
+    return boxes[keep], scores[keep], regions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Textbox Detector Cascade Benchmark')
+    parser.add_argument(
+        "-mp",
+        "--model_prefix",
+        type=str,
+        help="prefix of the model to be tested",
+        default="ft_003_3"
+    )
+    parser.add_argument(
+        "-nth",
+        "--nth_best_model",
+        type=int,
+        help="1 represent the latest model",
+        default=1
+    )
+    parser.add_argument(
+        "-cpu",
+        "--use_cpu",
+        action="store_true",
+        help="run the model on CPU",
+    )
+    parser.add_argument(
+        "-tdr",
+        "--test_dataset_root",
+        type=str,
+        help="folder of the images and ground truth files",
+        default="~/Pictures/dataset/ocr/SROIE2019_test"
+    )
+    parser.add_argument(
+        "-ext",
+        "--extension",
+        type=str,
+        help="extention of image",
+        default="jpg"
+    )
+    parser.add_argument(
+        "-gt_ext",
+        "--ground_truth_extension",
+        type=str,
+        help="extention of ground truth files",
+        default="txt"
+    )
+    parser.add_argument(
+        "-neval",
+        "--evaluation_num",
+        type=int,
+        help="number of images to be compared",
+        default=32
+    )
+    parser.add_argument(
+        "-sz",
+        "--image_size",
+        type=int,
+        help="longer side of the image at full resolution",
+        default=2048
+    )
+    parser.add_argument(
+        "-cs",
+        "--coarse_size",
+        type=int,
+        help="longer side of the image in the coarse pass",
+        default=768
+    )
+    parser.add_argument(
+        "-cm",
+        "--cascade_margin",
+        type=int,
+        help="pixels added around each proposal of the coarse pass",
+        default=32
+    )
+    parser.add_argument(
+        "-mc",
+        "--max_coverage",
+        type=float,
+        help="detect the whole image at full resolution if the proposals cover more than this",
+        default=0.6
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    opt = parse_arguments()
+    root_path = os.path.expanduser(opt.test_dataset_root)
+    img_list = sorted(glob.glob(root_path + "/*.%s"%(opt.extension)))[:opt.evaluation_num]
+    if len(img_list) == 0:
+        raise FileNotFoundError("No image found in %s"%(root_path))
+    from researches.ocr.textbox.tb_test import load_net
+    device = "cpu" if opt.use_cpu or not torch.cuda.is_available() else "cuda"
+    net = load_net(opt.model_prefix, device, nth=opt.nth_best_model)
+    detector = model.Detect(num_classes=2, bkg_label=0, top_k=1500, conf_thresh=0.05, nms_thresh=0.3)
+
+    evaluators = {"single": DetectionEvaluator(), "cascade": DetectionEvaluator()}
+    cost = {"single": 0, "cascade": 0}
+    coverage = 0
+    for img_file in img_list:
+        img = cv2.imread(img_file)
+        scale = opt.image_size / max(img.shape[0], img.shape[1])
+        image = cv2.resize(img, (round(img.shape[1] * scale), round(img.shape[0] * scale)))
+        height, width = image.shape[0], image.shape[1]
+        gt_boxes = []
+        for coord in tb_data.parse_file(os.path.splitext(img_file)[0] + "." + opt.ground_truth_extension):
+            gt_boxes.append([min(coord[::2]), min(coord[1::2]), max(coord[::2]), max(coord[1::2])])
+        gt_boxes = torch.Tensor(gt_boxes).view(-1, 4)
+        image_t = torch.Tensor(util.normalize_image(args, image)).unsqueeze(0).permute(0, 3, 1, 2)
+
+        for mode in ["single", "cascade"]:
+            start = time.time()
+            if mode == "single":
+                boxes, _ = detect_image(args, net, detector, image, score_thres=0.1)
+                boxes = boxes / torch.Tensor([width, height, width, height])
+            else:
+                boxes, _, regions = detect_cascade(args, net, detector, image, coarse_size=opt.coarse_size,
+                                                   margin=opt.cascade_margin, max_coverage=opt.max_coverage)
+                coverage += sum([(r[2] - r[0]) * (r[3] - r[1]) for r in regions]) / (height * width)
+            cost[mode] += time.time() - start
+            boxes = combine_boxes(boxes, img=image_t)
+            # To pixel coordinate of the original image
+            boxes = boxes.view(-1, 4) * torch.Tensor([width, height, width, height]) / scale
+            evaluators[mode].update([boxes], [gt_boxes], sizes=[(img.shape[0], img.shape[1])])
+
+    print("%8s | %8s | %12s"%("mode", "f1-score", "latency (s)"))
+    for mode in ["single", "cascade"]:
+        print("%8s | %8.4f | %12.3f"%(mode, evaluators[mode].summary()[0.1][3], cost[mode] / len(img_list)))
+    print("The fine pass covers %.1f%% of the image on average"%(100 * coverage / len(img_list)))
@@ -1,5 +1,7 @@
-import os, glob
+import os, glob, math, bisect, random, argparse, tempfile
+from functools import partial
 import torch, cv2, imgaug
+import numpy as np
 import xml.etree.ElementTree as ET
 from torch.utils.data import *
 from omni_torch.data.arbitrary_dataset import Arbitrary_Dataset
@@ -10,15 +12,15 @@ from researches.ocr.textbox.tb_augment import *
 
 
 def get_path_and_label(args, length, paths, auxiliary_info):
+    # The folder is listed once by the annotation index instead of checking every image file
+    index = get_annotation_index(paths, auxiliary_info["txt"])
     img_files, txt_files = [], []
-    path_list = sorted(glob.glob(paths+ "/*.%s"%(auxiliary_info["txt"])))
-    for i, txt_file in enumerate(path_list):
-        img_name = txt_file[txt_file.rfind("/") + 1:-4]
-        img_path = os.path.join(paths, img_name + ".%s" % (auxiliary_info["img"]))
-        if not os.path.exists(img_path):
+    for txt_name in index.names:
+        img_name = os.path.splitext(txt_name)[0] + ".%s" % (auxiliary_info["img"])
+        if img_name not in index.listing:
             continue
-        img_files.append(img_path)
-        txt_files.append(txt_file)
+        img_files.append(os.path.join(paths, img_name))
+        txt_files.append(os.path.join(paths, txt_name))
     return [list(zip(img_files, txt_files))]
 
 
@@ -29,18 +31,16 @@ def extract_bbox(args, path, seed, size):
     else:
         image = cv2.imread(img_file)
     h, w = image.shape[0], image.shape[1]
-    coords = parse_file(txt_file)
+    rects = annotation_rects(txt_file)
     BBox=[]
-    for coord in coords:
-        x1, x2 = min(coord[::2]), max(coord[::2])
-        y1, y2 = min(coord[1::2]), max(coord[1::2])
+    for x1, y1, x2, y2 in rects.tolist():
         if abs(x2 - x1) * abs(y2 - y1) <= args.min_bbox_threshold * h * w / 100:
             # Skip a bbox which is smaller than a certain percentage of the total size
             continue
         BBox.append(imgaug.imgaug.BoundingBox(x1, y1, x2, y2))
     BBox = imgaug.imgaug.BoundingBoxesOnImage(BBox, shape=image.shape)
     # The one with text is labeled as 0 not 1, or that would cause trouble in loss calculations
-    return image, BBox, [0 for i in coords]
+    return image, BBox, [0 for i in range(rects.shape[0])]
 
 
 def parse_file(txt_file):
@@ -69,6 +69,307 @@ def parse_file(txt_file):
     return coords
 
 
+class AnnotationIndex(object):
+    """
+    Persistent index of the annotations (txt or PAGE-XML) of a folder, saved as index_file.
+    Every box is a row of (xmin, ymin, xmax, ymax) in one int16 (or int32 if needed) array,
+    the boxes of the i-th file are rects[box_ptr[i]: box_ptr[i + 1]]. The original coordinates
+    of parse_file are kept in the same way (coords, coord_ptr).
+    Only the files whose mtime changed (or new files) are parsed again when the index is
+    loaded, so starting the dataset and reading an annotation cost almost nothing.
+    Args:
+        folder: (str) folder of the annotations.
+        txt_ext: (str) extension of the annotations, e.g. txt or xml.
+        index_file: (str) default is .tb_annotations_<txt_ext>.npz inside the folder.
+    """
+    def __init__(self, folder, txt_ext, index_file=None):
+        self.folder = folder
+        self.txt_ext = txt_ext
+        if index_file is None:
+            index_file = os.path.join(folder, ".tb_annotations_%s.npz"%(txt_ext))
+        self.index_file = index_file
+        self.update()
+
+    def load(self):
+        """Return the records (mtime, rects, coords, length of each box in coords) of the saved index"""
+        if not os.path.exists(self.index_file):
+            return {}
+        with np.load(self.index_file) as npz:
+            # Each access of a npz key reads the array again
+            index = {key: npz[key] for key in npz.files}
+        box_ptr, coord_ptr = index["box_ptr"], index["coord_ptr"]
+        rects, coords = index["rects"].astype(np.int32), index["coords"].astype(np.int32)
+        records = {}
+        for i, name in enumerate(index["names"].tolist()):
+            start, end = box_ptr[i], box_ptr[i + 1]
+            records[name] = (float(index["mtimes"][i]), rects[start: end],
+                             coords[coord_ptr[start]: coord_ptr[end]], np.diff(coord_ptr[start: end + 1]))
+        return records
+
+    def update(self):
+        """Rebuild the index for the new or modified annotation files"""
+        old = self.load()
+        self.listing, mtimes = set(), {}
+        with os.scandir(self.folder) as scan:
+            for entry in scan:
+                self.listing.add(entry.name)
+                if entry.name.endswith("." + self.txt_ext) and entry.is_file():
+                    mtimes[entry.name] = entry.stat().st_mtime
+        self.names = sorted(mtimes.keys())
+        records, changed = [], set(old.keys()) != set(self.names)
+        for name in self.names:
+            if name in old and old[name][0] == mtimes[name]:
+                records.append(old[name])
+                continue
+            changed = True
+            coords = parse_file(os.path.join(self.folder, name))
+            rects = [[min(c[::2]), min(c[1::2]), max(c[::2]), max(c[1::2])] for c in coords]
+            records.append((mtimes[name], np.array(rects, dtype=np.int32).reshape(-1, 4),
+                            np.array([v for c in coords for v in c], dtype=np.int32),
+                            np.array([len(c) for c in coords], dtype=np.int64)))
+        self.mtimes = np.array([r[0] for r in records], dtype=np.float64)
+        self.box_ptr = np.cumsum([0] + [r[1].shape[0] for r in records]).astype(np.int64)
+        self.coord_ptr = np.cumsum(np.concatenate([[0]] + [r[3] for r in records])).astype(np.int64)
+        rects = np.concatenate([np.zeros((0, 4), dtype=np.int32)] + [r[1] for r in records])
+        coords = np.concatenate([np.zeros(0, dtype=np.int32)] + [r[2] for r in records])
+        # int16 is enough unless a coordinate is larger than 32767
+        small = coords.size == 0 or (coords.min() >= -2 ** 15 and coords.max() < 2 ** 15)
+        dtype = np.int16 if small else np.int32
+        self.rects, self.coords = rects.astype(dtype), coords.astype(dtype)
+        self.lookup = {name: i for i, name in enumerate(self.names)}
+        if changed:
+            self.save()
+        return changed
+
+    def save(self):
+        tmp_file = None
+        try:
+            # Each writer (e.g. the data loader workers) gets its own temporary file,
+            # the last os.replace wins with a complete index
+            folder, name = os.path.split(self.index_file)
+            with tempfile.NamedTemporaryFile(dir=folder, prefix=name[:-4] + ".", suffix=".tmp.npz",
+                                             delete=False) as f:
+                tmp_file = f.name
+                np.savez(f, names=np.array(self.names), mtimes=self.mtimes, box_ptr=self.box_ptr,
+                         rects=self.rects, coords=self.coords, coord_ptr=self.coord_ptr)
+            os.replace(tmp_file, self.index_file)
+        except OSError as e:
+            # e.g. a read-only dataset, the index is still used in memory
+            print("Annotation index of %s is not saved: %s"%(self.folder, e))
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def __contains__(self, name):
+        return name in self.lookup
+
+    def get_rects(self, name):
+        i = self.lookup[name]
+        return self.rects[self.box_ptr[i]: self.box_ptr[i + 1]]
+
+    def get_coords(self, name):
+        """Same as parse_file"""
+        i = self.lookup[name]
+        ptr = self.coord_ptr[self.box_ptr[i]: self.box_ptr[i + 1] + 1]
+        return [self.coords[ptr[k]: ptr[k + 1]].tolist() for k in range(len(ptr) - 1)]
+
+
+# Annotation indexes of this process, keyed by (folder, extension)
+ANNOTATION_INDEXES = {}
+
+
+def get_annotation_index(folder, txt_ext):
+    key = (os.path.abspath(os.path.expanduser(folder)), txt_ext)
+    if key not in ANNOTATION_INDEXES:
+        ANNOTATION_INDEXES[key] = AnnotationIndex(key[0], txt_ext)
+    return ANNOTATION_INDEXES[key]
+
+
+def annotation_rects(txt_file):
+    """(xmin, ymin, xmax, ymax) of each box in txt_file (numpy array), read from the annotation index"""
+    folder, name = os.path.split(txt_file)
+    index = get_annotation_index(folder, os.path.splitext(name)[1][1:])
+    if name not in index:
+        # Created after the index is loaded
+        index.update()
+    return index.get_rects(name)
+
+
+def pack_shards(args, source, auxiliary_info, output_dir, max_height=None, shard_size=2 ** 30):
+    """
+    Decode the images of source once and write them into binary shard files, so that the
+    data loader reads them with memory-mapped numpy views instead of decoding the JPEG
+    and parsing the annotation in every epoch, see fetch_detection_data(shard_root=...).
+    Every augmentation pipeline starts with resizing the height, so images higher than
+    max_height can be downscaled without changing the result much, e.g. 2048 for aug_sroie
+    and 1536 for aug_sroie_dynamic_2.
+    Args:
+        source: (str) folder of the images and annotations (get_path_and_label).
+        output_dir: (str) the shards (shard_xxx.bin) and their index (index.npz) go here.
+        shard_size: (int) bytes of a shard file before the next one is started.
+    The index also records the source files with their mtimes and max_height, so that
+    stale shards are detected by check_shards.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    names, shard, offset, shape, scales, box_ptr, boxes = [], [], [], [], [], [0], []
+    txt_names, mtimes = [], []
+    shard_id, shard_file, position = 0, None, 0
+    for img_file, txt_file in get_path_and_label(args, None, source, auxiliary_info)[0]:
+        txt_names.append(os.path.basename(txt_file))
+        mtimes.append([os.stat(img_file).st_mtime, os.stat(txt_file).st_mtime])
+        if args.img_channel == 1:
+            image = cv2.imread(img_file, 0)
+        else:
+            image = cv2.imread(img_file)
+        scale = 1.0
+        if max_height and image.shape[0] > max_height:
+            scale = max_height / image.shape[0]
+            image = cv2.resize(image, (round(image.shape[1] * scale), max_height), interpolation=cv2.INTER_AREA)
+        image = np.ascontiguousarray(image)
+        if shard_file is None or (position > 0 and position + image.nbytes > shard_size):
+            if shard_file is not None:
+                shard_file.close()
+                shard_id += 1
+            shard_file = open(os.path.join(output_dir, "shard_%03d.bin"%(shard_id)), "wb")
+            position = 0
+        shard_file.write(image.tobytes())
+        names.append(os.path.basename(img_file))
+        shard.append(shard_id)
+        offset.append(position)
+        shape.append([image.shape[0], image.shape[1], 1 if image.ndim == 2 else image.shape[2]])
+        scales.append(scale)
+        position += image.nbytes
+        for x1, y1, x2, y2 in annotation_rects(txt_file).tolist():
+            boxes.append([x1 * scale, y1 * scale, x2 * scale, y2 * scale])
+        box_ptr.append(len(boxes))
+    if shard_file is not None:
+        shard_file.close()
+    np.savez(os.path.join(output_dir, "index.npz"), names=np.array(names), shard=np.array(shard, dtype=np.int32),
+             offset=np.array(offset, dtype=np.int64), shape=np.array(shape, dtype=np.int32).reshape(-1, 3),
+             scale=np.array(scales, dtype=np.float32), box_ptr=np.array(box_ptr, dtype=np.int64),
+             boxes=np.array(boxes, dtype=np.float32).reshape(-1, 4), channel=args.img_channel,
+             txt_names=np.array(txt_names), mtimes=np.array(mtimes, dtype=np.float64).reshape(-1, 2),
+             max_height=int(max_height or 0))
+    return len(names)
+
+
+def check_shards(args, shard_dir, source, auxiliary_info, max_height=0):
+    """
+    Verify the shards of pack_shards against source, like AnnotationIndex does for the
+    annotations: the same image and annotation files with the same mtimes, packed with
+    the same img_channel and max_height (0 is the original size).
+    Return:
+        None if the shards are up to date, otherwise the reason (str)
+    """
+    index = get_shard_reader(shard_dir).index
+    if "mtimes" not in index or "max_height" not in index:
+        return "packed without the source state, pack them again"
+    if int(index["channel"]) != args.img_channel:
+        return "packed with img_channel %d"%(int(index["channel"]))
+    if int(index["max_height"]) != int(max_height or 0):
+        return "packed with max_height %d instead of %d"%(int(index["max_height"]), int(max_height or 0))
+    samples = get_path_and_label(args, None, source, auxiliary_info)[0]
+    img_names = [os.path.basename(img_file) for img_file, _ in samples]
+    txt_names = [os.path.basename(txt_file) for _, txt_file in samples]
+    if img_names != index["names"].tolist() or txt_names != index["txt_names"].tolist():
+        return "the files of the source changed"
+    for (img_file, txt_file), (img_mtime, txt_mtime) in zip(samples, index["mtimes"].tolist()):
+        try:
+            modified = os.stat(img_file).st_mtime != img_mtime or os.stat(txt_file).st_mtime != txt_mtime
+        except OSError:
+            return "%s or its annotation was removed"%(os.path.basename(img_file))
+        if modified:
+            return "%s or its annotation was modified"%(os.path.basename(img_file))
+    return None
+
+
+class ShardReader(object):
+    """
+    Read the images and boxes written by pack_shards. The shards are memory-mapped on the
+    first access, each image is a read-only numpy view of its shard (no copy), which must
+    not be written or handed to torch.from_numpy, see extract_bbox_from_shard.
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        index = np.load(os.path.join(shard_dir, "index.npz"))
+        self.index = {key: index[key] for key in index.files}
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.index["names"])
+
+    def image(self, i):
+        shard = int(self.index["shard"][i])
+        if shard not in self.shards:
+            self.shards[shard] = np.memmap(os.path.join(self.shard_dir, "shard_%03d.bin"%(shard)),
+                                           dtype=np.uint8, mode="r")
+        h, w, c = [int(n) for n in self.index["shape"][i]]
+        start = int(self.index["offset"][i])
+        image = self.shards[shard][start: start + h * w * c]
+        return image.reshape(h, w) if c == 1 else image.reshape(h, w, c)
+
+    def boxes(self, i):
+        return self.index["boxes"][self.index["box_ptr"][i]: self.index["box_ptr"][i + 1]]
+
+
+# Shard readers of this process, the memory maps are shared by all the samples of a shard
+SHARD_READERS = {}
+
+
+def get_shard_reader(shard_dir):
+    if shard_dir not in SHARD_READERS:
+        SHARD_READERS[shard_dir] = ShardReader(shard_dir)
+    return SHARD_READERS[shard_dir]
+
+
+def get_shard_samples(args, length, paths, auxiliary_info):
+    """
+    Replace get_path_and_label when the source is packed, auxiliary_info["shards"] is the shard
+    folder, which is verified by check_shards in fetch_detection_data.
+    """
+    reader = get_shard_reader(auxiliary_info["shards"])
+    return [[(auxiliary_info["shards"], i) for i in range(len(reader))]]
+
+
+def extract_bbox_from_shard(args, path, seed, size, copy=True):
+    """
+    Same as extract_bbox, read from the shards of pack_shards.
+    copy: the read-only view of the shard is copied (one memcpy) before it goes to imgaug
+        and torch. FusedBBoxLoader passes False, as its warp already writes a new image.
+    """
+    reader = get_shard_reader(path[0])
+    image = reader.image(path[1])
+    if copy:
+        image = np.array(image)
+    h, w = image.shape[0], image.shape[1]
+    BBox = []
+    boxes = reader.boxes(path[1])
+    for x1, y1, x2, y2 in boxes.tolist():
+        if abs(x2 - x1) * abs(y2 - y1) <= args.min_bbox_threshold * h * w / 100:
+            # Skip a bbox which is smaller than a certain percentage of the total size
+            continue
+        BBox.append(imgaug.imgaug.BoundingBox(x1, y1, x2, y2))
+    BBox = imgaug.imgaug.BoundingBoxesOnImage(BBox, shape=image.shape)
+    return image, BBox, [0 for i in range(boxes.shape[0])]
+
+
+class FusedBBoxLoader(object):
+    """
+    Apply a FusedSroieAug right after loading the image and its boxes by bbox_loader,
+    the dataset then receives the augmented image and no imgaug augmentation is needed.
+    """
+    def __init__(self, bbox_loader, aug):
+        self.bbox_loader = bbox_loader
+        self.aug = aug
+
+    def __call__(self, args, path, seed, size):
+        image, BBox, labels = self.bbox_loader(args, path, seed, size)
+        boxes = np.array([[bbox.x1, bbox.y1, bbox.x2, bbox.y2] for bbox in BBox.bounding_boxes])
+        image, boxes, keep = self.aug(image, boxes)
+        BBox = imgaug.imgaug.BoundingBoxesOnImage(
+            [imgaug.imgaug.BoundingBox(x1, y1, x2, y2) for x1, y1, x2, y2 in boxes.tolist()], shape=image.shape)
+        return image, BBox, [0 for i in range(keep.shape[0])]
+
+
 def detection_collector(batch):
     imgs, labels = [], []
     for sample in batch:
@@ -84,37 +385,368 @@ def detection_collector(batch):
     return imgs, labels
 
 
+class PinnedCollector(object):
+    """
+    Collate function for images of the same shape (fix_size mode), which writes the samples
+    into reused (pinned) buffers instead of building lists and stacking them.
+    The targets are returned as one padded tensor and the number of boxes of each image,
+    see pad_targets and unpad_targets in tb_utils.
+    In the main process (loading_threads = 0) a ring of num_buffers pinned buffers is reused,
+    so a batch stays valid until num_buffers more batches are collated, and the DataLoader
+    does not pin the batches again (see loader_pin_memory). In a worker process the batch
+    is written into shared memory directly, which is sent to the main process without
+    another copy, but the buffers can not be reused there as the main process holds them,
+    and the DataLoader pins each batch as usual.
+    So the reuse and pinning pay off with -lt 0, when loading is cheap enough for the main
+    process, e.g. with shards (-shr) and FusedSroieAug (-fua). With workers, only the
+    list building, torch.stack and the extra copy into shared memory are saved.
+    Return:
+        images, Shape: [batch, channel, height, width], the padded targets, Shape:
+        [batch, max_boxes, 5] and the number of boxes of each image, Shape: [batch]
+    """
+    def __init__(self, num_buffers=2, pin_memory=None):
+        self.num_buffers = num_buffers
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.buffers = {}
+        self.step = 0
+
+    def buffer(self, name, shape, dtype):
+        numel = int(np.prod(shape))
+        if torch.utils.data.get_worker_info() is not None:
+            return torch.empty(numel, dtype=dtype).share_memory_().view(shape)
+        key = (name, self.step % self.num_buffers)
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.numel() < numel or buffer.dtype != dtype:
+            buffer = torch.empty(numel, dtype=dtype)
+            if self.pin_memory:
+                buffer = buffer.pin_memory()
+            self.buffers[key] = buffer
+        return buffer[:numel].view(shape)
+
+    def __call__(self, batch):
+        self.step += 1
+        # There is no bbox or label inside the image
+        samples = [sample[0] for sample in batch if sample[0][1].size(0) > 0 and sample[0][2].size(0) > 0]
+        if len(samples) == 0:
+            img = batch[0][0][0]
+            return img.new_zeros((0,) + tuple(img.shape)), (img.new_zeros(0, 1, 5), torch.zeros(0, dtype=torch.long))
+        shape = samples[0][0].shape
+        if any([sample[0].shape != shape for sample in samples]):
+            raise ValueError("PinnedCollector requires images of the same shape, "
+                             "use BucketCollector for dynamic input shape")
+        counts = [sample[1].size(0) for sample in samples]
+        images = self.buffer("images", (len(samples),) + tuple(shape), samples[0][0].dtype)
+        targets = self.buffer("targets", (len(samples), max(counts), samples[0][1].size(1) + 1),
+                              samples[0][1].dtype)
+        targets.zero_()
+        for i, (img, boxes, labels) in enumerate(samples):
+            images[i].copy_(img)
+            targets[i, :counts[i], :-1].copy_(boxes)
+            targets[i, :counts[i], -1].copy_(labels.view(-1))
+        return images, (targets, torch.LongTensor(counts))
+
+
+def bucket_size(height, width, buckets, stride=32):
+    """
+    The smallest bucket (height, width) which holds a height x width image, if there is no
+    such bucket, the image size rounded up to a multiple of stride.
+    """
+    fit = [b for b in buckets if b[0] >= height and b[1] >= width]
+    if len(fit) > 0:
+        return min(fit, key=lambda b: b[0] * b[1])
+    return int(math.ceil(height / stride) * stride), int(math.ceil(width / stride) * stride)
+
+
+class BucketCollector(object):
+    """
+    Collate function for images of different shapes (e.g. dynamic input size), which pads
+    the images of a batch to the smallest bucket holding all of them instead of requiring
+    batch size 1. The padding is at the bottom and on the right, the normalized box
+    coordinates are rescaled to the padded image.
+    The number of different input shapes is limited to the buckets, so the prior boxes of
+    each bucket are created only once, see SSD.get_prior and MultiBoxLoss.get_priors.
+    Args:
+        buckets: (list) (height, width) of the buckets.
+        pad_value: (float) value of the padded area, 0.5 is white with the default
+            normalization of tb_preset (mean 0.5, std 1.0).
+    """
+    def __init__(self, buckets, pad_value=0.5):
+        self.buckets = [tuple(b) for b in buckets]
+        self.pad_value = pad_value
+
+    def __call__(self, batch):
+        imgs, labels = [], []
+        for sample in batch:
+            if sample[0][1].size(0) == 0 or sample[0][2].size(0) == 0:
+                # There is no bbox or label inside the image
+                continue
+            imgs.append(sample[0][0])
+            labels.append(torch.cat([sample[0][1], sample[0][2].unsqueeze(-1)], dim=1))
+        if len(imgs) == 0:
+            return batch[0][0][0].unsqueeze(0), labels
+        height, width = bucket_size(max([img.size(1) for img in imgs]),
+                                    max([img.size(2) for img in imgs]), self.buckets)
+        padded = imgs[0].new_full((len(imgs), imgs[0].size(0), height, width), self.pad_value)
+        for i, img in enumerate(imgs):
+            padded[i, :, :img.size(1), :img.size(2)] = img
+            scale = labels[i].new_tensor([img.size(2) / width, img.size(1) / height] * 2 + [1])
+            labels[i] = labels[i] * scale
+        return padded, labels
+
+
+def loader_pin_memory(collate_fn, num_workers):
+    """Whether the DataLoader should pin the batches, PinnedCollector pins them itself in the main process"""
+    return not (isinstance(collate_fn, PinnedCollector) and collate_fn.pin_memory and num_workers == 0)
+
+
+class RawCollector(object):
+    """
+    Collate function for the batched augmentation (see tb_augment.BatchAugment): the images
+    of different shapes are padded at the bottom and on the right to the largest one
+    (rounded up to stride), the boxes stay normalized w.r.t. each image.
+    The normalized float images of the workers are turned back into uint8 pixels, so the
+    padded full resolution batch costs a quarter of the shared memory, pinned memory and
+    host to device copy, BatchAugment normalizes it again after grid_sample.
+    Args:
+        mean, std: the normalization of the images (args.img_mean and args.img_std).
+        pad_value: (float) normalized value of the padded area, 0.5 is white with the
+            default normalization of tb_preset (mean 0.5, std 1.0).
+    Return:
+        the padded uint8 images, the targets and the (height, width) of each image, Shape: [batch, 2]
+    """
+    def __init__(self, mean=(0.5, 0.5, 0.5), std=(1.0, 1.0, 1.0), pad_value=0.5, stride=32):
+        self.mean = mean
+        self.std = std
+        self.pad_value = pad_value
+        self.stride = stride
+
+    def __call__(self, batch):
+        imgs, labels = [], []
+        for sample in batch:
+            if sample[0][1].size(0) == 0 or sample[0][2].size(0) == 0:
+                # There is no bbox or label inside the image
+                continue
+            imgs.append(sample[0][0])
+            labels.append(torch.cat([sample[0][1], sample[0][2].unsqueeze(-1)], dim=1))
+        if len(imgs) == 0:
+            return batch[0][0][0].unsqueeze(0), labels, torch.zeros(0, 2, dtype=torch.long)
+        height, width = bucket_size(max([img.size(1) for img in imgs]),
+                                    max([img.size(2) for img in imgs]), [], stride=self.stride)
+        channel = imgs[0].size(0)
+        mean = torch.Tensor(self.mean[:channel]).view(-1, 1, 1)
+        std = torch.Tensor(self.std[:channel]).view(-1, 1, 1)
+        padded = torch.empty((len(imgs), channel, height, width), dtype=torch.uint8)
+        padded.copy_(to_pixels(torch.full((channel, 1, 1), self.pad_value), mean, std).expand_as(padded))
+        for i, img in enumerate(imgs):
+            padded[i, :, :img.size(1), :img.size(2)] = to_pixels(img, mean, std)
+        sizes = torch.LongTensor([[img.size(1), img.size(2)] for img in imgs])
+        return padded, labels, sizes
+
+
+def image_sizes(img_files):
+    """(height, width) of each image, read from the file header without decoding the image"""
+    from PIL import Image
+    sizes = []
+    for img_file in img_files:
+        with Image.open(img_file) as img:
+            sizes.append((img.size[1], img.size[0]))
+    return sizes
+
+
+def image_aspect_ratios(img_files):
+    """width / height of each image, read from the file header without decoding the image"""
+    return [width / height for height, width in image_sizes(img_files)]
+
+
+class AspectRatioBatchSampler(Sampler):
+    """
+    Batch sampler which only puts images of similar aspect ratio into a batch, so that
+    BucketCollector (or tb_test) pads them to a small bucket.
+    Args:
+        ratios: (list) width / height of each sample, e.g. from image_aspect_ratios.
+        boundaries: (list) ascending aspect ratios separating the groups.
+        indices: (list) dataset index of each ratio, default is the position in ratios.
+    """
+    def __init__(self, ratios, batch_size, boundaries=(0.5, 0.75, 1.0, 1.5), shuffle=True, drop_last=False,
+                 indices=None):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.groups = {}
+        if indices is None:
+            indices = range(len(ratios))
+        for idx, ratio in zip(indices, ratios):
+            self.groups.setdefault(bisect.bisect(boundaries, ratio), []).append(idx)
+
+    def batches(self):
+        batches = []
+        for _, indices in sorted(self.groups.items()):
+            if self.shuffle:
+                indices = random.sample(indices, len(indices))
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start: start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            random.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        if self.drop_last:
+            return sum([len(indices) // self.batch_size for indices in self.groups.values()])
+        return sum([int(math.ceil(len(indices) / self.batch_size)) for indices in self.groups.values()])
+
+
+def source_image_sizes(args, source, auxiliary_info, shard_dir=None):
+    """(height, width) of each sample of source, in the order of the dataset (step_1)"""
+    if shard_dir is not None:
+        shapes = get_shard_reader(shard_dir).index["shape"]
+        return [(int(h), int(w)) for h, w in shapes[:, :2]]
+    samples = get_path_and_label(args, None, os.path.join(os.path.expanduser(args.path), source),
+                                 auxiliary_info)[0]
+    return image_sizes([img_file for img_file, _ in samples])
+
+
+def dataset_indices(dataset, offsets):
+    """
+    Index in the concatenated sources of every sample of dataset, which is a source dataset
+    or a Subset / ConcatDataset of them, offsets maps id() of each source to its first index.
+    """
+    if isinstance(dataset, Subset):
+        parent = dataset_indices(dataset.dataset, offsets)
+        return [parent[i] for i in dataset.indices]
+    if isinstance(dataset, ConcatDataset):
+        return [idx for subset in dataset.datasets for idx in dataset_indices(subset, offsets)]
+    return [offsets[id(dataset)] + i for i in range(len(dataset))]
+
+
+def ratio_batch_sampler(loader, ratios, offsets, batch_size, boundaries, shuffle=True):
+    """AspectRatioBatchSampler over the samples of loader, ratios are given for the concatenated sources"""
+    # A subset sampler draws these positions of loader.dataset, other samplers all of them
+    positions = list(loader.sampler.indices) if hasattr(loader.sampler, "indices") \
+        else list(range(len(loader.dataset)))
+    samples = dataset_indices(loader.dataset, offsets)
+    return AspectRatioBatchSampler([ratios[samples[p]] for p in positions], batch_size, boundaries,
+                                   shuffle=shuffle, indices=positions)
+
+
+def reload_batches(args, loader, collate_fn, batch_sampler=None):
+    """
+    The DataLoader of the same samples drawn by batch_sampler (default is the one of loader),
+    the batches are pinned as loader_pin_memory decides.
+    """
+    return DataLoader(loader.dataset, batch_sampler=batch_sampler or loader.batch_sampler,
+                      num_workers=args.loading_threads, collate_fn=collate_fn,
+                      pin_memory=loader_pin_memory(collate_fn, args.loading_threads))
+
+
 def fetch_detection_data(args, sources, auxiliary_info, batch_size, batch_size_val=None,
-                         shuffle=True, split_val=0.0, k_fold=1, pre_process=None, aug=None):
+                         shuffle=True, split_val=0.0, k_fold=1, pre_process=None, aug=None,
+                         collate_fn=detection_collector, shard_root=None, batch_ratio=None,
+                         ratio_boundaries=(0.5, 0.75, 1.0, 1.5), shard_max_height=0):
+    """
+    shard_root: if not None, a source packed by pack_shards into shard_root/<source>
+        is read from its shards instead of decoding the images, when check_shards finds them
+        up to date and packed with shard_max_height
+    aug: a list of imgaug augmenters or a FusedSroieAug, which is applied by the bbox_loader
+    batch_ratio: function (height, width) -> width / height of the sample after augmentation.
+        If given, the training batches only hold samples whose ratio falls between the same
+        ratio_boundaries (see AspectRatioBatchSampler), e.g. the boundaries of the buckets of
+        BucketCollector, so that a batch is padded to a small bucket.
+    """
+    fused = isinstance(aug, FusedSroieAug)
     args.loading_threads = round(args.loading_threads * torch.cuda.device_count())
     batch_size = batch_size * torch.cuda.device_count()
     if batch_size_val is None:
         batch_size_val = batch_size
     else:
         batch_size_val * torch.cuda.device_count()
-    dataset = []
+    dataset, sizes, offsets = [], [], {}
     for i, source in enumerate(sources):
-        subset = Arbitrary_Dataset(args, sources=[source], step_1=[get_path_and_label],
-                                   step_2=[omth_loader.read_image], bbox_loader=[extract_bbox],
-                                   auxiliary_info=[auxiliary_info[i]], pre_process=[pre_process],
-                                   augmentation=[aug])
+        shard_dir = None if shard_root is None else os.path.join(os.path.expanduser(shard_root), source)
+        if shard_dir is not None and not os.path.exists(os.path.join(shard_dir, "index.npz")):
+            shard_dir = None
+        if shard_dir is not None:
+            stale = check_shards(args, shard_dir, os.path.join(os.path.expanduser(args.path), source),
+                                 auxiliary_info[i], shard_max_height)
+            if stale:
+                print("Shards of %s are not used (%s), the images are decoded instead"%(source, stale))
+                shard_dir = None
+        if batch_ratio is not None:
+            sizes += source_image_sizes(args, source, auxiliary_info[i], shard_dir)
+        if shard_dir is not None:
+            subset = Arbitrary_Dataset(args, sources=[source], step_1=[get_shard_samples],
+                                       step_2=[omth_loader.read_image],
+                                       bbox_loader=[FusedBBoxLoader(partial(extract_bbox_from_shard, copy=False), aug)
+                                                    if fused else extract_bbox_from_shard],
+                                       auxiliary_info=[dict(auxiliary_info[i], shards=shard_dir)],
+                                       pre_process=[pre_process], augmentation=[None if fused else aug])
+        else:
+            subset = Arbitrary_Dataset(args, sources=[source], step_1=[get_path_and_label],
+                                       step_2=[omth_loader.read_image],
+                                       bbox_loader=[FusedBBoxLoader(extract_bbox, aug) if fused else extract_bbox],
+                                       auxiliary_info=[auxiliary_info[i]], pre_process=[pre_process],
+                                       augmentation=[None if fused else aug])
         subset.prepare()
+        offsets[id(subset)] = sum([len(d) for d in dataset])
         dataset.append(subset)
 
     if k_fold > 1:
-        return util.k_fold_cross_validation(args, dataset, batch_size, batch_size_val,
-                                            k_fold, collate_fn=detection_collector)
+        loaders = util.k_fold_cross_validation(args, dataset, batch_size, batch_size_val,
+                                               k_fold, collate_fn=collate_fn)
+    elif split_val > 0:
+        loaders = util.split_train_val_dataset(args, dataset, batch_size, batch_size_val,
+                                               split_val, collate_fn=collate_fn)
     else:
-        if split_val > 0:
-            return util.split_train_val_dataset(args, dataset, batch_size, batch_size_val,
-                                                split_val, collate_fn=detection_collector)
-        else:
-            kwargs = {'num_workers': args.loading_threads, 'pin_memory': True}
-            train_set = DataLoader(ConcatDataset(dataset), batch_size=batch_size,
-                                   shuffle=shuffle, collate_fn=detection_collector, **kwargs)
-            return [(train_set, None)]
+        kwargs = {'num_workers': args.loading_threads,
+                  'pin_memory': loader_pin_memory(collate_fn, args.loading_threads)}
+        train_set = DataLoader(ConcatDataset(dataset), batch_size=batch_size,
+                               shuffle=shuffle, collate_fn=collate_fn, **kwargs)
+        loaders = [(train_set, None)]
+    if batch_ratio is None and not isinstance(collate_fn, PinnedCollector):
+        return loaders
+    # The same samples, drawn by the ratio batch sampler and without pinning the batches
+    # of PinnedCollector twice
+    ratios = [batch_ratio(height, width) for height, width in sizes] if batch_ratio is not None else None
+    result = []
+    for train_set, val_set in loaders:
+        sampler = None if ratios is None else \
+            ratio_batch_sampler(train_set, ratios, offsets, batch_size, ratio_boundaries, shuffle=shuffle)
+        result.append((reload_batches(args, train_set, collate_fn, sampler),
+                       None if val_set is None else reload_batches(args, val_set, collate_fn)))
+    return result
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Pack the detection dataset into binary shards')
+    parser.add_argument(
+        "-o",
+        "--shard_root",
+        type=str,
+        help="the shards of each source go to shard_root/<source>, pass it to fetch_detection_data",
+        default="~/Pictures/dataset/ocr/_shards"
+    )
+    parser.add_argument(
+        "-mh",
+        "--max_height",
+        type=int,
+        help="downscale the images higher than this, 0 keeps the original size",
+        default=0
+    )
+    args = parser.parse_args()
+    return args
 
 
 if __name__ == "__main__":
-    pass
+    import researches.ocr.textbox.tb_preset as preset
+    opt = parse_arguments()
+    args = util.get_args(preset.PRESET)
+    for source, aux in zip(args.train_sources, args.train_aux):
+        output_dir = os.path.join(os.path.expanduser(opt.shard_root), source)
+        num = pack_shards(args, os.path.join(os.path.expanduser(args.path), source), aux, output_dir,
+                          max_height=opt.max_height)
+        print("%d images of %s are packed into %s"%(num, source, output_dir))
     
\ No newline at end of file
@@ -0,0 +1,160 @@
+import os, sys, time, queue
+sys.path.append(os.path.expanduser("~/Documents/sroie2019"))
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def run_member(net, detector, image_t, score_thres=0.1):
+    """
+    Detect a batch with one member of the ensemble.
+    Return:
+        text boxes (list) of each image, each of Shape: [num_boxes, 4]
+    """
+    device = next(net.parameters()).device
+    with torch.no_grad():
+        loc_data, conf_data, prior_data = net(image_t.to(device), is_train=False)
+        detections = detector(loc_data, conf_data, prior_data.to(device))
+    return [det[(det[:, 0] == 1) & (det[:, 1] >= score_thres), 2:].cpu() for det in detections]
+
+
+def member_worker(idx, net, detector, num_threads, score_thres, inputs, outputs):
+    """Loop of a worker process, which detects the images put into inputs until None arrives"""
+    torch.set_num_threads(num_threads)
+    while True:
+        image_t = inputs.get()
+        if image_t is None:
+            break
+        try:
+            outputs.put((idx, run_member(net, detector, image_t, score_thres)))
+        except Exception as e:
+            outputs.put((idx, RuntimeError("member %d failed: %s"%(idx, repr(e)))))
+
+
+class EnsembleRunner(object):
+    """
+    Run the members of an ensemble concurrently instead of one after another, so the
+    latency of the ensemble approaches the one of the slowest member rather than the sum.
+    In thread mode, each member runs in its own thread (PyTorch releases the GIL inside
+    its operators), which also works for members on different GPUs.
+    In process mode, each member runs in its own CPU worker process. The parameters of
+    the members and the input batch are moved to shared memory once and not copied.
+    The CPU cores are split evenly among the members, to avoid oversubscription. In thread
+    mode the intra-op thread count is shared by the whole process, so it is changed for the
+    lifetime of the runner and restored by close().
+    Args:
+        nets: (list) SSD models of the ensemble.
+        detector: Detect layer.
+        mode: (str) "thread" or "process".
+        num_threads: (int) intra-op threads of each member, default is cores / members.
+        timeout: (float) seconds a batch may take in process mode before TimeoutError,
+            None waits as long as the workers are alive.
+    """
+    def __init__(self, nets, detector, mode="thread", num_threads=None, score_thres=0.1, timeout=None):
+        assert mode in ["thread", "process"], "mode should be thread or process"
+        self.nets = nets
+        self.timeout = timeout
+        self.detector = detector
+        self.mode = mode
+        self.score_thres = score_thres
+        if num_threads is None:
+            num_threads = max(1, (os.cpu_count() or 1) // len(nets))
+        self.num_threads = num_threads
+        if mode == "thread":
+            self.prev_num_threads = torch.get_num_threads()
+            torch.set_num_threads(num_threads)
+            self.pool = ThreadPoolExecutor(max_workers=len(nets))
+        else:
+            # Spawned workers do not inherit the OpenMP state of this process
+            ctx = mp.get_context("spawn")
+            self.outputs = ctx.Queue()
+            self.inputs, self.workers = [], []
+            for idx, net in enumerate(nets):
+                assert next(net.parameters()).device.type == "cpu", "process mode only runs on CPU"
+                net.share_memory()
+                inputs = ctx.Queue()
+                worker = ctx.Process(target=member_worker, daemon=True,
+                                     args=(idx, net, detector, num_threads, score_thres, inputs, self.outputs))
+                worker.start()
+                self.inputs.append(inputs)
+                self.workers.append(worker)
+
+    def __call__(self, image_t):
+        """
+        Args:
+            image_t: (tensor) batch of images, Shape: [batch, channel, height, width].
+        Return:
+            text boxes (list) of each image, each is a list of the boxes of each member
+        """
+        results = [None] * len(self.nets)
+        if self.mode == "thread":
+            futures = {self.pool.submit(run_member, net, self.detector, image_t, self.score_thres): idx
+                       for idx, net in enumerate(self.nets)}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        else:
+            image_t = image_t.cpu().share_memory_()
+            for inputs in self.inputs:
+                inputs.put(image_t)
+            # All the members answer before an error is raised, so that no stale result
+            # is left in the queue for the next batch
+            start, errors = time.time(), []
+            for _ in self.nets:
+                idx, result = self.get_output(start)
+                if isinstance(result, Exception):
+                    errors.append(result)
+                results[idx] = result
+            if len(errors) > 0:
+                raise errors[0]
+        # Results are merged as they arrive but kept in the order of members, so that the
+        # output is the same as running them one after another
+        return [[result[i] for result in results] for i in range(image_t.size(0))]
+
+    def get_output(self, start, poll=1.0):
+        """Wait for the next member result, raise when a worker died or timeout is exceeded"""
+        while True:
+            try:
+                return self.outputs.get(timeout=poll)
+            except queue.Empty:
+                dead = [idx for idx, worker in enumerate(self.workers) if not worker.is_alive()]
+                if len(dead) > 0:
+                    raise RuntimeError("the workers of member %s died"%(dead))
+                if self.timeout is not None and time.time() - start > self.timeout:
+                    raise TimeoutError("the ensemble did not answer in %s seconds"%(self.timeout))
+
+    def close(self):
+        if self.mode == "thread":
+            self.pool.shutdown()
+            torch.set_num_threads(self.prev_num_threads)
+        else:
+            for inputs in self.inputs:
+                inputs.put(None)
+            for worker in self.workers:
+                # A worker stuck in a member is stopped instead of blocking the caller
+                worker.join(timeout=10)
+                if worker.is_alive():
+                    worker.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    import researches.ocr.textbox.tb_model as model
+    nets = [model.SSD(model.cfg, connect_loc_to_conf=True, fix_size=False, incep_conf=True, incep_loc=True,
+                      pretrained=False).eval() for _ in range(3)]
+    detector = model.Detect(num_classes=2, bkg_label=0, top_k=1500, conf_thresh=0.05, nms_thresh=0.3)
+    image_t = torch.randn(1, 3, 512, 512)
+    start = time.time()
+    sequential = [run_member(net, detector, image_t) for net in nets]
+    print("sequential: %.3f seconds"%(time.time() - start))
+    for mode in ["thread", "process"]:
+        with EnsembleRunner(nets, detector, mode=mode) as runner:
+            runner(image_t)
+            start = time.time()
+            boxes = runner(image_t)[0]
+            print("%s: %.3f seconds"%(mode, time.time() - start))
+        assert all([torch.equal(a, b[0]) for a, b in zip(boxes, sequential)])
@@ -0,0 +1,215 @@
+import os, sys, glob, argparse
+sys.path.append(os.path.expanduser("~/Documents/sroie2019"))
+import torch
+from multiprocessing import Pool
+from researches.ocr.textbox.tb_utils import batch_measure
+
+
+def rasterize(boxes, height, width):
+    """
+    Paint boxes (in pixel coordinate) on a height x width canvas with a 2D
+    difference array, so the cost does not depend on the size of each box.
+    Return:
+        coverage of the boxes (tensor), Shape: [height, width]
+    """
+    boxes = boxes.view(-1, 4).round().long()
+    x1, x2 = boxes[:, 0].clamp(0, width), boxes[:, 2].clamp(0, width)
+    y1, y2 = boxes[:, 1].clamp(0, height), boxes[:, 3].clamp(0, height)
+    ones = torch.ones(boxes.size(0), dtype=torch.int32, device=boxes.device)
+    diff = torch.zeros(height + 1, width + 1, dtype=torch.int32, device=boxes.device)
+    diff.index_put_((y1, x1), ones, accumulate=True)
+    diff.index_put_((y1, x2), -ones, accumulate=True)
+    diff.index_put_((y2, x1), -ones, accumulate=True)
+    diff.index_put_((y2, x2), ones, accumulate=True)
+    return diff.cumsum(0).cumsum(1)[:height, :width] > 0
+
+
+class DetectionEvaluator(object):
+    """
+    Accumulate the detection metrics of a dataset batch by batch.
+    For each key (e.g. a score threshold), accuracy, precision, recall and f1-score
+    are averaged over images as measure does. Only running sums are kept, so the
+    state has a fixed size no matter how many images are evaluated.
+    If area_metric is enabled, the boxes are also rasterized and the pixel-level
+    (DetEval-style) intersection, predicted area and ground truth area are summed up.
+    Args:
+        keys: (list) keys to be evaluated separately.
+        area_metric: (bool) Whether to compute the rasterized area metric.
+        canvas_size: (int) canvas size used to rasterize normalized boxes.
+    """
+    def __init__(self, keys=(0.1,), area_metric=False, canvas_size=1024):
+        self.keys = list(keys)
+        self.area_metric = area_metric
+        self.canvas_size = canvas_size
+        # accuracy, precision, recall, f1-score
+        self.sums = torch.zeros(len(self.keys), 4, dtype=torch.float64)
+        self.count = torch.zeros(len(self.keys), dtype=torch.float64)
+        # intersection, predicted and ground truth pixels
+        self.area = torch.zeros(len(self.keys), 3, dtype=torch.float64)
+
+    def update(self, pred_boxes, gt_boxes, key=None, sizes=None):
+        """
+        Args:
+            pred_boxes: (list) Predicted boxes of each image, each of Shape: [num_pred, 4].
+            gt_boxes: (list) Ground truth boxes of each image, each of Shape: [num_gt, 4].
+            key: the key the batch is accumulated into, default is the first key.
+            sizes: (list) (height, width) of each image when the boxes are in pixel,
+                if None, the boxes are treated as normalized to [0, 1].
+        """
+        k = 0 if key is None else self.keys.index(key)
+        if len(pred_boxes) == 0:
+            return
+        result = batch_measure(pred_boxes, gt_boxes).double().cpu()
+        precision, recall = result[:, 1], result[:, 2]
+        f1_score = 2 * (recall * precision) / (recall + precision)
+        f1_score[(recall + precision) < 1e-3] = 0
+        self.sums[k] += torch.cat([result, f1_score.unsqueeze(1)], dim=1).sum(0)
+        self.count[k] += result.size(0)
+        if self.area_metric:
+            for i, (pred, gt) in enumerate(zip(pred_boxes, gt_boxes)):
+                if sizes is None:
+                    height = width = self.canvas_size
+                    scale = self.canvas_size
+                else:
+                    height, width = sizes[i]
+                    scale = 1
+                canvas_p = rasterize(pred * scale, height, width)
+                canvas_g = rasterize(gt.to(pred.device) * scale, height, width)
+                self.area[k] += torch.tensor([float((canvas_p & canvas_g).sum()),
+                                              float(canvas_p.sum()), float(canvas_g.sum())], dtype=torch.float64)
+
+    def merge(self, other):
+        """Add the state of another evaluator with the same keys, e.g. from a worker process"""
+        assert self.keys == other.keys, "cannot merge evaluators with different keys"
+        self.sums += other.sums
+        self.count += other.count
+        self.area += other.area
+        return self
+
+    def summary(self):
+        """
+        Return:
+            a dict of key -> (accuracy, precision, recall, f1-score), when area_metric is
+            enabled, the area precision, recall and f1-score are appended
+        """
+        result = {}
+        for k, key in enumerate(self.keys):
+            metrics = (self.sums[k] / self.count[k].clamp(min=1)).tolist()
+            if self.area_metric:
+                inter, pred_area, gt_area = self.area[k].tolist()
+                area_p = inter / max(pred_area, 1)
+                area_r = inter / max(gt_area, 1)
+                area_f1 = 0 if area_p + area_r < 1e-3 else 2 * area_p * area_r / (area_p + area_r)
+                metrics += [area_p, area_r, area_f1]
+            result.update({key: metrics})
+        return result
+
+    def print_summary(self, prefix=" --- "):
+        for key, metrics in sorted(self.summary().items()):
+            msg = "%sConf=%s: accuracy=%.4f, precision=%.4f, recall=%.4f, f1-score=%.4f" % \
+                  ((prefix, key) + tuple(metrics[:4]))
+            if self.area_metric:
+                msg += ", area precision=%.4f, area recall=%.4f, area f1-score=%.4f" % tuple(metrics[4:])
+            print(msg + "  ---")
+
+
+def load_boxes(txt_file):
+    """Read the 4 or 8 point boxes in txt_file as (xmin, ymin, xmax, ymax)"""
+    import researches.ocr.textbox.tb_data as tb_data
+    coords = tb_data.parse_file(txt_file)
+    boxes = [[min(coord[::2]), min(coord[1::2]), max(coord[::2]), max(coord[1::2])] for coord in coords]
+    return torch.Tensor(boxes).view(-1, 4)
+
+
+def _score_files(job):
+    file_pairs, area_metric, batch_size = job
+    evaluator = DetectionEvaluator(area_metric=area_metric)
+    for start in range(0, len(file_pairs), batch_size):
+        preds, gts, sizes = [], [], []
+        for result_file, gt_file in file_pairs[start: start + batch_size]:
+            pred, gt = load_boxes(result_file), load_boxes(gt_file)
+            preds.append(pred)
+            gts.append(gt)
+            # Canvas large enough to hold every box of this image
+            boxes = torch.cat([pred, gt])
+            if boxes.size(0) == 0:
+                sizes.append((1, 1))
+            else:
+                sizes.append((int(boxes[:, 3].max()) + 1, int(boxes[:, 2].max()) + 1))
+        evaluator.update(preds, gts, sizes=sizes)
+    return evaluator
+
+
+def score_directory(result_dir, gt_dir, gt_ext="txt", processes=4, area_metric=False, batch_size=16):
+    """
+    Score the result .txt files (one 8 point box per line) written by tb_test.py
+    against the ground truth files with the same name in gt_dir.
+    Return:
+        DetectionEvaluator with all the images accumulated
+    """
+    result_dir, gt_dir = os.path.expanduser(result_dir), os.path.expanduser(gt_dir)
+    file_pairs = []
+    for result_file in sorted(glob.glob(os.path.join(result_dir, "*.txt"))):
+        name = os.path.basename(result_file)[:-4]
+        gt_file = os.path.join(gt_dir, name + "." + gt_ext)
+        if not os.path.exists(gt_file):
+            print("Ground truth of %s does not exist, skipped"%(name))
+            continue
+        file_pairs.append((result_file, gt_file))
+    processes = max(1, min(processes, len(file_pairs)))
+    jobs = [(file_pairs[i::processes], area_metric, batch_size) for i in range(processes)]
+    evaluator = DetectionEvaluator(area_metric=area_metric)
+    if processes == 1:
+        return evaluator.merge(_score_files(jobs[0]))
+    with Pool(processes) as pool:
+        for worker_evaluator in pool.imap_unordered(_score_files, jobs):
+            evaluator.merge(worker_evaluator)
+    return evaluator
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Textbox Detection Evaluation')
+    parser.add_argument(
+        "-rd",
+        "--result_dir",
+        type=str,
+        help="folder of the result txt files",
+        required=True
+    )
+    parser.add_argument(
+        "-gd",
+        "--ground_truth_dir",
+        type=str,
+        help="folder of the ground truth files",
+        default="~/Pictures/dataset/ocr/SROIE2019_test"
+    )
+    parser.add_argument(
+        "-gt_ext",
+        "--ground_truth_extension",
+        type=str,
+        help="ground truth extention (text file) of image",
+        default="txt"
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        help="number of worker processes",
+        default=4
+    )
+    parser.add_argument(
+        "-area",
+        "--area_metric",
+        action="store_true",
+        help="also compute the rasterized area metric",
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    opt = parse_arguments()
+    evaluator = score_directory(opt.result_dir, opt.ground_truth_dir, gt_ext=opt.ground_truth_extension,
+                                processes=opt.processes, area_metric=opt.area_metric)
+    print("%d images evaluated"%(int(evaluator.count[0])))
+    evaluator.print_summary()
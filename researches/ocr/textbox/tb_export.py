@@ -0,0 +1,182 @@
+"""
+Export the whole text detector (SSD + prior boxes + Detect + combine_boxes) as one
+TorchScript file, so that a worker only needs torch to run it:
+    detector = torch.jit.load("detector.pt")
+    boxes = detector(image_t)
+where image_t is the normalized image tensor of Shape: [1, 3, size, size] as in tb_test.py,
+and boxes are the combined text boxes normalized to [0, 1], Shape: [num_boxes, 4].
+"""
+import os, sys, time, argparse
+sys.path.append(os.path.expanduser("~/Documents/sroie2019"))
+import torch
+import torch.nn as nn
+import researches.ocr.textbox.tb_kernels as tb_kernels
+
+
+class DetectorPipeline(nn.Module):
+    """
+    SSD forward, Detect and combine_boxes for a fixed input size, the prior boxes of
+    that size are stored in the module.
+    Args:
+        network: module which maps the image tensor to (loc, softmax conf), e.g. a traced SSD.
+        priors: (tensor) Prior boxes of the input size in center-offset form.
+        score_thresh: (float) only text boxes with a higher score are combined, as tb_test does.
+    """
+    def __init__(self, network, priors, input_size, variance, num_classes=2, top_k=1500,
+                 conf_thresh=0.05, nms_thresh=0.3, score_thresh=0.1):
+        super().__init__()
+        self.network = network
+        self.register_buffer("priors", priors)
+        self.input_size = list(input_size)
+        self.variance = [float(v) for v in variance]
+        self.num_classes = num_classes
+        self.top_k = top_k
+        self.conf_thresh = conf_thresh
+        self.nms_thresh = nms_thresh
+        self.score_thresh = score_thresh
+
+    def forward(self, image):
+        if [image.size(2), image.size(3)] != self.input_size:
+            raise ValueError("The input size is different from the one the detector is exported for")
+        loc, conf = self.network(image)
+        # Detect and combine_boxes run the same code as tb_model.Detect and tb_postprocess
+        decoded_boxes = tb_kernels.decode(loc.view(1, -1, 4), self.priors, self.variance)
+        boxes, scores, valid, img_idx, labels = tb_kernels.detect_candidates(
+            decoded_boxes, conf, self.num_classes, 0, self.top_k, self.conf_thresh)
+        keep = tb_kernels.solve_nms(boxes, valid, self.nms_thresh)
+        det = tb_kernels.collect_detections(boxes, scores, keep, img_idx, labels, 1, self.top_k)[0]
+        text_boxes = det[(det[:, 0] == 1) & (det[:, 1] >= self.score_thresh), 2:]
+        if text_boxes.size(0) == 0:
+            return text_boxes
+        return tb_kernels.combine_boxes(text_boxes, image)
+
+
+class _Network(nn.Module):
+    """Inference output of SSD without the prior boxes, so that it can be traced"""
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, x):
+        loc, conf, _ = self.net(x, is_train=False)
+        return loc, conf
+
+
+def export_detector(net, path, input_size=2048, top_k=1500, conf_thresh=0.05, nms_thresh=0.3,
+                    score_thresh=0.1, fuse=True):
+    """
+    Trace the SSD at the given input size (square) and script it together with Detect and
+    combine_boxes into one TorchScript file.
+    Return:
+        the scripted DetectorPipeline
+    """
+    net = net.eval()
+    sample = torch.zeros(1, 3, input_size, input_size, device=next(net.parameters()).device)
+    if fuse:
+        net.fuse_for_inference(sample=sample)
+    with torch.no_grad():
+        _, _, priors = net(sample, is_train=False)
+        network = torch.jit.trace(_Network(net), sample, check_trace=False)
+    pipeline = DetectorPipeline(network, priors.to(sample.device), [input_size, input_size],
+                                net.cfg['variance'], num_classes=net.num_classes, top_k=top_k,
+                                conf_thresh=conf_thresh, nms_thresh=nms_thresh, score_thresh=score_thresh)
+    pipeline = torch.jit.script(pipeline)
+    torch.jit.save(pipeline, os.path.expanduser(path))
+    return pipeline
+
+
+def verify_artifact(path, net, image, top_k=1500, conf_thresh=0.05, nms_thresh=0.3, score_thresh=0.1):
+    """
+    Compare the exported detector with the python path used by tb_test.py on image
+    Return:
+        max difference between the boxes (0 when both are empty), inf when the number of boxes differs
+    """
+    from researches.ocr.textbox.tb_model import Detect
+    from researches.ocr.textbox.tb_postprocess import combine_boxes as combine_boxes_eager
+    detector = Detect(num_classes=net.num_classes, bkg_label=0, top_k=top_k,
+                      conf_thresh=conf_thresh, nms_thresh=nms_thresh)
+    with torch.no_grad():
+        loc_data, conf_data, prior_data = net(image, is_train=False)
+        det = detector(loc_data, conf_data, prior_data)[0]
+        text_boxes = det[(det[:, 0] == 1) & (det[:, 1] >= score_thresh), 2:]
+        expected = combine_boxes_eager(text_boxes, img=image) if text_boxes.size(0) > 0 else text_boxes
+        output = torch.jit.load(os.path.expanduser(path), map_location=image.device)(image)
+    if output.shape != expected.shape:
+        return float("inf")
+    return float((output - expected).abs().max()) if output.numel() > 0 else 0.0
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Textbox Detector Export')
+    parser.add_argument(
+        "-mp",
+        "--model_prefix",
+        type=str,
+        help="prefix of the model to be exported",
+        default="ft_003_3"
+    )
+    parser.add_argument(
+        "-nth",
+        "--nth_best_model",
+        type=int,
+        help="1 represent the latest model",
+        default=1
+    )
+    parser.add_argument(
+        "-sz",
+        "--image_size",
+        type=int,
+        help="the exported detector only accepts square images of this size",
+        default=2048
+    )
+    parser.add_argument(
+        "-dtk",
+        "--detector_top_k",
+        type=int,
+        help="get top_k boxes from prediction",
+        default=1500
+    )
+    parser.add_argument(
+        "-dct",
+        "--detector_conf_threshold",
+        type=float,
+        help="detector_conf_threshold",
+        default=0.05
+    )
+    parser.add_argument(
+        "-dnt",
+        "--detector_nms_threshold",
+        type=float,
+        help="detector_nms_threshold",
+        default=0.3
+    )
+    parser.add_argument(
+        "-cpu",
+        "--use_cpu",
+        action="store_true",
+        help="export the detector for CPU",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="path of the exported TorchScript file",
+        default="~/Pictures/dataset/ocr/_text_detection/detector.pt"
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    opt = parse_arguments()
+    from researches.ocr.textbox.tb_test import load_net
+    device = "cpu" if opt.use_cpu or not torch.cuda.is_available() else "cuda"
+    net = load_net(opt.model_prefix, device, nth=opt.nth_best_model)
+    start = time.time()
+    export_detector(net, opt.output, input_size=opt.image_size, top_k=opt.detector_top_k,
+                    conf_thresh=opt.detector_conf_threshold, nms_thresh=opt.detector_nms_threshold)
+    print("Detector exported to %s in %.2f seconds"%(opt.output, time.time() - start))
+    image = torch.rand(1, 3, opt.image_size, opt.image_size, device=device) - 0.5
+    print("Max difference against the python path: %s"%(
+        verify_artifact(opt.output, net, image, top_k=opt.detector_top_k,
+                        conf_thresh=opt.detector_conf_threshold, nms_thresh=opt.detector_nms_threshold)))
@@ -0,0 +1,342 @@
+"""
+TorchScript versions of the box kernels in tb_utils.
+The eager functions in tb_utils run a chain of small element-wise operations, each of
+them launching its own kernel and allocating its own temporary. Here the same math is
+written with broadcasting only (no .repeat() copies) and compiled with torch.jit.script,
+so the fuser can merge the element-wise chains.
+Every kernel gives the same result as its counterpart in tb_utils, which stays as the
+fallback when TorchScript is not available, see tb_utils.set_kernel_backend and
+check_parity.
+detect_candidates, collect_detections and combine_boxes are the single implementation
+of Detect and combine_boxes, run by the eager path and by the exported detector (tb_export).
+"""
+from typing import List, Tuple
+import torch
+
+
+def calibrate_prior(x):
+    t = x + 2 / x
+    s = 0.7 * (t + 1)
+    return 2 / torch.sqrt(torch.tanh(s) + s) + x / 150
+
+
+def point_form(boxes, img_ratio: float):
+    boxes = boxes / torch.tensor([1.0, 1.0, img_ratio, 1.0], dtype=boxes.dtype, device=boxes.device)
+    return torch.cat((boxes[..., :2] - boxes[..., 2:] / 2, boxes[..., :2] + boxes[..., 2:] / 2), -1)
+
+
+def center_size(prior, img_ratio: float):
+    boxes = torch.cat([(prior[..., 2:] + prior[..., :2]) / 2, prior[..., 2:] - prior[..., :2]], -1)
+    return boxes * torch.tensor([1.0, 1.0, img_ratio, 1.0], dtype=prior.dtype, device=prior.device)
+
+
+def get_box_size(box):
+    return (box[..., 2] - box[..., 0]) * (box[..., 3] - box[..., 1])
+
+
+def intersect(box_a, box_b):
+    max_xy = torch.min(box_a[..., :, None, 2:], box_b[..., None, :, 2:])
+    min_xy = torch.max(box_a[..., :, None, :2], box_b[..., None, :, :2])
+    inter = torch.clamp(max_xy - min_xy, min=0)
+    return inter[..., 0] * inter[..., 1]
+
+
+def jaccard(box_a, box_b):
+    inter = intersect(box_a, box_b)
+    area_a = get_box_size(box_a).unsqueeze(-1)
+    area_b = get_box_size(box_b).unsqueeze(-2)
+    return inter / (area_a + area_b - inter)
+
+
+def box_jaccard(prior_a, prior_b):
+    # [num_b, num_a] by broadcasting prior_b over the rows and prior_a over the columns
+    a = prior_a.unsqueeze(0)
+    b = prior_b.unsqueeze(1)
+    center_dis = 1 / torch.sqrt(torch.sum((a[..., :2] - b[..., :2]) ** 2, dim=2) + 1e-5)
+    aspt = a[..., 2] / a[..., 3] / b[..., 2] * b[..., 3]
+    aspt = 1 / (aspt + 1 / aspt)
+    size = a[..., 2] * a[..., 3] / b[..., 2] / b[..., 3]
+    size = 1 / (size + 1 / size)
+    return center_dis / aspt / size
+
+
+def super_wide_overlaps(targets, prior_point, prior_area, prior_ratio, prior_calibration,
+                        img_ratio: float):
+    targets = point_form(center_size(targets, img_ratio), img_ratio)
+    inter = intersect(targets, prior_point)
+    targets_ratio = (targets[..., 2] / targets[..., 3]).unsqueeze(-1)
+    # suppress the prior boxes both too small or too big than the target boxes
+    x = targets_ratio / prior_ratio.unsqueeze(-2)
+    ratio = torch.relu(-0.5 * (x - 1.5) * (x - 1.5) + 2)
+    # suppress the target without wide aspect ratio
+    x = targets_ratio / 3 - 3
+    targets_penelizer = 0.6 * x / (1 + torch.abs(x)) + 0.5
+    super_wide_jac = inter / prior_area.unsqueeze(-2) * prior_calibration.unsqueeze(-2)
+    return super_wide_jac * ratio * targets_penelizer
+
+
+def encode(matched, priors, variances: List[float]):
+    g_cxcy = ((matched[..., :2] + matched[..., 2:]) / 2 - priors[..., :2]) / (variances[0] * priors[..., 2:])
+    g_wh = torch.log((matched[..., 2:] - matched[..., :2]) / priors[..., 2:]) / variances[1]
+    return torch.cat([g_cxcy, g_wh], -1)
+
+
+def decode(loc, priors, variances: List[float]):
+    wh = priors[..., 2:] * torch.exp(loc[..., 2:] * variances[1])
+    xy = priors[..., :2] + loc[..., :2] * variances[0] * priors[..., 2:] - wh / 2
+    return torch.cat([xy, xy + wh], -1)
+
+
+def cluster_nms(boxes, valid, overlap: float):
+    suppress = ((~jaccard(boxes, boxes).le(overlap)).triu(1) & valid.unsqueeze(2)).float()
+    keep = valid
+    while True:
+        suppressed = torch.bmm(keep.float().unsqueeze(1), suppress).squeeze(1) > 0
+        new_keep = valid & ~suppressed
+        if torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+    return keep
+
+
+def greedy_nms(boxes, valid, overlap: float):
+    keep = torch.zeros_like(valid)
+    for b in range(boxes.size(0)):
+        idx = valid[b].nonzero().squeeze(1)
+        while idx.numel() > 0:
+            i = int(idx[0])
+            keep[b, i] = True
+            idx = idx[1:]
+            iou = jaccard(boxes[b, i:i + 1], boxes[b, idx])[0]
+            idx = idx[iou.le(overlap)]
+    return keep
+
+
+def solve_nms(boxes, valid, overlap: float):
+    # Same dispatch as tb_utils.solve_nms (64 is CLUSTER_NMS_CPU_LIMIT), torchvision
+    # is not used so that the exported detector only needs torch
+    if boxes.is_cuda or boxes.size(1) <= 64:
+        return cluster_nms(boxes, valid, overlap)
+    return greedy_nms(boxes, valid, overlap)
+
+
+def detect_candidates(decoded_boxes, conf_data, num_classes: int, background_label: int,
+                      top_k: int, conf_thresh: float) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor,
+                                                                torch.Tensor, torch.Tensor]:
+    """
+    First half of tb_model.Detect, shared with the exported detector (tb_export): the top-k
+    boxes above conf_thresh of each (image, class) pair, sorted by descending score.
+    Return:
+        boxes [batch * classes, k, 4], scores and valid mask [batch * classes, k],
+        image and class of each row [batch * classes]
+    """
+    num = decoded_boxes.size(0)
+    num_priors = decoded_boxes.size(1)
+    classes: List[int] = []
+    for cl in range(num_classes):
+        if cl != background_label:
+            classes.append(cl)
+    labels = torch.tensor(classes, device=conf_data.device)
+    conf_scores = conf_data.view(num, num_priors, num_classes).index_select(2, labels)
+    conf_scores = conf_scores.transpose(2, 1).reshape(-1, num_priors)
+    k = min(top_k, int((conf_scores > conf_thresh).sum(1).max()))
+    scores, idx = conf_scores.topk(k, dim=1)
+    img_idx = torch.arange(num, device=idx.device).repeat_interleave(len(classes))
+    boxes = decoded_boxes[img_idx.unsqueeze(1), idx]
+    return boxes, scores, scores > conf_thresh, img_idx, labels.repeat(num)
+
+
+def collect_detections(boxes, scores, keep, img_idx, labels, num: int, top_k: int) -> List[torch.Tensor]:
+    """
+    Second half of tb_model.Detect, the boxes kept by the NMS of detect_candidates.
+    Return:
+        detections of each image, Shape: [num_kept, 6], a row is (class, score, xmin, ymin, xmax, ymax)
+    """
+    kept = keep.nonzero()
+    row, col = kept[:, 0], kept[:, 1]
+    detections = torch.cat([labels[row].unsqueeze(1).to(boxes.dtype), scores[row, col].unsqueeze(1),
+                            boxes[row, col]], dim=1)
+    img_idx = img_idx[row]
+    output: List[torch.Tensor] = []
+    for i in range(num):
+        det = detections[img_idx == i]
+        _, order = det[:, 1].sort(descending=True)
+        output.append(det[order[:top_k]])
+    return output
+
+
+def combine_boxes(prediction, img, h_thres_pct: float = 1.5, y_thres_pct: float = 1.0,
+                  combine_thres: float = 0.7, overlap_thres: float = 0.0):
+    """
+    The body of tb_postprocess.combine_boxes, shared with the exported detector (tb_export).
+    Return:
+        combined boxes normalized to [0, 1], Shape: [num_boxes, 4]
+    """
+    w = img.size(3)
+    h = img.size(2)
+    _scale = torch.tensor([w, h, w, h], dtype=prediction.dtype, device=prediction.device)
+    prediction = prediction * _scale
+
+    # Eliminate White Boxes
+    qualified_boxes: List[torch.Tensor] = []
+    for i in range(prediction.size(0)):
+        pred = prediction[i]
+        cropped = img[:, :, int(pred[1]): int(pred[3]), int(pred[0]): int(pred[2])]
+        avg_value = 255 * (float(torch.sum(cropped) / cropped.numel()) + 0.5)
+        if not avg_value > 245:
+            qualified_boxes.append(pred)
+    if len(qualified_boxes) == 0:
+        return prediction.new_zeros(0, 4)
+    prediction = torch.stack(qualified_boxes, dim=0)
+
+    # Merge the boxes contained in other boxes
+    merged_boxes: List[torch.Tensor] = []
+    unmerge_idx = torch.ones(prediction.size(0), dtype=torch.bool, device=prediction.device)
+    inter = intersect(prediction, prediction)
+    pred_size = ((prediction[:, 2] - prediction[:, 0]) * (prediction[:, 3] - prediction[:, 1])).unsqueeze(0)
+    indicator = (inter / pred_size) > combine_thres
+    for i in range(indicator.size(0)):
+        idctr = indicator[i].clone()
+        if int(idctr.sum()) <= 1:
+            continue
+        unmerge_idx[idctr] = False
+        merged_boxes.append(
+            torch.cat([torch.min(prediction[idctr][:, :2], dim=0)[0], torch.max(prediction[idctr][:, 2:], dim=0)[0]])
+        )
+        # once a box is merged, it does not need tp be merged or calculated again
+        indicator[:, idctr] = False
+    if len(merged_boxes) > 0:
+        prediction = torch.cat([prediction[unmerge_idx], torch.stack(merged_boxes, dim=0)], dim=0)
+
+    # Boxes with similar height and at almost same height
+    height = prediction[:, 3] - prediction[:, 1]
+    idx_h = torch.abs(height.unsqueeze(0) - height.unsqueeze(1)) < (h_thres_pct * h / 100)
+    center = (prediction[:, 3] + prediction[:, 1]) / 2
+    idx_v = torch.abs(center.unsqueeze(0) - center.unsqueeze(1)) < (y_thres_pct * h / 100)
+    idx = idx_h & idx_v
+    output_box: List[torch.Tensor] = []
+    eliminated = torch.zeros(prediction.size(0), dtype=torch.bool, device=prediction.device)
+    for i in range(idx.size(0)):
+        if bool(eliminated[i]):
+            continue
+        box_id = idx[i]
+        if int(torch.sum(box_id[i:])) == 1:
+            output_box.append(prediction[i, :] / _scale)
+            eliminated[i] = True
+            continue
+        # boxes that have the potential to be connected
+        _box_id = box_id.nonzero().squeeze(1)
+        qualify_box = prediction[box_id]
+        similar_boxes = jaccard(qualify_box, qualify_box) > overlap_thres
+        for j in range(similar_boxes.size(0)):
+            similar_boxes[j, :j] = False
+            similar_id = similar_boxes[j].clone()
+            num_similar = int(torch.sum(similar_id))
+            if num_similar == 0:
+                continue
+            elif num_similar == 1:
+                # this box has no intersecting boxes
+                box_idx = int(_box_id[similar_id][0])
+                if bool(eliminated[box_idx]):
+                    continue
+                eliminated[box_idx] = True
+                output_box.append(qualify_box[similar_id][0] / _scale)
+            else:
+                comb_boxes = qualify_box[similar_id]
+                output_box.append(torch.cat([torch.min(comb_boxes[:, :2], dim=0)[0],
+                                             torch.max(comb_boxes[:, 2:], dim=0)[0]]) / _scale)
+                eliminated[_box_id[similar_id]] = True
+            # Eliminate the boxes that already been combined
+            similar_boxes[:, similar_id] = False
+    return torch.stack(output_box, dim=0)
+
+
+KERNELS = ["calibrate_prior", "intersect", "jaccard", "box_jaccard",
+           "super_wide_overlaps", "encode", "decode", "cluster_nms", "greedy_nms", "solve_nms"]
+
+# None until script_kernels is called, then whether the KERNELS were compiled
+SCRIPTED = None
+
+
+def script_kernels():
+    """
+    Compile the KERNELS with torch.jit.script and replace the python functions of this
+    module by them. It happens once, on the first set_kernel_backend("script"), so that
+    importing tb_utils does not pay for compiling kernels which may never be used.
+    Return:
+        True if the scripted kernels are available
+    """
+    global SCRIPTED
+    if SCRIPTED is None:
+        try:
+            scripted = {name: torch.jit.script(globals()[name]) for name in KERNELS}
+            globals().update(scripted)
+            SCRIPTED = True
+        except Exception as e:
+            print("TorchScript box kernels are not available (%s), eager kernels are used."%(e))
+            SCRIPTED = False
+    return SCRIPTED
+
+
+def check_parity(num_truths=16, num_priors=400, batch=2, seed=0, rtol=1e-4, atol=1e-5):
+    """
+    Compare every kernel of this module with its eager counterpart in tb_utils on random
+    boxes (on CPU), the nms kernels must keep exactly the same boxes.
+    Return:
+        max absolute difference of each kernel (dict), AssertionError on a mismatch
+    """
+    import researches.ocr.textbox.tb_utils as tb_utils
+    gen = torch.Generator().manual_seed(seed)
+    def random_boxes(*size):
+        xy = torch.rand(*size, 2, generator=gen) * 0.8
+        wh = torch.rand(*size, 2, generator=gen) * torch.Tensor([0.3, 0.05]) + 1e-2
+        return torch.cat([xy, xy + wh], -1)
+    truths = random_boxes(batch, num_truths)
+    priors = tb_utils.Priors(tb_utils.center_size(random_boxes(num_priors), 1.0))
+    loc = torch.randn(batch, num_priors, 4, generator=gen) * 0.1
+    matched = truths[:, :1].expand(-1, num_priors, -1)
+    # jittered copies of a few boxes, so that the nms really suppresses
+    candidates = truths[:, :4].repeat(1, 30, 1) + torch.randn(batch, 120, 4, generator=gen) * 0.005
+    valid = torch.rand(batch, 120, generator=gen) > 0.1
+    t = tb_utils
+    # name: (eager call, call of the kernel of this module)
+    calls = {
+        "calibrate_prior": (lambda: t.calibrate_prior(priors.center[:, 2] / priors.center[:, 3]),
+                            lambda: calibrate_prior(priors.center[:, 2] / priors.center[:, 3])),
+        "intersect": (lambda: t.intersect(truths, priors.point), lambda: intersect(truths, priors.point)),
+        "jaccard": (lambda: t.jaccard(truths, priors.point), lambda: jaccard(truths, priors.point)),
+        "box_jaccard": (lambda: t.box_jaccard(priors.center, truths[0]), lambda: box_jaccard(priors.center, truths[0])),
+        "super_wide_overlaps": (lambda: t.super_wide_jaccard(truths, priors, 1.0),
+                                lambda: super_wide_overlaps(truths, priors.point, priors.area, priors.point_ratio,
+                                                            priors.point_calibration, 1.0)),
+        "encode": (lambda: t.encode(matched, priors.center, [0.1, 0.2]),
+                   lambda: encode(matched, priors.center, [0.1, 0.2])),
+        "decode": (lambda: t.decode(loc, priors.center, [0.1, 0.2]), lambda: decode(loc, priors.center, [0.1, 0.2])),
+        "cluster_nms": (lambda: t.cluster_nms(candidates, valid, 0.3), lambda: cluster_nms(candidates, valid, 0.3)),
+        "greedy_nms": (lambda: t.greedy_nms(candidates, valid, 0.3), lambda: greedy_nms(candidates, valid, 0.3)),
+        "solve_nms": (lambda: t.solve_nms(candidates, valid, 0.3), lambda: solve_nms(candidates, valid, 0.3)),
+    }
+    backend = tb_utils.get_kernel_backend()
+    tb_utils.set_kernel_backend("eager")
+    diffs = {}
+    try:
+        for name in KERNELS:
+            expected, result = calls[name][0](), calls[name][1]()
+            if expected.dtype == torch.bool:
+                assert torch.equal(expected, result), "%s keeps other boxes than tb_utils"%(name)
+                diffs[name] = 0.0
+            else:
+                assert torch.allclose(expected, result, rtol=rtol, atol=atol, equal_nan=True), \
+                    "%s differs from tb_utils"%(name)
+                diffs[name] = float((expected - result).abs().max())
+    finally:
+        tb_utils.set_kernel_backend(backend)
+    return diffs
+
+
+if __name__ == "__main__":
+    import os, sys
+    sys.path.append(os.path.expanduser("~/Documents/sroie2019"))
+    print("scripted: %s"%(script_kernels()))
+    for name, diff in check_parity().items():
+        print("%20s | max diff: %.2e"%(name, diff))
@@ -1,9 +1,9 @@
 import torch
 import torch.nn as nn
+from collections import OrderedDict
 import torch.nn.functional as F
-from torch.autograd import Variable
 #from layers.box_utils import match, log_sum_exp
-from researches.ocr.textbox.tb_utils import match, log_sum_exp
+from researches.ocr.textbox.tb_utils import match_batch, pad_targets, Priors
 
 #
 # This a slight modified version from originally implementation
@@ -33,7 +33,7 @@ class MultiBoxLoss(nn.Module):
         See: https://arxiv.org/pdf/1512.02325.pdf for more details.
     """
 
-    def __init__(self, cfg, neg_pos, use_gpu=True):
+    def __init__(self, cfg, neg_pos, use_gpu=True, prior_cache_size=8):
         super(MultiBoxLoss, self).__init__()
         self.cfg = cfg
         self.num_classes = cfg['num_classes']
@@ -42,8 +42,38 @@ class MultiBoxLoss(nn.Module):
         self.threshold = cfg['overlap_thresh']
         self.negpos_ratio = neg_pos
         self.balancer = cfg['alpha']
+        # Prior boxes and their derived tensors of each input shape (e.g. batch bucket), see get_priors
+        self.prior_cache = OrderedDict()
+        self.prior_cache_size = prior_cache_size
 
-    def forward(self, predictions, targets, ratios):
+    def get_priors(self, priors, ratios, input_size=None):
+        """
+        Return the Priors object of priors, it is only built once for each prior set.
+        Prior boxes are fully decided by the cfg and the input shape, so the input shape
+        (height, width) together with the device and image ratio identifies the prior set,
+        the same as SSD.get_prior. Without input_size, the number of priors is not enough
+        (e.g. 769 and 770 pixel inputs have as many priors at different scales), so a
+        cached prior set is only reused when it equals priors.
+        The latest prior_cache_size prior sets are kept, so that batches of a few
+        input shapes (see tb_data.BucketCollector) do not rebuild them in turn.
+        """
+        if isinstance(priors, Priors):
+            return priors
+        if input_size is None:
+            key = (priors.size(0), str(priors.device), ratios)
+        else:
+            key = (tuple(input_size), str(priors.device), ratios)
+        prior = self.prior_cache.pop(key, None)
+        if prior is not None and input_size is None and not torch.equal(prior.center, priors.data):
+            prior = None
+        if prior is None:
+            prior = Priors(priors.data, ratios, grid_size=self.cfg.get('match_grid'))
+        self.prior_cache[key] = prior
+        while len(self.prior_cache) > self.prior_cache_size:
+            self.prior_cache.popitem(last=False)
+        return prior
+
+    def forward(self, predictions, targets, ratios, input_size=None):
         """Multibox Loss
         Args:
             predictions (tuple): A tuple containing loc preds, conf preds,
@@ -52,30 +82,23 @@ class MultiBoxLoss(nn.Module):
                 loc shape: torch.size(batch_size,num_priors,4)
                 priors shape: torch.size(num_priors,4)
 
-            targets (tensor): Ground truth boxes and labels for a batch,
-                shape: [batch_size,num_objs,5] (last idx is the label).
+            targets (list): Ground truth boxes and labels for each image,
+                shape: [num_objs,5] (last idx is the label), or the padded targets
+                and the number of boxes of each image (see tb_data.PinnedCollector).
+            input_size (tuple): (height, width) of the input images, which identifies the
+                prior set, see get_priors.
         """
         loc_data, conf_data, priors = predictions
         num = loc_data.size(0)
         # If we use nn.DataParallel then prior size will be multiplied by GPU count
-        priors = priors[:loc_data.size(1), :]
-        num_priors = (priors.size(0))
+        priors = self.get_priors(priors[:loc_data.size(1)], ratios, input_size)
 
-        # match priors (default boxes) and ground truth boxes
-        loc_t = torch.Tensor(num, num_priors, 4)
-        conf_t = torch.LongTensor(num, num_priors)
-        for idx in range(num):
-            gt_coord = targets[idx][:, :-1].data
-            gt_labels = targets[idx][:, -1].data
-            default_box = priors.data
-            match(self.cfg, self.threshold, gt_coord, default_box, self.variance, gt_labels,
-                  loc_t, conf_t, idx, ratios)
-        if self.use_gpu:
-            loc_t = loc_t.cuda()
-            conf_t = conf_t.cuda()
-        # wrap targets
-        loc_t = Variable(loc_t, requires_grad=False)
-        conf_t = Variable(conf_t, requires_grad=False)
+        # match priors (default boxes) and ground truth boxes for the whole batch
+        targets, valid = pad_targets(targets)
+        with torch.no_grad():
+            targets = targets.to(loc_data.device)
+            loc_t, conf_t = match_batch(self.cfg, self.threshold, targets[:, :, :-1], targets[:, :, -1],
+                                        valid.to(loc_data.device), priors, self.variance, ratios)
 
         pos = conf_t > 0
         num_pos = pos.sum(dim=1, keepdim=True)
@@ -87,25 +110,22 @@ class MultiBoxLoss(nn.Module):
         loc_t = loc_t[pos_idx].view(-1, 4)
         loss_l = F.smooth_l1_loss(loc_p, loc_t, size_average=False)
 
-        # Compute max conf across batch for hard negative mining
-        batch_conf = conf_data.view(-1, self.num_classes)
-        loss_c = log_sum_exp(batch_conf) - batch_conf.gather(1, conf_t.view(-1, 1))
-        loss_c = loss_c.view(num, -1)
+        # Confidence loss (cross entropy) of every prior, computed in one pass
+        # and shared by hard negative mining and the final confidence loss
+        # Shape: [batch,num_priors]
+        loss_c = torch.logsumexp(conf_data, dim=2) - conf_data.gather(2, conf_t.unsqueeze(2)).squeeze(2)
         # Hard Negative Mining
-        loss_c[pos] = 0  # filter out pos boxes for now
-        loss_c = loss_c.view(num, -1)
-        _, loss_idx = loss_c.sort(1, descending=True)
-        _, idx_rank = loss_idx.sort(1)
+        # Select the num_neg negatives with highest loss of each image by topk,
+        # instead of sorting the loss of every prior twice
+        mining = loss_c.detach().masked_fill(pos, 0)  # filter out pos boxes for now
         num_pos = pos.long().sum(1, keepdim=True)
         num_neg = torch.clamp(self.negpos_ratio*num_pos, max=pos.size(1)-1)
-        neg = idx_rank < num_neg.expand_as(idx_rank)
+        _, neg_idx = mining.topk(int(num_neg.max()), dim=1)
+        neg_rank = torch.arange(neg_idx.size(1), device=neg_idx.device).unsqueeze(0)
+        neg = torch.zeros_like(pos).scatter_(1, neg_idx, neg_rank < num_neg)
 
         # Confidence Loss Including Positive and Negative Examples
-        pos_idx = pos.unsqueeze(2).expand_as(conf_data)
-        neg_idx = neg.unsqueeze(2).expand_as(conf_data)
-        conf_p = conf_data[(pos_idx+neg_idx).gt(0)].view(-1, self.num_classes)
-        targets_weighted = conf_t[(pos+neg).gt(0)]
-        loss_c = F.cross_entropy(conf_p, targets_weighted, size_average=False)
+        loss_c = loss_c[pos | neg].sum()
 
         # Sum of losses: L(x,c,l,g) = (Lconf(x, c) + αLloc(x,l,g)) / N
 
@@ -1,11 +1,13 @@
 import torch, sys, os, math
+from collections import OrderedDict
 import torch.nn as nn
-from torch.autograd import Function
 import numpy as np
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from torchvision.models import vgg16_bn
 import omni_torch.networks.blocks as omth_blocks
 import researches.ocr.textbox as init
 from researches.ocr.textbox.tb_utils import *
+import researches.ocr.textbox.tb_kernels as tb_kernels
 
 cfg = {
     # Configuration for 512x512 input image
@@ -50,13 +52,25 @@ cfg = {
     'clip': True,
     'super_wide': 0.5,
     'super_wide_coeff': 0.5,
+    # Max elements of one overlap tile during matching, the priors are matched chunk by chunk
+    # so that the full (ground truth x prior) overlap matrix is never allocated
+    # Set it to None to compute the overlaps in one go
+    'match_tile': 2 ** 22,
+    # If not None, bucket the prior boxes into a match_grid x match_grid grid and only compute
+    # the overlaps of the priors inside the cells covered by ground truth boxes
+    # The matching result is identical to the dense one
+    'match_grid': None,
 }
 
 
 class SSD(nn.Module):
     def __init__(self, cfg, btnk_chnl=512, batch_norm=nn.BatchNorm2d, fix_size=True,
                  connect_loc_to_conf=False, incep_loc=False, incep_conf=False, nms_thres=0.2,
-                 nms_top_k=1600, nms_conf_thres=0.01):
+                 nms_top_k=1600, nms_conf_thres=0.01, prior_cache_size=8, pretrained=True,
+                 init_weights=True):
+        # pretrained: load the ImageNet weights of VGG-16, init_weights: initialize the loc and
+        # conf layers, both of them are wasted when a detector checkpoint is loaded afterwards,
+        # see create_empty_ssd
         super().__init__()
         self.cfg = cfg
         self.num_classes = cfg['num_classes']
@@ -72,8 +86,15 @@ class SSD(nn.Module):
         self.fix_size = fix_size
         self.bottleneck_channel = btnk_chnl
         self.batch_norm = batch_norm
+        self.pretrained = pretrained
+        self.init_weights = init_weights
+        # Prior boxes of dynamic input shapes, see get_prior
+        self.prior_cache = OrderedDict()
+        self.prior_cache_size = prior_cache_size
         if fix_size:
-            self.prior = self.create_prior()#.cuda()
+            # Prior boxes are not parameters, always create them on CPU (e.g. under a meta device context)
+            with torch.device("cpu"):
+                self.prior = self.create_prior()#.cuda()
 
         # Create the backbone model structure
         self.create_backbone_model()
@@ -82,18 +103,25 @@ class SSD(nn.Module):
         for i  in range(len(cfg['conv_output'])):
             in_channel = cfg["loc_and_conf"][i]
             anchor = calculate_anchor_number(cfg, i)
+            # After anchors are pruned (see tb_anchor.prune_anchors), the loc layer still predicts
+            # the original anchors, which are fed to conf_concate, only the kept ones are output
+            loc_anchor = cfg['loc_anchor_number'][i] if cfg.get('loc_anchor_index') else anchor
+            if loc_anchor != anchor:
+                index = [a * 4 + c for a in cfg['loc_anchor_index'][i] for c in range(4)]
+                with torch.device("cpu"):
+                    self.register_buffer("loc_index_%d"%(i), torch.tensor(index), persistent=False)
             # Create Location and Confidence Layer
             self.loc_layers.append(self.create_loc_layer(
-                in_channel, anchor, cfg['stride'][i], incep_loc=incep_loc, in_wid=128))
-            conf_layer, conf_concate = self.create_conf_layer(in_channel, anchor,
-                                                              cfg['stride'][i], incep_conf=incep_conf)
+                in_channel, loc_anchor, cfg['stride'][i], incep_loc=incep_loc, in_wid=128))
+            conf_layer, conf_concate = self.create_conf_layer(in_channel, anchor, cfg['stride'][i],
+                                                              incep_conf=incep_conf, loc_anchor=loc_anchor)
             self.conf_layers.append(conf_layer)
             self.conf_concate.append(conf_concate)
 
 
     def create_backbone_model(self):
         # Prepare VGG-16 net with batch normalization
-        vgg16_model = vgg16_bn(pretrained=True)
+        vgg16_model = vgg16_bn(pretrained=self.pretrained)
         net = list(vgg16_model.children())[0]
         # Replace the maxout with ceil in vanilla vgg16 net
         ceil_maxout = nn.MaxPool2d(kernel_size=2, stride=2, padding=0, dilation=1, ceil_mode=True)
@@ -160,10 +188,11 @@ class SSD(nn.Module):
             input_channel, filters=[input_channel, int(input_channel / 2), anchor * 4],
             kernel_sizes=[3, 1, 3], stride=[1, 1, stride], padding=[0, 1, 1], activation=None)
         )
-        loc_layer.apply(init.init_cnn)
+        if self.init_weights:
+            loc_layer.apply(init.init_cnn)
         return loc_layer
 
-    def create_conf_layer(self, in_channel, anchor, stride, incep_conf=False):
+    def create_conf_layer(self, in_channel, anchor, stride, incep_conf=False, loc_anchor=None):
         conf_layer = nn.ModuleList([])
         conf_layer.append(omth_blocks.conv_block(
             in_channel, [in_channel, in_channel], kernel_sizes=[3, 1], stride=[1, 1],
@@ -187,17 +216,19 @@ class SSD(nn.Module):
             # Feeding the conf layer with regressed location, helping the conf layer
             # to get better prediction
             conf_concate = omth_blocks.conv_block(
-                int(in_channel / 2) + anchor * 4, kernel_sizes=[3, 1, 3],
+                int(in_channel / 2) + (anchor if loc_anchor is None else loc_anchor) * 4, kernel_sizes=[3, 1, 3],
                 filters=[int(in_channel / 2), int(in_channel / 4), anchor * 2],
                 stride=[1, 1, stride], padding=[1, 0, 1], activation=None)
-            conf_concate.apply(init.init_cnn)
+            if self.init_weights:
+                conf_concate.apply(init.init_cnn)
         else:
             print("incep_conf is turned off due to connect_loc_to_conf is False")
             conf_layer.append(omth_blocks.conv_block(
                 in_channel, filters=[in_channel, int(in_channel / 2), anchor * 2],
                 kernel_sizes=[1, 3, 3], stride=[1, 1, stride], padding=[0, 1, 1], activation=None))
             conf_concate = None
-        conf_layer.apply(init.init_cnn)
+        if self.init_weights:
+            conf_layer.apply(init.init_cnn)
         return conf_layer, conf_concate
 
     def create_prior(self, feature_map_size=None, input_size=None):
@@ -206,43 +237,105 @@ class SSD(nn.Module):
         :param input_size: When input size is not None. which means Dynamic Input Size
         :return:
         """
-        from itertools import product as product
-        mean = []
+        prior_boxes = []
         big_box = self.cfg['big_box']
         if feature_map_size is None:
             assert len(self.cfg['feature_map_sizes']) >= len(self.cfg['conv_output'])
             feature_map_size = self.cfg['feature_map_sizes']
         if input_size is None:
-            input_size = cfg['input_img_size']
+            input_size = self.cfg['input_img_size']
         assert len(input_size) == 2, "input_size should be either int or list of int with 2 elements"
-        input_ratio = input_size[1] / input_size[0]
         for k in range(len(self.cfg['conv_output'])):
             # Get setting for prior creation from cfg
             h, w = get_parameter(feature_map_size[k])
-            h_stride, w_stride = get_parameter(cfg['stride'][k])
-            for i, j in product(range(0, int(h), int(h_stride)), range(0, int(w), int(w_stride))):
-                # 4 point represent: center_x, center_y, box_width, box_height
-                cx = (j + 0.5) / w
-                cy = (i + 0.5) / h
-                # Add prior boxes with different height and aspect-ratio
-                for height in self.cfg['box_height'][k]:
-                    s_k = height / input_size[0]
-                    for box_ratio in self.cfg['box_ratios'][k]:
-                        mean += [cx, cy, s_k * box_ratio, s_k]
-                # Add prior boxes with different number aspect-ratio if the box is large
-                if big_box:
-                    for height in self.cfg['box_height_large'][k]:
-                        s_k_big = height / input_size[0]
-                        for box_ratio_l in self.cfg['box_ratios_large'][k]:
-                            mean += [cx, cy, s_k_big * box_ratio_l, s_k_big]
-        # back to torch land
-        prior_boxes = torch.Tensor(mean).view(-1, 4)
+            h_stride, w_stride = get_parameter(self.cfg['stride'][k])
+            # Anchor table of (box_width, box_height), prior boxes with different height and
+            # aspect-ratio, followed by the large ones if big_box is enabled
+            anchors = [[height / input_size[0] * box_ratio, height / input_size[0]]
+                       for height in self.cfg['box_height'][k] for box_ratio in self.cfg['box_ratios'][k]]
+            if big_box:
+                anchors += [[height / input_size[0] * box_ratio_l, height / input_size[0]]
+                            for height in self.cfg['box_height_large'][k]
+                            for box_ratio_l in self.cfg['box_ratios_large'][k]]
+            # Computed in double precision so that the result is the same as python float
+            anchors = torch.tensor(anchors, dtype=torch.float64)
+            cy = (torch.arange(0, int(h), int(h_stride), dtype=torch.float64) + 0.5) / h
+            cx = (torch.arange(0, int(w), int(w_stride), dtype=torch.float64) + 0.5) / w
+            # 4 point represent: center_x, center_y, box_width, box_height
+            # in the order of (row, column, anchor)
+            grid = torch.stack([cx.unsqueeze(0).expand(cy.size(0), cx.size(0)),
+                                cy.unsqueeze(1).expand(cy.size(0), cx.size(0))], dim=-1)
+            grid = grid.view(-1, 1, 2).expand(-1, anchors.size(0), 2)
+            anchors = anchors.unsqueeze(0).expand(grid.size(0), -1, 2)
+            prior_boxes.append(torch.cat([grid, anchors], dim=-1).reshape(-1, 4))
+        # back to float
+        prior_boxes = torch.cat(prior_boxes, dim=0).float()
         if self.cfg['clip']:
             #boxes = center_size(prior_boxes, input_ratio)
             prior_boxes.clamp_(max=1, min=0)
             #prior_boxes = point_form(boxes, input_ratio)
         return prior_boxes
 
+    def get_prior(self, feature_map_size, input_size, device):
+        """
+        LRU cached version of create_prior, so that the prior boxes of a repeated
+        input shape are only created (and moved to device) once
+        """
+        key = (tuple(tuple(get_parameter(size)) for size in feature_map_size), tuple(input_size), str(device))
+        prior = self.prior_cache.pop(key, None)
+        if prior is None:
+            prior = self.create_prior(feature_map_size=feature_map_size, input_size=input_size).to(device)
+        # (Re-)insert as the most recently used one
+        self.prior_cache[key] = prior
+        while len(self.prior_cache) > self.prior_cache_size:
+            self.prior_cache.popitem(last=False)
+        return prior
+
+    def fuse_for_inference(self, sample=None, atol=1e-4):
+        """
+        Prepare the model for inference only:
+            1. drop the conv modules after the last one in cfg['conv_output'] (e.g. extra_4),
+               forward never reaches them.
+            2. fold every BatchNorm2d (running statistics) into the Conv2d right before it.
+        Must be called after the weights are loaded, the fused model cannot load the
+        original state_dict and should not be trained any more.
+        Args:
+            sample: (tensor) If not None, an input batch used to verify the outputs are unchanged.
+            atol: (float) Absolute tolerance of the verification, a relative tolerance
+                of 1e-3 is also allowed.
+        Return:
+            the model itself in eval mode
+        """
+        self.eval()
+        if sample is not None:
+            with torch.no_grad():
+                loc_ref, conf_ref, _ = self.forward(sample)
+        # Dead modules
+        last = max([self.conv_module_name.index(name) for name in self.output_list])
+        self.conv_module = nn.ModuleList(list(self.conv_module)[:last + 1])
+        self.conv_module_name = self.conv_module_name[:last + 1]
+        # BatchNorm folding, conv blocks are sequences of (conv, bn, activation)
+        fused = 0
+        for container in list(self.modules()):
+            if not isinstance(container, (nn.Sequential, nn.ModuleList)):
+                continue
+            for i in range(len(container) - 1):
+                conv, bn = container[i], container[i + 1]
+                if type(conv) is nn.Conv2d and isinstance(bn, nn.BatchNorm2d) \
+                        and bn.track_running_stats and bn.num_features == conv.out_channels:
+                    container[i] = fuse_conv_bn_eval(conv, bn)
+                    container[i + 1] = nn.Identity()
+                    fused += 1
+        if sample is not None:
+            with torch.no_grad():
+                loc, conf, _ = self.forward(sample)
+            diff = max(float((loc - loc_ref).abs().max()), float((conf - conf_ref).abs().max()))
+            if not (torch.allclose(loc, loc_ref, rtol=1e-3, atol=atol) and
+                    torch.allclose(conf, conf_ref, rtol=1e-3, atol=atol)):
+                raise RuntimeError("Outputs of the fused model differ by %s (atol=%s)"%(diff, atol))
+            print("%d BatchNorm layers fused, max output difference: %.2e"%(fused, diff))
+        return self
+
     def forward(self, x, is_train=True, verbose=False):
         input_size = [x.size(2), x.size(3)]
         locations, confidences, conv_output = [], [], []
@@ -259,13 +352,18 @@ class SSD(nn.Module):
                     # Doesn't need to compute further convolutional output
                     break
         if not self.fix_size:
-            self.prior = self.create_prior(feature_map_size=feature_shape, input_size=input_size).cuda()
+            self.prior = self.get_prior(feature_shape, input_size, x.device)
         for i, x in enumerate(conv_output):
             # Calculate location regression
             loc = x
             for layer in self.loc_layers[i]:
                 loc = layer(loc)
-            locations.append(loc.permute(0, 2, 3, 1).contiguous().view(loc.size(0), -1, 4))
+            if hasattr(self, "loc_index_%d"%(i)):
+                # Pruned anchors
+                loc_out = loc.index_select(1, getattr(self, "loc_index_%d"%(i)))
+            else:
+                loc_out = loc
+            locations.append(loc_out.permute(0, 2, 3, 1).contiguous().view(loc.size(0), -1, 4))
 
             # Calculate prediction confidence
             conf = x
@@ -292,13 +390,59 @@ class SSD(nn.Module):
         #return output
 
 
-class Detect(Function):
+def create_empty_ssd(cfg, **kwargs):
+    """
+    Create the SSD structure without allocating or initializing any weight, for the case
+    where the weights come from a detector checkpoint anyway (e.g. tb_test.py).
+    Nothing is downloaded and the parameters live on the meta device until they are replaced
+    by net.load_state_dict(state_dict, assign=True).
+    Args:
+        kwargs: the arguments of SSD except pretrained and init_weights.
+    """
+    with torch.device("meta"):
+        net = SSD(cfg, pretrained=False, init_weights=False, **kwargs)
+    return net
+
+
+def assert_materialized(net):
+    """Raise if some parameters or buffers are still on the meta device"""
+    empty = [name for name, tensor in list(net.named_parameters()) + list(net.named_buffers())
+             if tensor.is_meta]
+    if len(empty) > 0:
+        raise RuntimeError("%d tensors are not loaded from the checkpoint, e.g. %s"%(len(empty), empty[0]))
+    return net
+
+
+def level_slices(net, image):
+    """Prior index range of each output level, used to compare the heads separately"""
+    shapes = []
+    hooks = [net.conv_module[net.conv_module_name.index(name)].register_forward_hook(
+        lambda m, i, o: shapes.append(o.shape[2:])) for name in net.output_list]
+    with torch.no_grad():
+        net(image)
+    for hook in hooks:
+        hook.remove()
+    slices, start = [], 0
+    for i, (h, w) in enumerate(shapes):
+        end = start + h * w * calculate_anchor_number(net.cfg, i)
+        slices.append(slice(start, end))
+        start = end
+    return slices
+
+
+class Detect(nn.Module):
     """At test time, Detect is the final layer of SSD.  Decode location preds,
     apply non-maximum suppression to location predictions based on conf
     scores and threshold to a top_k number of output predictions for both
     confidence score and locations.
+    The whole batch is decoded at once on the device of the inputs and the NMS
+    of every (image, class) pair is solved by solve_nms: together in the cluster
+    form on GPU, one by one in the greedy form on CPU. Only the boxes whose
+    score is above conf_thresh take part in NMS, so the cost scales with the
+    number of surviving boxes.
     """
     def __init__(self, num_classes, bkg_label, top_k, conf_thresh, nms_thresh):
+        super().__init__()
         self.num_classes = num_classes
         self.background_label = bkg_label
         self.top_k = top_k
@@ -317,44 +461,31 @@ class Detect(Function):
             conf_data: (tensor) Shape: Conf preds from conf layers
                 Shape: [batch*num_priors,num_classes]
             prior_data: (tensor) Prior boxes and variances from priorbox layers
-                Shape: [1,num_priors,4]
+                Shape: [1,num_priors,4], or the Priors object of them
+        Return:
+            A list of detections of each image, each is a tensor of Shape: [num_kept, 6]
+            where a row is (class, score, xmin, ymin, xmax, ymax), sorted by descending score.
         """
+        if isinstance(prior_data, Priors):
+            prior_data = prior_data.center
         num = loc_data.size(0)  # batch size
         num_priors = prior_data.size(0)
-        output = torch.zeros(num, self.num_classes, self.top_k, 5)
-        conf_preds = conf_data.view(num, num_priors,
-                                    self.num_classes).transpose(2, 1)
-
-        # Decode predictions into bboxes.
-        for i in range(num):
-            decoded_boxes = decode(loc_data[i], prior_data, self.variance)
-            # For each class, perform nms
-            conf_scores = conf_preds[i].clone()
-
-            for cl in range(1, self.num_classes):
-                c_mask = conf_scores[cl].gt(self.conf_thresh)
-                scores = conf_scores[cl][c_mask]
-                if scores.size(0) == 0:
-                    continue
-                l_mask = c_mask.unsqueeze(1).expand_as(decoded_boxes)
-                boxes = decoded_boxes[l_mask].view(-1, 4)
-                # idx of highest scoring and non-overlapping boxes per class
-                ids, count = nms(boxes, scores, self.nms_thresh, self.top_k)
-                output[i, cl, :count] = \
-                    torch.cat((scores[ids[:count]].unsqueeze(1),
-                               boxes[ids[:count]]), 1)
-        flt = output.contiguous().view(num, -1, 5)
-        _, idx = flt[:, :, 0].sort(1, descending=True)
-        _, rank = idx.sort(1)
-        flt[(rank < self.top_k).unsqueeze(-1).expand_as(flt)].fill_(0)
-        return output.cuda()
+        # Decode predictions into bboxes, Shape: [batch, num_priors, 4]
+        decoded_boxes = decode(loc_data.view(num, num_priors, 4), prior_data, self.variance)
+        # Candidates are the top-k boxes above conf_thresh of each (image, class) pair,
+        # the same code as the exported detector (tb_export) runs, see tb_kernels
+        boxes, scores, valid, img_idx, labels = tb_kernels.detect_candidates(
+            decoded_boxes, conf_data, self.num_classes, self.background_label, self.top_k, float(self.conf_thresh))
+        keep = solve_nms(boxes, valid, self.nms_thresh)
+        return tb_kernels.collect_detections(boxes, scores, keep, img_idx, labels, num, self.top_k)
 
 
 if __name__ == "__main__":
     import time
-    tmp = torch.randn(1, 3, 128, 128).to("cuda")
-    x = torch.randn(2, 3, 768, 768).to("cuda")
-    ssd = SSD(cfg, connect_loc_to_conf=True, incep_conf=True, incep_loc=True).to("cuda")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    tmp = torch.randn(1, 3, 128, 128).to(device)
+    x = torch.randn(2, 3, 768, 768).to(device)
+    ssd = SSD(cfg, connect_loc_to_conf=True, incep_conf=True, incep_loc=True).to(device)
 
     # Warm up
     _ = ssd(tmp)
@@ -365,3 +496,10 @@ if __name__ == "__main__":
     print(conf.shape)
     print(prior.shape)
     print("Calculation cost: %s seconds"%(time.time() - start))
+
+    # Inference with the BatchNorm layers folded into the convolutions
+    ssd.fuse_for_inference(sample=tmp)
+    with torch.no_grad():
+        start = time.time()
+        ssd(x, is_train=False)
+    print("Calculation cost after fusion: %s seconds"%(time.time() - start))
@@ -0,0 +1,134 @@
+"""
+Structured channel pruning of the loc and conf heads of SSD.
+Every output level has a dilated conv block, an InceptionBlock and the output conv blocks
+in both of its loc and conf head, which cost about as much as the backbone.
+Inside a conv block (nn.Sequential), the output channels of a convolution are only consumed
+by the next convolution of the same block, so they can be removed physically without
+touching the rest of the model. The channels are ranked by the scale of the BatchNorm after
+the convolution (or the L1 norm of its filters when there is none), the least important ones
+are removed and the model is fine-tuned briefly, see prune in textbox.py.
+"""
+import os, sys, time
+sys.path.append(os.path.expanduser("~/Documents/sroie2019"))
+import torch
+import torch.nn as nn
+from researches.ocr.textbox.tb_anchor import slice_conv, slice_batch_norm
+
+HEADS = ["loc_layers", "conf_layers", "conf_concate"]
+
+
+def prunable_pairs(net):
+    """
+    Yield (name, block, i, j) for each pair of consecutive Conv2d i and j inside a conv block
+    of the heads, where only BatchNorm2d and parameter-free layers lie in between.
+    name identifies the pair in the model, e.g. loc_layers.0.0.0
+    """
+    for name, block in net.named_modules():
+        if name.split(".")[0] not in HEADS or not isinstance(block, nn.Sequential):
+            continue
+        convs = [i for i, layer in enumerate(block) if type(layer) is nn.Conv2d]
+        for i, j in zip(convs[:-1], convs[1:]):
+            between = list(block)[i + 1: j]
+            if block[i].groups != 1 or block[j].groups != 1:
+                continue
+            if any(not isinstance(layer, nn.BatchNorm2d) and len(list(layer.parameters())) > 0
+                   for layer in between):
+                continue
+            yield "%s.%d"%(name, i), block, i, j
+
+
+def channel_importance(block, i, j, criterion="bn"):
+    """Importance of each output channel of block[i], a larger value is more important"""
+    if criterion == "bn":
+        for layer in list(block)[i + 1: j]:
+            if isinstance(layer, nn.BatchNorm2d) and layer.affine:
+                return layer.weight.data.abs()
+    # L1 norm of the filters, also used when the BatchNorm is folded into the convolution
+    return block[i].weight.data.abs().sum(dim=(1, 2, 3))
+
+
+def prune_pair(block, i, j, index):
+    """Keep the output channels in index of block[i] and the corresponding input channels of block[j]"""
+    block[i] = slice_conv(block[i], out_index=index)
+    for k in range(i + 1, j):
+        if isinstance(block[k], nn.BatchNorm2d):
+            block[k] = slice_batch_norm(block[k], index)
+    block[j] = slice_conv(block[j], in_index=index)
+
+
+def prune_heads(net, ratio, criterion="bn", divisor=8, min_channels=8):
+    """
+    Remove ratio of the prunable channels of every conv block in the heads.
+    Args:
+        net: (SSD) float model with trained weights.
+        ratio: (float) fraction of the channels removed in each prunable layer.
+        criterion: (str) "bn" (BatchNorm scale) or "l1" (L1 norm of the filters).
+        divisor: (int) the number of kept channels is rounded to a multiple of divisor,
+            which suits the convolution kernels better.
+    Return:
+        the number of removed channels, the kept channels are recorded in net.head_channels
+        so that the structure can be rebuilt before loading, see resize_heads
+    """
+    if not hasattr(net, "head_channels"):
+        net.head_channels = {}
+    removed = 0
+    for name, block, i, j in list(prunable_pairs(net)):
+        channels = block[i].out_channels
+        keep = int(round(channels * (1 - ratio) / divisor) * divisor)
+        keep = min(max(keep, min_channels), channels)
+        if keep == channels:
+            continue
+        importance = channel_importance(block, i, j, criterion)
+        index = importance.topk(keep)[1].sort()[0]
+        prune_pair(block, i, j, index)
+        net.head_channels[name] = keep
+        removed += channels - keep
+    return removed
+
+
+def resize_heads(net, head_channels):
+    """Shrink the heads of a newly created SSD to head_channels, so that a pruned state_dict fits"""
+    for name, block, i, j in list(prunable_pairs(net)):
+        if name in head_channels:
+            prune_pair(block, i, j, torch.arange(head_channels[name]))
+    net.head_channels = dict(head_channels)
+    return net
+
+
+def head_parameters(net):
+    return sum([p.numel() for head in HEADS for p in getattr(net, head).parameters()])
+
+
+def measure_latency(net, dataset, num=20):
+    """Average forward time (in seconds) of an image over the first num batches of dataset"""
+    device = next(net.parameters()).device
+    cost, count = 0, 0
+    with torch.no_grad():
+        for batch_idx, batch in enumerate(dataset):
+            if batch_idx >= num:
+                break
+            images = batch[0].to(device)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.time()
+            net(images, is_train=False)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            cost += time.time() - start
+            count += images.size(0)
+    return cost / max(count, 1)
+
+
+if __name__ == "__main__":
+    import copy
+    import researches.ocr.textbox.tb_model as model
+    net = model.SSD(model.cfg, connect_loc_to_conf=True, fix_size=False, incep_conf=True, incep_loc=True,
+                    pretrained=False).eval()
+    sample = torch.randn(1, 3, 512, 512)
+    for ratio in [0.25, 0.5, 0.75]:
+        pruned = copy.deepcopy(net)
+        removed = prune_heads(pruned, ratio)
+        dataset = [(sample, None)] * 3
+        print("ratio %.2f: %d channels removed, head parameters %d -> %d, latency %.3f -> %.3f seconds"%(
+            ratio, removed, head_parameters(net), head_parameters(pruned),
+            measure_latency(net, dataset), measure_latency(pruned, dataset)))
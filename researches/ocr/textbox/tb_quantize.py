@@ -0,0 +1,297 @@
+import os, sys, time, glob, copy, argparse
+sys.path.append(os.path.expanduser("~/Documents/sroie2019"))
+import cv2, torch
+import torch.nn as nn
+import torch.ao.quantization as quant
+import torch.ao.nn.intrinsic as nni
+import omni_torch.utils as util
+import researches.ocr.textbox.tb_preset as preset
+import researches.ocr.textbox.tb_model as model
+import researches.ocr.textbox.tb_data as tb_data
+from researches.ocr.textbox.tb_eval import DetectionEvaluator
+
+cfg = model.cfg
+args = util.get_args(preset.PRESET)
+
+
+def fuse_conv_relu(net):
+    """
+    Merge each Conv2d with the ReLU following it (BatchNorm must be folded already
+    by SSD.fuse_for_inference), so that they become a single quantized op.
+    """
+    for container in list(net.modules()):
+        if not isinstance(container, nn.Sequential):
+            continue
+        for i in range(len(container) - 1):
+            if type(container[i]) is not nn.Conv2d:
+                continue
+            j = i + 1
+            while j < len(container) - 1 and isinstance(container[j], nn.Identity):
+                j += 1
+            if type(container[j]) is nn.ReLU:
+                container[i] = nni.ConvReLU2d(container[i], container[j])
+                container[j] = nn.Identity()
+    return net
+
+
+def wrap_blocks(module, qconfig):
+    """
+    Put a QuantStub / DeQuantStub pair at both ends of every Sequential holding convolutions,
+    e.g. the VGG stages and the conv blocks of the extra, loc and conf layers. The stubs are
+    inserted into the blocks, which SSD.forward iterates over, instead of wrapping them.
+    Everything between the blocks (torch.cat, softmax, reshapes) stays in float.
+    """
+    for child in module.children():
+        if isinstance(child, nn.Sequential) and \
+                any(isinstance(m, (nn.Conv2d, nni.ConvReLU2d)) for m in child.children()):
+            child.insert(0, quant.QuantStub())
+            child.append(quant.DeQuantStub())
+            child.qconfig = qconfig
+        else:
+            wrap_blocks(child, qconfig)
+    return module
+
+
+def heads(net):
+    """Return the loc and conf heads of each output level as (name, [module list])"""
+    result = []
+    for i in range(len(net.output_list)):
+        result.append(("loc_%d"%(i), ["loc_layers"], i))
+        result.append(("conf_%d"%(i), ["conf_layers", "conf_concate"], i))
+    return result
+
+
+def relative_error(output, reference):
+    return float((output - reference).norm() / reference.norm().clamp(min=1e-12))
+
+
+def head_errors(qnet, float_net, images, slices):
+    """Relative L2 error of the location and softmax confidence output of every head"""
+    errors = {}
+    with torch.no_grad():
+        for image in images:
+            loc_q, conf_q, _ = qnet(image, is_train=False)
+            loc_f, conf_f, _ = float_net(image, is_train=False)
+            for i, level in enumerate(slices):
+                for name, q, f in [("loc_%d"%(i), loc_q, loc_f), ("conf_%d"%(i), conf_q, conf_f)]:
+                    error = relative_error(q[:, level], f[:, level])
+                    errors[name] = max(errors.get(name, 0), error)
+    return errors
+
+
+def prepare_quantization(float_net, backend="x86"):
+    """Copy of float_net (BatchNorm folded) with the observers inserted"""
+    torch.backends.quantized.engine = backend
+    qnet = fuse_conv_relu(copy.deepcopy(float_net))
+    wrap_blocks(qnet, quant.get_default_qconfig(backend))
+    return quant.prepare(qnet, inplace=True)
+
+
+def restore_float_heads(qnet, float_net, names):
+    """Replace the heads in names (e.g. loc_0, conf_2) of qnet with the float ones"""
+    for name, attrs, i in heads(qnet):
+        if name in names:
+            for attr in attrs:
+                getattr(qnet, attr)[i] = copy.deepcopy(getattr(float_net, attr)[i])
+    qnet.float_heads = list(names)
+    return qnet
+
+
+def quantize_ssd(net, calib_images, backend="x86", max_error=0.05):
+    """
+    Post-training static int8 quantization of an SSD for CPU inference.
+    Args:
+        net: (SSD) model with trained weights.
+        calib_images: (list) input tensors used to calibrate the activation ranges.
+        backend: (str) quantized engine, "x86" / "fbgemm" on servers, "qnnpack" on ARM.
+        max_error: (float) a loc or conf head whose relative output error is larger
+            than this is switched back to float.
+    Return:
+        the quantized model and the relative error of each head (dict)
+    """
+    float_net = copy.deepcopy(net).cpu().fuse_for_inference(sample=calib_images[0])
+    qnet = prepare_quantization(float_net, backend)
+    with torch.no_grad():
+        for image in calib_images:
+            qnet(image)
+    quant.convert(qnet, inplace=True)
+
+    # Fall back to float for the heads which lose too much accuracy
+    slices = model.level_slices(float_net, calib_images[0])
+    errors = head_errors(qnet, float_net, calib_images, slices)
+    float_heads = []
+    for name, _, _ in heads(qnet):
+        if errors[name] > max_error:
+            print("%s has a relative error of %.4f, fall back to float"%(name, errors[name]))
+            float_heads.append(name)
+    restore_float_heads(qnet, float_net, float_heads)
+    qnet.quantized_backend = backend
+    return qnet, head_errors(qnet, float_net, calib_images, slices)
+
+
+def save_quantized(qnet, path):
+    """
+    Quantized modules cannot be pickled as a whole model, so only the state_dict is saved
+    together with what is needed to rebuild the same structure, see load_quantized.
+    """
+    torch.save({"state_dict": qnet.state_dict(), "float_heads": qnet.float_heads,
+                "backend": qnet.quantized_backend}, path)
+
+
+def load_quantized(path, net=None):
+    """
+    Args:
+        path: (str) file saved by save_quantized.
+        net: (SSD) float model with the same structure, created without pretrained or
+            initialized weights if None, since all of them are overwritten by the state_dict.
+    Return:
+        the quantized model in eval mode on CPU
+    """
+    checkpoint = torch.load(os.path.expanduser(path), map_location="cpu", weights_only=False)
+    if net is None:
+        net = model.SSD(cfg, connect_loc_to_conf=True, fix_size=False, incep_conf=True, incep_loc=True,
+                        pretrained=False, init_weights=False)
+    float_net = net.cpu().fuse_for_inference()
+    qnet = prepare_quantization(float_net, checkpoint["backend"])
+    quant.convert(qnet, inplace=True)
+    restore_float_heads(qnet, float_net, checkpoint["float_heads"])
+    qnet.quantized_backend = checkpoint["backend"]
+    qnet.load_state_dict(checkpoint["state_dict"])
+    return qnet.eval()
+
+
+def load_image(img_file, size):
+    """
+    Resize the longer side of the image to size and pad it into a square as tb_test does.
+    Return:
+        image tensor and its ground truth boxes normalized to [0, 1]
+    """
+    img = cv2.imread(img_file)
+    h, w = img.shape[0], img.shape[1]
+    scale = size / max(h, w)
+    h_re, w_re = round(h * scale), round(w * scale)
+    top, left = (size - h_re) // 2, (size - w_re) // 2
+    image = cv2.copyMakeBorder(cv2.resize(img, (w_re, h_re)), top, size - h_re - top,
+                               left, size - w_re - left, cv2.BORDER_CONSTANT, value=(255, 255, 255))
+    image_t = torch.Tensor(util.normalize_image(args, image)).unsqueeze(0).permute(0, 3, 1, 2)
+    gt_boxes = []
+    for coord in tb_data.parse_file(os.path.splitext(img_file)[0] + ".txt"):
+        gt_boxes.append([(min(coord[::2]) * scale + left) / size, (min(coord[1::2]) * scale + top) / size,
+                         (max(coord[::2]) * scale + left) / size, (max(coord[1::2]) * scale + top) / size])
+    return image_t, torch.Tensor(gt_boxes).view(-1, 4)
+
+
+def evaluate(net, detector, samples):
+    """Return the f1-score and the average latency (in seconds) of a forward pass"""
+    evaluator = DetectionEvaluator()
+    cost = 0
+    with torch.no_grad():
+        for image, gt_boxes in samples:
+            start = time.time()
+            loc_data, conf_data, prior_data = net(image, is_train=False)
+            cost += time.time() - start
+            det = detector(loc_data, conf_data, prior_data)[0]
+            evaluator.update([det[(det[:, 0] == 1) & (det[:, 1] >= 0.1), 2:]], [gt_boxes])
+    return evaluator.summary()[0.1][3], cost / max(len(samples), 1)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Textbox Detector Quantization')
+    parser.add_argument(
+        "-mp",
+        "--model_prefix",
+        type=str,
+        help="prefix of the model to be quantized",
+        default="ft_003_3"
+    )
+    parser.add_argument(
+        "-nth",
+        "--nth_best_model",
+        type=int,
+        help="1 represent the latest model",
+        default=1
+    )
+    parser.add_argument(
+        "-tdr",
+        "--test_dataset_root",
+        type=str,
+        help="folder of the images (and ground truth txt files) for calibration and evaluation",
+        default="~/Pictures/dataset/ocr/SROIE2019_test"
+    )
+    parser.add_argument(
+        "-ext",
+        "--extension",
+        type=str,
+        help="extention of image",
+        default="jpg"
+    )
+    parser.add_argument(
+        "-ncal",
+        "--calibration_num",
+        type=int,
+        help="number of images used for calibration",
+        default=8
+    )
+    parser.add_argument(
+        "-neval",
+        "--evaluation_num",
+        type=int,
+        help="number of images used to compare the fp32 and int8 model",
+        default=32
+    )
+    parser.add_argument(
+        "-sz",
+        "--image_size",
+        type=int,
+        help="images are resized and padded to this size",
+        default=2048
+    )
+    parser.add_argument(
+        "-be",
+        "--backend",
+        type=str,
+        help="quantized engine",
+        default="x86"
+    )
+    parser.add_argument(
+        "-me",
+        "--max_error",
+        type=float,
+        help="heads with a larger relative output error fall back to float",
+        default=0.05
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="path to save the quantized model, which can be loaded by tb_test.py -qm",
+        default="~/Pictures/dataset/ocr/_text_detection/quantized.pth"
+    )
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    opt = parse_arguments()
+    root_path = os.path.expanduser(opt.test_dataset_root)
+    img_list = sorted(glob.glob(root_path + "/*.%s"%(opt.extension)))
+    if len(img_list) == 0:
+        raise FileNotFoundError("No image found in %s"%(root_path))
+    calib = [load_image(img_file, opt.image_size)[0] for img_file in img_list[:opt.calibration_num]]
+    samples = [load_image(img_file, opt.image_size) for img_file in
+               img_list[opt.calibration_num: opt.calibration_num + opt.evaluation_num]]
+
+    from researches.ocr.textbox.tb_test import load_net
+    net = load_net(opt.model_prefix, "cpu", nth=opt.nth_best_model)
+    qnet, errors = quantize_ssd(net, calib, backend=opt.backend, max_error=opt.max_error)
+    for name, error in errors.items():
+        print("%s: relative error %.4f"%(name, error))
+    output = os.path.expanduser(opt.output)
+    save_quantized(qnet, output)
+    print("Quantized model saved to %s"%(output))
+
+    detector = model.Detect(num_classes=2, bkg_label=0, top_k=1500, conf_thresh=0.05, nms_thresh=0.3)
+    print("%6s | %8s | %12s"%("model", "f1-score", "latency (s)"))
+    for name, _net in [("fp32", net), ("int8", qnet)]:
+        f1_score, latency = evaluate(_net, detector, samples)
+        print("%6s | %8.4f | %12.3f"%(name, f1_score, latency))
@@ -7,18 +7,20 @@ from imgaug import augmenters
 import omni_torch.utils as util
 import researches.ocr.textbox.tb_preset as preset
 import researches.ocr.textbox.tb_model as model
+import researches.ocr.textbox.tb_data as tb_data
 from researches.ocr.textbox.tb_utils import *
 from researches.ocr.textbox.tb_preprocess import *
 from researches.ocr.textbox.tb_augment import *
 from researches.ocr.textbox.tb_postprocess import combine_boxes
+from researches.ocr.textbox.tb_eval import DetectionEvaluator
+from researches.ocr.textbox.tb_tile import detect_tiled, combine_image
+from researches.ocr.textbox.tb_ensemble import EnsembleRunner
 from researches.ocr.textbox.tb_vis import visualize_bbox, print_box
 import omni_torch.visualize.basic as vb
 
 TMPJPG = os.path.expanduser("~/Pictures/tmp.jpg")
 cfg = model.cfg
 args = util.get_args(preset.PRESET)
-if not torch.cuda.is_available():
-    raise RuntimeError("Need cuda devices")
 dt = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M")
 # Image will be resize to this size
 square = 2048
@@ -36,6 +38,34 @@ def parse_arguments():
         help="1 represent the latest model",
         default=0
     )
+    parser.add_argument(
+        "-cpu",
+        "--use_cpu",
+        action="store_true",
+        help="run the test on CPU, it is used automatically when no cuda device is available",
+    )
+    parser.add_argument(
+        "-fuse",
+        "--fuse_for_inference",
+        action="store_true",
+        help="fold the BatchNorm layers into convolutions and drop unused layers before testing",
+    )
+    parser.add_argument(
+        "-qm",
+        "--quantized_model",
+        type=str,
+        help="path of a quantized model created by tb_quantize.py, "
+             "if set, it is used instead of -mpl and the test runs on CPU",
+        default=None
+    )
+    parser.add_argument(
+        "-pm",
+        "--pruned_model",
+        type=str,
+        help="path of a model with pruned anchors or head channels created by tb_anchor.py "
+             "or textbox.py -pr, if set, it is used instead of -mpl",
+        default=None
+    )
     parser.add_argument(
         "-tdr",
         "--test_dataset_root",
@@ -93,6 +123,69 @@ def parse_arguments():
         help="detector_nms_threshold",
         default=0.3
     )
+    parser.add_argument(
+        "-bkt",
+        "--bucket",
+        action="store_true",
+        help="pad the resized image to the smallest bucket instead of a square",
+    )
+    parser.add_argument(
+        "-bs",
+        "--test_batch_size",
+        type=int,
+        help="number of images tested together, images are grouped by aspect ratio",
+        default=1
+    )
+    parser.add_argument(
+        "-tile",
+        "--tile_size",
+        type=int,
+        help="if greater than 0, detect at native scale with overlapping tiles of this size "
+             "instead of resizing the image to a square",
+        default=0
+    )
+    parser.add_argument(
+        "-tov",
+        "--tile_overlap",
+        type=int,
+        help="overlap between adjacent tiles, should be larger than the highest text line",
+        default=256
+    )
+    parser.add_argument(
+        "-tbs",
+        "--tile_batch_size",
+        type=int,
+        help="number of tiles sent to the model at once",
+        default=4
+    )
+    parser.add_argument(
+        "-cas",
+        "--cascade",
+        action="store_true",
+        help="propose text regions with a low resolution pass, then only detect them at full resolution",
+    )
+    parser.add_argument(
+        "-cs",
+        "--coarse_size",
+        type=int,
+        help="longer side of the image in the coarse pass of cascade mode",
+        default=768
+    )
+    parser.add_argument(
+        "-cm",
+        "--cascade_margin",
+        type=int,
+        help="pixels added around each proposal of the coarse pass",
+        default=32
+    )
+    parser.add_argument(
+        "-par",
+        "--parallel_ensemble",
+        type=str,
+        choices=["thread", "process"],
+        help="run the models of -mpl concurrently with one worker thread or (CPU) process per model",
+        default=None
+    )
     args = parser.parse_args()
     return args
 
@@ -119,152 +212,243 @@ def augment_back(transform_det, height_ori, width_ori, v_crop, h_crop):
     return aug
 
 
+def test_buckets():
+    """(height, width) buckets used by -bkt, the longer side is always square"""
+    return [(square, square * k // 8) for k in range(3, 9)] + [(square * k // 8, square) for k in range(3, 8)]
+
+
+def prepare_image(opt, img_file):
+    """Read the image, rotate it back and resize its longer side to square"""
+    name = img_file[img_file.rfind("/") + 1 : -4]
+    img = cv2.imread(img_file)
+    height_ori, width_ori = img.shape[0], img.shape[1]
+
+    # detect rotation for returning the image back
+    img, transform_det = estimate_angle(img, args, None, None, None)
+    transform_det["rotation"] = 0
+    if transform_det["rotation"] != 0:
+        rot_aug = augmenters.Affine(rotate=transform_det["rotation"],
+                                     cval=args.aug_bg_color)
+    else:
+        rot_aug = None
+
+    # Perform Augmentation
+    if rot_aug:
+        rot_aug = augmenters.Sequential(
+            augmenters.Affine(rotate=transform_det["rotation"], cval=args.aug_bg_color))
+        image = rot_aug.augment_image(img)
+    else:
+        image = img
+    if opt.tile_size <= 0:
+        # Resize the longer side to a certain length
+        if height_ori >= width_ori:
+            resize_aug =augmenters.Sequential([
+                augmenters.Resize(size={"height": square, "width": "keep-aspect-ratio"})])
+        else:
+            resize_aug = augmenters.Sequential([
+                augmenters.Resize(size={"height": "keep-aspect-ratio", "width": square})])
+        resize_aug = resize_aug.to_deterministic()
+        image = resize_aug.augment_image(image)
+    return {"name": name, "img": img, "image": image, "transform_det": transform_det,
+            "height_ori": height_ori, "width_ori": width_ori,
+            "h_re": image.shape[0], "w_re": image.shape[1]}
+
+
+def save_result(opt, sample, text_boxes, result_dir, evaluator):
+    """Map the boxes back to the original image, write and evaluate them"""
+    name, img, image = sample["name"], sample["img"], sample["image"]
+    h_re, w_re = sample["h_re"], sample["w_re"]
+    h_final, w_final= image.shape[0], image.shape[1]
+    pred = [[float(coor) for coor in area] for area in text_boxes]
+    BBox = [imgaug.imgaug.BoundingBox(box[0] * w_final, box[1] * h_final, box[2] * w_final, box[3] * h_final)
+            for box in pred]
+    BBoxes = imgaug.imgaug.BoundingBoxesOnImage(BBox, shape=image.shape)
+    return_aug = augment_back(sample["transform_det"], sample["height_ori"], sample["width_ori"],
+                              (h_final - h_re) / 2, (w_final - w_re) / 2)
+    return_aug = return_aug.to_deterministic()
+    img_ori = return_aug.augment_image(image)
+    bbox = return_aug.augment_bounding_boxes([BBoxes])[0]
+    #print_box(blue_boxes=pred, idx=i, img=vb.plot_tensor(args, image_t, margin=0),
+              #save_dir=args.val_log)
+
+    f = open(os.path.join(result_dir, name + ".txt"), "w")
+
+    gt_box_file = os.path.join(opt.test_dataset_root, name + "." + opt.ground_truth_extension)
+    coords = tb_data.parse_file(os.path.expanduser(gt_box_file))
+    gt_coords = []
+    for coord in coords:
+        x1, x2 = min(coord[::2]), max(coord[::2])
+        y1, y2 = min(coord[1::2]), max(coord[1::2])
+        gt_coords.append([x1, y1, x2, y2])
+    pred_final = []
+    for box in bbox.bounding_boxes:
+        x1, y1, x2, y2 = int(round(box.x1)), int(round(box.y1)), int(round(box.x2)), int(round(box.y2))
+        pred_final.append([x1, y1, x2, y2])
+        #box_tensors.append(torch.tensor([x1, y1, x2, y2]))
+        # 4-point to 8-point: x1, y1, x2, y1, x2, y2, x1, y2
+        f.write("%d,%d,%d,%d,%d,%d,%d,%d\n"%(x1, y1, x2, y1, x2, y2, x1, y2))
+        cv2.rectangle(img, (x1, y1), (x2, y2), (255, 105, 65), 2)
+    evaluator.update([torch.Tensor(pred_final)], [torch.Tensor(gt_coords)],
+                     sizes=[(img.shape[0], img.shape[1])])
+    img_save_directory = os.path.join(args.path, args.code_name, "val+" + "-".join(opt.model_prefix_list))
+    if not os.path.exists(img_save_directory):
+        os.mkdir(img_save_directory)
+    cv2.imwrite(os.path.join(img_save_directory, name + ".jpg"), img)
+    f.close()
+
+
+def get_device(opt, idx):
+    if opt.use_cpu or not torch.cuda.is_available():
+        return torch.device("cpu")
+    return torch.device("cuda:%d"%(opt.device_id if len(opt.model_prefix_list) == 1 else idx))
+
+
+def load_net(prefix, device, nth=1):
+    """Create the SSD and load the weights saved with prefix, return it in eval mode"""
+    # Weights are allocated only once, by the checkpoint
+    net = model.create_empty_ssd(cfg, connect_loc_to_conf=True, fix_size=False,
+                                 incep_conf=True, incep_loc=True)
+    net_dict = net.state_dict()
+    weight_dict = util.load_latest_model(args, net, prefix=prefix,
+                                         return_state_dict=True, nth=nth)
+    loading_fail_signal = False
+    for i, key in enumerate(net_dict.keys()):
+        if "module." + key not in weight_dict:
+            net_dict[key] = torch.zeros_like(net_dict[key], device="cpu")
+    for key in weight_dict.keys():
+        if key[7:] in net_dict:
+            if net_dict[key[7:]].shape == weight_dict[key].shape:
+                net_dict[key[7:]] = weight_dict[key]
+            else:
+                print("Key: %s from disk has shape %s copy to the model with shape %s"%
+                      (key[7:], str(weight_dict[key].shape), str(net_dict[key[7:]].shape)))
+                loading_fail_signal = True
+        else:
+            print("Key: %s does not exist in net_dict"%(key[7:]))
+    if loading_fail_signal:
+        raise RuntimeError('Shape Error happens, remove "%s" from your -mpl settings.'%(prefix))
+
+    net.load_state_dict(net_dict, assign=True)
+    net = model.assert_materialized(net).to(device)
+    net.eval()
+    return net
+
+
 def test_rotation(opt):
     result_dir = os.path.join(args.path, args.code_name, "result+" + "-".join(opt.model_prefix_list))
     if not os.path.exists(result_dir):
         os.makedirs(result_dir)
     # Load
-    assert len(opt.model_prefix_list) <= torch.cuda.device_count(), \
-        "number of models should not exceed the device numbers"
+    if opt.quantized_model or opt.parallel_ensemble == "process":
+        # Quantized models and worker processes only run on CPU
+        opt.use_cpu = True
+    if not opt.use_cpu and torch.cuda.is_available():
+        assert len(opt.model_prefix_list) <= torch.cuda.device_count(), \
+            "number of models should not exceed the device numbers"
+    # tb_quantize, tb_anchor and tb_cascade parse their own arguments when imported,
+    # so they are only imported by the mode which uses them
     nets = []
-    for _, prefix in enumerate(opt.model_prefix_list):
-        net = model.SSD(cfg, connect_loc_to_conf=True, fix_size=False,
-                        incep_conf=True, incep_loc=True)
-        device_id = opt.device_id if len(opt.model_prefix_list) == 1 else _
-        net = net.to("cuda:%d"%(device_id))
-        net_dict = net.state_dict()
-        weight_dict = util.load_latest_model(args, net, prefix=prefix,
-                                             return_state_dict=True, nth=opt.nth_best_model)
-        loading_fail_signal = False
-        for i, key in enumerate(net_dict.keys()):
-            if "module." + key not in weight_dict:
-                net_dict[key] = torch.zeros(net_dict[key].shape)
-        for key in weight_dict.keys():
-            if key[7:] in net_dict:
-                if net_dict[key[7:]].shape == weight_dict[key].shape:
-                    net_dict[key[7:]] = weight_dict[key]
-                else:
-                    print("Key: %s from disk has shape %s copy to the model with shape %s"%
-                          (key[7:], str(weight_dict[key].shape), str(net_dict[key[7:]].shape)))
-                    loading_fail_signal = True
-            else:
-                print("Key: %s does not exist in net_dict"%(key[7:]))
-        if loading_fail_signal:
-            raise RuntimeError('Shape Error happens, remove "%s" from your -mpl settings.'%(prefix))
-
-        net.load_state_dict(net_dict)
-        net.eval()
+    if opt.quantized_model:
+        from researches.ocr.textbox.tb_quantize import load_quantized
+        nets.append(load_quantized(opt.quantized_model))
+        print("Quantized model %s loaded"%(opt.quantized_model))
+    elif opt.pruned_model:
+        from researches.ocr.textbox.tb_anchor import load_pruned
+        nets.append(load_pruned(opt.pruned_model, get_device(opt, 0)))
+        print("Pruned model %s loaded"%(opt.pruned_model))
+    for _, prefix in enumerate([] if opt.quantized_model or opt.pruned_model else opt.model_prefix_list):
+        net = load_net(prefix, get_device(opt, _), nth=opt.nth_best_model)
+        if opt.fuse_for_inference:
+            sample = torch.randn(1, 3, 512, 512, device=get_device(opt, _))
+            net.fuse_for_inference(sample=sample)
         nets.append(net)
         print("Above model loaded with out a problem")
     detector = model.Detect(num_classes=2, bkg_label=0,
                             top_k=opt.detector_top_k,
                             conf_thresh=opt.detector_conf_threshold,
                             nms_thresh=opt.detector_nms_threshold)
-    
     # Enumerate test folder
     root_path = os.path.expanduser(opt.test_dataset_root)
     if not os.path.exists(root_path):
         raise FileNotFoundError("%s does not exists, please check your -tdr/--test_dataset_root settings"%(root_path))
-    img_list = glob.glob(root_path + "/*.%s"%(opt.extension))
-    precisions, recalls = [], []
-    for i, img_file in enumerate(sorted(img_list)):
-        start = time.time()
-        name = img_file[img_file.rfind("/") + 1 : -4]
-        img = cv2.imread(img_file)
-        height_ori, width_ori = img.shape[0], img.shape[1]
-
-        # detect rotation for returning the image back
-        img, transform_det = estimate_angle(img, args, None, None, None)
-        transform_det["rotation"] = 0
-        if transform_det["rotation"] != 0:
-            rot_aug = augmenters.Affine(rotate=transform_det["rotation"],
-                                         cval=args.aug_bg_color)
-        else:
-            rot_aug = None
-
-        # Perform Augmentation
-        if rot_aug:
-            rot_aug = augmenters.Sequential(
-                augmenters.Affine(rotate=transform_det["rotation"], cval=args.aug_bg_color))
-            image = rot_aug.augment_image(img)
-        else:
-            image = img
-        # Resize the longer side to a certain length
-        if height_ori >= width_ori:
-            resize_aug =augmenters.Sequential([
-                augmenters.Resize(size={"height": square, "width": "keep-aspect-ratio"})])
-        else:
-            resize_aug = augmenters.Sequential([
-                augmenters.Resize(size={"height": "keep-aspect-ratio", "width": square})])
-        resize_aug = resize_aug.to_deterministic()
-        image = resize_aug.augment_image(image)
-        h_re, w_re = image.shape[0], image.shape[1]
-        # Pad the image into a square image
-        pad_aug = augmenters.Sequential(
-            augmenters.PadToFixedSize(width=square, height=square, pad_cval=255, position="center")
-        )
-        pad_aug = pad_aug.to_deterministic()
-        image = pad_aug.augment_image(image)
-        h_final, w_final= image.shape[0], image.shape[1]
-
-        # Prepare image tensor and test
-        image_t = torch.Tensor(util.normalize_image(args, image)).unsqueeze(0)
-        image_t = image_t.permute(0, 3, 1, 2)
-        #visualize_bbox(args, cfg, image, [torch.Tensor(rot_coord).cuda()], net.prior, height_final/width_final)
+    img_list = sorted(glob.glob(root_path + "/*.%s"%(opt.extension)))
+    evaluator = DetectionEvaluator()
+    if opt.test_batch_size > 1:
+        # Receipts of similar aspect ratio are tested together, so they need little padding
+        batches = list(tb_data.AspectRatioBatchSampler(tb_data.image_aspect_ratios(img_list),
+                                                       opt.test_batch_size, shuffle=False))
+    else:
+        batches = [[i] for i in range(len(img_list))]
+    if opt.cascade:
+        from researches.ocr.textbox.tb_cascade import detect_cascade
+    runner = None
+    if opt.parallel_ensemble and len(nets) > 1 and opt.tile_size <= 0 and not opt.cascade:
+        runner = EnsembleRunner(nets, detector, mode=opt.parallel_ensemble)
+    # The runner is closed even if the loop fails, which stops the worker processes
+    # and restores the thread count
+    try:
+        i = 0
+        for batch in batches:
+            start = time.time()
+            samples = [prepare_image(opt, img_list[idx]) for idx in batch]
+            if opt.tile_size > 0 or opt.cascade:
+                # Tiled mode works at native scale, without resizing and padding
+                # Cascade mode crops the regions from the unpadded image
+                pad_size = None
+            elif opt.bucket:
+                pad_size = tb_data.bucket_size(max([s["h_re"] for s in samples]),
+                                               max([s["w_re"] for s in samples]), test_buckets())
+            else:
+                pad_size = (square, square)
+            for sample in samples:
+                if pad_size is not None:
+                    # Pad the image into a square image (or the bucket)
+                    pad_aug = augmenters.Sequential(
+                        augmenters.PadToFixedSize(width=pad_size[1], height=pad_size[0], pad_cval=255, position="center")
+                    )
+                    pad_aug = pad_aug.to_deterministic()
+                    sample["image"] = pad_aug.augment_image(sample["image"])
 
-        text_boxes = []
-        for _, net in enumerate(nets):
-            device_id = opt.device_id if len(nets) == 1 else _
-            image_t = image_t.to("cuda:%d"%(device_id))
-            out = net(image_t, is_train=False)
-            loc_data, conf_data, prior_data = out
-            prior_data = prior_data.to("cuda:%d"%(device_id))
-            det_result = detector(loc_data, conf_data, prior_data)
-            # Extract the predicted bboxes
-            idx = det_result.data[0, 1, :, 0] >= 0.1
-            text_boxes.append(det_result.data[0, 1, idx, 1:])
-        text_boxes = torch.cat(text_boxes, dim=0)
-        text_boxes = combine_boxes(text_boxes, img=image_t)
-        pred = [[float(coor) for coor in area] for area in text_boxes]
-        BBox = [imgaug.imgaug.BoundingBox(box[0] * w_final, box[1] * h_final, box[2] * w_final, box[3] * h_final)
-                for box in pred]
-        BBoxes = imgaug.imgaug.BoundingBoxesOnImage(BBox, shape=image.shape)
-        return_aug = augment_back(transform_det, height_ori, width_ori, (h_final - h_re) / 2, (w_final - w_re) / 2)
-        return_aug = return_aug.to_deterministic()
-        img_ori = return_aug.augment_image(image)
-        bbox = return_aug.augment_bounding_boxes([BBoxes])[0]
-        #print_box(blue_boxes=pred, idx=i, img=vb.plot_tensor(args, image_t, margin=0),
-                  #save_dir=args.val_log)
-        
-        f = open(os.path.join(result_dir, name + ".txt"), "w")
+            # Prepare image tensor and test
+            # Unpadded images (tiled and cascade mode) may have different shapes
+            # Tiled mode reads the tiles from the native image, images_t is only used by combine_boxes
+            images_t = [combine_image(s["image"], square) if opt.tile_size > 0 else s["image"] for s in samples]
+            images_t = [torch.Tensor(util.normalize_image(args, image)).unsqueeze(0).permute(0, 3, 1, 2)
+                        for image in images_t]
+            #visualize_bbox(args, cfg, image, [torch.Tensor(rot_coord).cuda()], net.prior, height_final/width_final)
 
-        import researches.ocr.textbox.tb_data as tb_data
-        gt_box_file = os.path.join(opt.test_dataset_root, name + "." + opt.ground_truth_extension)
-        coords = tb_data.parse_file(os.path.expanduser(gt_box_file))
-        gt_coords = []
-        for coord in coords:
-            x1, x2 = min(coord[::2]), max(coord[::2])
-            y1, y2 = min(coord[1::2]), max(coord[1::2])
-            gt_coords.append([x1, y1, x2, y2])
-        pred_final = []
-        for box in bbox.bounding_boxes:
-            x1, y1, x2, y2 = int(round(box.x1)), int(round(box.y1)), int(round(box.x2)), int(round(box.y2))
-            pred_final.append([x1, y1, x2, y2])
-            #box_tensors.append(torch.tensor([x1, y1, x2, y2]))
-            # 4-point to 8-point: x1, y1, x2, y1, x2, y2, x1, y2
-            f.write("%d,%d,%d,%d,%d,%d,%d,%d\n"%(x1, y1, x2, y1, x2, y2, x1, y2))
-            cv2.rectangle(img, (x1, y1), (x2, y2), (255, 105, 65), 2)
-        accu, precision, recall = measure(torch.Tensor(pred_final).cuda(), torch.Tensor(gt_coords).cuda(),
-                                          width=img.shape[1], height=img.shape[0])
-        precisions.append(precision)
-        recalls.append(recall)
-        img_save_directory = os.path.join(args.path, args.code_name, "val+" + "-".join(opt.model_prefix_list))
-        if not os.path.exists(img_save_directory):
-            os.mkdir(img_save_directory)
-        cv2.imwrite(os.path.join(img_save_directory, name + ".jpg"), img)
-        f.close()
-        print("%d th image cost %.2f seconds"%(i, time.time() - start))
-    print("Precision: %.2f, Recall: %.2f"%(avg(precisions), avg(recalls)))
+            text_boxes = [[] for _ in samples]
+            if runner is not None:
+                text_boxes = runner(torch.cat(images_t, dim=0))
+            for _, net in enumerate([] if runner is not None else nets):
+                if opt.tile_size > 0:
+                    for j, sample in enumerate(samples):
+                        text_boxes[j].append(detect_tiled(args, net, detector, sample["image"], tile_size=opt.tile_size,
+                                                          overlap=opt.tile_overlap, batch_size=opt.tile_batch_size,
+                                                          nms_thres=opt.detector_nms_threshold)[0])
+                    continue
+                if opt.cascade:
+                    for j, sample in enumerate(samples):
+                        text_boxes[j].append(detect_cascade(args, net, detector, sample["image"],
+                                                            coarse_size=opt.coarse_size, margin=opt.cascade_margin,
+                                                            nms_thres=opt.detector_nms_threshold)[0])
+                    continue
+                image_t = torch.cat(images_t, dim=0).to(get_device(opt, _))
+                out = net(image_t, is_train=False)
+                loc_data, conf_data, prior_data = out
+                prior_data = prior_data.to(get_device(opt, _))
+                for j, det in enumerate(detector(loc_data, conf_data, prior_data)):
+                    # Extract the predicted bboxes
+                    text_boxes[j].append(det[(det[:, 0] == 1) & (det[:, 1] >= 0.1), 2:])
+            for j, sample in enumerate(samples):
+                boxes = combine_boxes(torch.cat(text_boxes[j], dim=0), img=images_t[j])
+                save_result(opt, sample, boxes, result_dir, evaluator)
+                print("%d th image cost %.2f seconds"%(i, (time.time() - start) / len(samples)))
+                i += 1
+    finally:
+        if runner is not None:
+            runner.close()
+    evaluator.print_summary()
     os.chdir(os.path.join(args.path, args.code_name, "result+"+ "-".join(opt.model_prefix_list)))
     os.system("zip result_%s.zip ~/Pictures/dataset/ocr/_text_detection/result+%s/*.txt"
               %("val+" + "-".join(opt.model_prefix_list), "-".join(opt.model_prefix_list)))
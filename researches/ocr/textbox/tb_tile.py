@@ -0,0 +1,113 @@
+import os, sys
+sys.path.append(os.path.expanduser("~/Documents/sroie2019"))
+import cv2, torch
+import numpy as np
+import omni_torch.utils as util
+from researches.ocr.textbox.tb_utils import solve_nms
+
+
+def tile_starts(length, tile_size, overlap):
+    """Start positions of the tiles covering [0, length), the last tile ends at length"""
+    stride = tile_size - overlap
+    assert stride > 0, "tile overlap should be smaller than the tile size"
+    starts = list(range(0, max(length - tile_size, 0) + 1, stride))
+    if starts[-1] + tile_size < length:
+        starts.append(length - tile_size)
+    return starts
+
+
+def iterate_tiles(image, tile_size, overlap, pad_value=255):
+    """
+    Cut the image (numpy array of Shape: [height, width, channel]) into overlapping tiles at
+    native scale, a tile exceeding the image is padded with pad_value.
+    Yield:
+        (y0, x0, tile) where (y0, x0) is the top left corner of the tile in the image
+    """
+    height, width = image.shape[0], image.shape[1]
+    for y0 in tile_starts(height, tile_size, overlap):
+        for x0 in tile_starts(width, tile_size, overlap):
+            tile = image[y0: y0 + tile_size, x0: x0 + tile_size]
+            if tile.shape[0] < tile_size or tile.shape[1] < tile_size:
+                tile = cv2.copyMakeBorder(tile, 0, tile_size - tile.shape[0], 0, tile_size - tile.shape[1],
+                                          cv2.BORDER_CONSTANT, value=[pad_value] * 3)
+            yield y0, x0, tile
+
+
+def core_region(start, tile_size, overlap, length):
+    """The part of a tile whose boxes are kept, each overlap is split evenly by both tiles"""
+    lower = start + overlap / 2 if start > 0 else 0
+    upper = start + tile_size - overlap / 2 if start + tile_size < length else length
+    return lower, upper
+
+
+def combine_image(image, max_side=2048):
+    """
+    The image combine_boxes reads the average color of the (normalized) boxes from. A tiled
+    image stays at native scale, so a copy downscaled to max_side is enough, INTER_AREA keeps
+    the average colors and the thresholds of combine_boxes are relative to the image size.
+    """
+    height, width = image.shape[0], image.shape[1]
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (max(round(width * scale), 1), max(round(height * scale), 1)),
+                      interpolation=cv2.INTER_AREA)
+
+
+def detect_tiled(args, net, detector, image, tile_size=1024, overlap=256, batch_size=4,
+                 score_thres=0.1, nms_thres=0.3):
+    """
+    Detect the text boxes of a (tall) image tile by tile, the memory cost is bounded by
+    tile_size and batch_size no matter how long the image is.
+    A box is kept by the tile where its center lies in the core region, the duplicates
+    left in the overlaps are removed by a global NMS.
+    Args:
+        image: (numpy array) image before normalization, Shape: [height, width, channel].
+        net: SSD model, the tiles are sent to the device of its parameters.
+        detector: Detect layer.
+    Return:
+        text boxes normalized to [0, 1] w.r.t. the whole image (tensor), Shape: [num_boxes, 4]
+        and their scores (tensor), Shape: [num_boxes]
+    """
+    height, width = image.shape[0], image.shape[1]
+    device = next(net.parameters()).device
+    boxes, scores = [], []
+
+    def run(batch):
+        corners = [(y0, x0) for y0, x0, _ in batch]
+        tiles = np.stack([util.normalize_image(args, tile) for _, _, tile in batch])
+        tiles = torch.Tensor(tiles).permute(0, 3, 1, 2).to(device)
+        with torch.no_grad():
+            loc_data, conf_data, prior_data = net(tiles, is_train=False)
+            detections = detector(loc_data, conf_data, prior_data)
+        for (y0, x0), det in zip(corners, detections):
+            det = det[(det[:, 0] == 1) & (det[:, 1] >= score_thres)]
+            # To pixel coordinate of the whole image
+            box = det[:, 2:] * tile_size + det.new_tensor([x0, y0, x0, y0])
+            center_x, center_y = (box[:, 0] + box[:, 2]) / 2, (box[:, 1] + box[:, 3]) / 2
+            x_lower, x_upper = core_region(x0, tile_size, overlap, width)
+            y_lower, y_upper = core_region(y0, tile_size, overlap, height)
+            inside = (center_x >= x_lower) & (center_x < x_upper) & (center_y >= y_lower) & (center_y < y_upper)
+            boxes.append(box[inside].cpu())
+            scores.append(det[inside, 1].cpu())
+
+    batch = []
+    for tile in iterate_tiles(image, tile_size, overlap):
+        batch.append(tile)
+        if len(batch) == batch_size:
+            run(batch)
+            batch = []
+    if len(batch) > 0:
+        run(batch)
+
+    boxes, scores = torch.cat(boxes, dim=0), torch.cat(scores, dim=0)
+    if boxes.size(0) == 0:
+        return boxes, scores
+    boxes = boxes / torch.Tensor([width, height, width, height])
+    boxes[:, 0::2] = boxes[:, 0::2].clamp(min=0, max=1)
+    boxes[:, 1::2] = boxes[:, 1::2].clamp(min=0, max=1)
+    # Boxes crossing the border of core regions may be detected by both tiles
+    scores, order = scores.sort(descending=True)
+    boxes = boxes[order]
+    keep = solve_nms(boxes.unsqueeze(0), torch.ones_like(scores, dtype=torch.bool).unsqueeze(0), nms_thres)[0]
+    return boxes[keep], scores[keep]
@@ -2,12 +2,48 @@
 # This file was copied from
 # https://github.com/amdegroot/ssd.pytorch
 #
-import random
+import os, random
 import torch
 import torch.nn.functional as F
+import researches.ocr.textbox.tb_kernels as tb_kernels
+try:
+    # torchvision < 0.3 has no ops.nms, greedy_nms falls back to a loop in that case
+    from torchvision.ops import nms as torchvision_nms
+except ImportError:
+    torchvision_nms = None
+
+# "eager" or "script" (the TorchScript kernels in tb_kernels), see set_kernel_backend
+_kernel_backend = "eager"
+
+
+def set_kernel_backend(backend):
+    """
+    Select the implementation of the box kernels (calibrate_prior, intersect, jaccard,
+    box_jaccard, super_wide_jaccard, encode, decode and cluster_nms) at runtime.
+    The TorchScript kernels are compiled on the first switch to "script", and it falls
+    back to eager when they failed to compile. tb_kernels.check_parity (python tb_kernels.py)
+    verifies them against the eager kernels.
+    Return:
+        the backend actually in use
+    """
+    global _kernel_backend
+    assert backend in ["eager", "script"], "unknown kernel backend: %s"%(backend)
+    if backend == "script" and not tb_kernels.script_kernels():
+        backend = "eager"
+    _kernel_backend = backend
+    return _kernel_backend
+
+
+def get_kernel_backend():
+    return _kernel_backend
+
+
+set_kernel_backend(os.environ.get("TB_KERNEL_BACKEND", "eager"))
 
 
 def calibrate_prior(x):
+    if _kernel_backend == "script":
+        return tb_kernels.calibrate_prior(x)
     mul = 0.7
     trans = 1
     t = x + 2 / x
@@ -21,39 +57,36 @@ def calculate_anchor_number(cfg, i):
 def point_form(boxes, img_ratio):
     """ Convert prior_boxes to (xmin, ymin, xmax, ymax)
     """
-    # boxes[:, :2] represent the center_x and center_y
-    ratio_coefficiency = torch.Tensor([[1.0, 1.0, img_ratio, 1.0]]).repeat(boxes.size(0), 1)
-    if boxes.is_cuda:
-        ratio_coefficiency = ratio_coefficiency.cuda()
+    # boxes[..., :2] represent the center_x and center_y
+    ratio_coefficiency = boxes.new_tensor([1.0, 1.0, img_ratio, 1.0])
     boxes = boxes / ratio_coefficiency
-    return torch.cat((boxes[:, :2] - boxes[:, 2:]/2, boxes[:, :2] + boxes[:, 2:]/2), 1)
+    return torch.cat((boxes[..., :2] - boxes[..., 2:]/2, boxes[..., :2] + boxes[..., 2:]/2), -1)
 
 
 def center_size(prior, img_ratio):
     """ Convert prior_boxes to (cx, cy, w, h)
     """
-    ratio_coefficiency = torch.Tensor([[1.0, 1.0, img_ratio, 1.0]]).repeat(prior.size(0), 1)
-    if prior.is_cuda:
-        ratio_coefficiency = ratio_coefficiency.cuda()
-    boxes = torch.cat([(prior[:, 2:] + prior[:, :2]) / 2, prior[:, 2:] - prior[:, :2]], 1)
+    ratio_coefficiency = prior.new_tensor([1.0, 1.0, img_ratio, 1.0])
+    boxes = torch.cat([(prior[..., 2:] + prior[..., :2]) / 2, prior[..., 2:] - prior[..., :2]], -1)
     return boxes * ratio_coefficiency
 
 
 def box_jaccard(prior_a, prior_b):
+    if _kernel_backend == "script":
+        return tb_kernels.box_jaccard(prior_a, prior_b)
+    # Broadcast prior_b over the rows and prior_a over the columns, Shape: [num_b, num_a]
+    prior_a = prior_a.unsqueeze(0)
+    prior_b = prior_b.unsqueeze(1)
     # step 1: calculate the distance (L-2) between the center coordinate
-    center_a = prior_a[:, :2].unsqueeze(0).repeat(prior_b.size(0), 1, 1)
-    center_b = prior_b[:, :2].unsqueeze(1).repeat(1, prior_a.size(0), 1)
-    coord_a = prior_a[:, 2:].unsqueeze(0).repeat(prior_b.size(0), 1, 1)
-    coord_b = prior_b[:, 2:].unsqueeze(1).repeat(1, prior_a.size(0), 1)
-    center_dis = torch.sqrt(torch.sum((center_a - center_b)**2, dim=2) + 1e-5)
+    center_dis = torch.sqrt(torch.sum((prior_a[..., :2] - prior_b[..., :2])**2, dim=2) + 1e-5)
     # step 2: calculate the shape distance between the shape coordinate
     #    1. when distance between center is close, make the score higher, the more closer the much higher
     center_dis = 1 / center_dis
     #    2. compare the aspect ratio, the higher the better, aspect_ratio = width / height
-    aspt = coord_a[:, :, 0] / coord_a[:, :, 1] / coord_b[:, :, 0] * coord_b[:, :, 1]
+    aspt = prior_a[..., 2] / prior_a[..., 3] / prior_b[..., 2] * prior_b[..., 3]
     aspt = 1 / (aspt + 1 / aspt)
     #    3. compare the size, the higher the better
-    size = coord_a[:, :, 0] * coord_a[:, :, 1] / coord_b[:, :, 0] / coord_b[:, :, 1]
+    size = prior_a[..., 2] * prior_a[..., 3] / prior_b[..., 2] / prior_b[..., 3]
     size = 1 / (size + 1 / size)
     box_jcd = center_dis / aspt / size
     return box_jcd
@@ -63,20 +96,18 @@ def get_box_size(box):
     """
     calculate the bound box size
     """
-    return (box[:, 2]-box[:, 0]) * (box[:, 3]-box[:, 1])
+    return (box[..., 2]-box[..., 0]) * (box[..., 3]-box[..., 1])
 
 
 def intersect(box_a, box_b):
     """ Calculate the intersection area of box_a & box_b
     """
-    A = box_a.size(0)
-    B = box_b.size(0)
-    max_xy = torch.min(box_a[:, 2:].unsqueeze(1).expand(A, B, 2),
-                       box_b[:, 2:].unsqueeze(0).expand(A, B, 2))
-    min_xy = torch.max(box_a[:, :2].unsqueeze(1).expand(A, B, 2),
-                       box_b[:, :2].unsqueeze(0).expand(A, B, 2))
+    if _kernel_backend == "script":
+        return tb_kernels.intersect(box_a, box_b)
+    max_xy = torch.min(box_a[..., :, None, 2:], box_b[..., None, :, 2:])
+    min_xy = torch.max(box_a[..., :, None, :2], box_b[..., None, :, :2])
     inter = torch.clamp((max_xy - min_xy), min=0)
-    return inter[:, :, 0] * inter[:, :, 1]
+    return inter[..., 0] * inter[..., 1]
     
 
 def jaccard(box_a, box_b):
@@ -88,19 +119,147 @@ def jaccard(box_a, box_b):
     Args:
         box_a: (tensor) Ground truth bounding boxes, Shape: [num_objects,4]
         box_b: (tensor) Prior boxes from priorbox layers, Shape: [num_priors,4]
+        Both of them can carry leading batch dimensions, e.g. [batch,num_objects,4].
     Return:
         jaccard overlap: (tensor) Shape: [box_a.size(0), box_b.size(0)]
     """
+    if _kernel_backend == "script":
+        return tb_kernels.jaccard(box_a, box_b)
     inter = intersect(box_a, box_b)
-    area_a = get_box_size(box_a).unsqueeze(1).expand_as(inter)  # [A,B]
-    area_b = get_box_size(box_b).unsqueeze(0).expand_as(inter)  # [A,B]
+    area_a = get_box_size(box_a).unsqueeze(-1).expand_as(inter)  # [A,B]
+    area_b = get_box_size(box_b).unsqueeze(-2).expand_as(inter)  # [A,B]
     jac = inter / (area_a + area_b - inter)
     return jac
 
 
+def grid_cells(boxes, grid_size, margin=0.0):
+    """
+    The range of grid cells covered by each box (in point form) when [0, 1] x [0, 1]
+    is divided into grid_size x grid_size cells.
+    Return:
+        x_start, y_start, x_end, y_end (inclusive) of each box, Shape: [num_boxes, 4]
+    """
+    cells = torch.cat([boxes[..., :2] - margin, boxes[..., 2:] + margin], -1)
+    cells = (cells.clamp(min=0, max=1) * grid_size).floor().long()
+    return cells.clamp_(max=grid_size - 1)
+
+
+def expand_cells(cells, grid_size):
+    """
+    Enumerate the index of all the cells inside each range of cells
+    Return:
+        owner: (tensor) index of the range each enumerated cell belongs to
+        cell_idx: (tensor) row * grid_size + column of each enumerated cell
+    """
+    width = cells[:, 2] - cells[:, 0] + 1
+    height = cells[:, 3] - cells[:, 1] + 1
+    count = width * height
+    owner = torch.arange(cells.size(0), device=cells.device).repeat_interleave(count)
+    # offset of each enumerated cell inside its own range
+    start = torch.cumsum(count, 0) - count
+    offset = torch.arange(owner.size(0), device=cells.device) - start[owner]
+    col = cells[owner, 0] + offset % width[owner]
+    row = cells[owner, 1] + offset // width[owner]
+    return owner, row * grid_size + col
+
+
+class Priors(object):
+    """Prior boxes together with every quantity derived from them.
+    The matcher, the loss and Detect only depend on the priors and the aspect ratio of
+    the input image, so these tensors are built once per prior set and stay on the
+    device of the priors instead of being recomputed in every training step.
+    Args:
+        priors: (tensor) Prior boxes in center-offset form, Shape: [num_priors,4].
+        img_ratio: (float) width / height of the input image.
+        grid_size: (int) If not None, build the spatial index used by sparse matching.
+    """
+    def __init__(self, priors, img_ratio=1.0, grid_size=None):
+        self.img_ratio = img_ratio
+        # (cx, cy, w, h), used by encode and decode
+        self.center = priors
+        # (xmin, ymin, xmax, ymax) and its clipped version, used by the overlaps
+        self.point = point_form(priors, img_ratio)
+        self.point_clip = self.point.clamp(max=1, min=0)
+        self.area = get_box_size(self.point)
+        self.area_clip = get_box_size(self.point_clip)
+        # Calibration of the prior boxes by its aspect ratio
+        self.calibration = calibrate_prior(priors[:, 2] / priors[:, 3])
+        # The ratio and calibration used by super_wide_jaccard
+        self.point_ratio = self.point[:, 2] / self.point[:, 3]
+        self.point_calibration = calibrate_prior(self.point_ratio)
+        # Spatial index: (grid_size, cell_ptr, cell_priors), see build_grid
+        self.grid = None
+        if grid_size:
+            self.build_grid(grid_size)
+
+    def __len__(self):
+        return self.center.size(0)
+
+    def __getitem__(self, item):
+        """Slice every derived tensor at once, e.g. priors[start: end]
+        The spatial index refers to the full prior set, so it is not kept."""
+        sliced = Priors.__new__(Priors)
+        sliced.img_ratio = self.img_ratio
+        sliced.grid = None
+        for key, value in self.__dict__.items():
+            if torch.is_tensor(value):
+                setattr(sliced, key, value[item])
+        return sliced
+
+    def size(self, dim=None):
+        return self.center.size() if dim is None else self.center.size(dim)
+
+    @property
+    def device(self):
+        return self.center.device
+
+    def to(self, device):
+        moved = Priors.__new__(Priors)
+        moved.img_ratio = self.img_ratio
+        moved.grid = None
+        if self.grid is not None:
+            moved.grid = (self.grid[0], self.grid[1].to(device), self.grid[2].to(device))
+        for key, value in self.__dict__.items():
+            if torch.is_tensor(value):
+                setattr(moved, key, value.to(device))
+        return moved
+
+    def build_grid(self, grid_size):
+        """
+        Bucket the prior boxes into a grid_size x grid_size grid over the image.
+        A prior is registered in every cell its (unclipped) box covers, so every prior
+        that overlaps a box can be found from the cells covered by that box.
+        The index is stored in CSR form: priors in cell c are cell_priors[cell_ptr[c]: cell_ptr[c+1]]
+        """
+        if self.grid is not None and self.grid[0] == grid_size:
+            return
+        owner, cell_idx = expand_cells(grid_cells(self.point, grid_size), grid_size)
+        cell_idx, order = cell_idx.sort()
+        count = torch.bincount(cell_idx, minlength=grid_size * grid_size)
+        cell_ptr = torch.cat([count.new_zeros(1), torch.cumsum(count, 0)])
+        self.grid = (grid_size, cell_ptr, owner[order])
+
+    def query_grid(self, boxes):
+        """
+        Return the sorted index of the priors registered in the cells covered by boxes
+        Args:
+            boxes: (tensor) boxes in point form, Shape: [num_boxes, 4].
+        """
+        grid_size, cell_ptr, cell_priors = self.grid
+        # A small margin so that rounding in the overlap functions cannot escape the index
+        _, cells = expand_cells(grid_cells(boxes, grid_size, margin=1e-5), grid_size)
+        cells = torch.unique(cells)
+        count = cell_ptr[cells + 1] - cell_ptr[cells]
+        owner = torch.arange(cells.size(0), device=cells.device).repeat_interleave(count)
+        start = torch.cumsum(count, 0) - count
+        offset = torch.arange(owner.size(0), device=cells.device) - start[owner]
+        return torch.unique(cell_priors[cell_ptr[cells][owner] + offset])
+
+
 def super_wide_jaccard(targets, priors, img_ratio):
     """
     match a wide textbox with those small boxes inside the large boxes
+    priors can either be a tensor in center-offset form or a Priors object
     """
     def mutate_quad(x):
         y = -0.5 * (x - 1.5) * (x - 1.5) + 2
@@ -109,14 +268,18 @@ def super_wide_jaccard(targets, priors, img_ratio):
         x = x / 3 - 3
         y = 0.6 * x / (1 + torch.abs(x)) + 0.5
         return y
+    if not isinstance(priors, Priors):
+        priors = Priors(priors, img_ratio)
+    if _kernel_backend == "script":
+        return tb_kernels.super_wide_overlaps(targets, priors.point, priors.area, priors.point_ratio,
+                                              priors.point_calibration, float(img_ratio))
     targets = center_size(targets, img_ratio)
     #targets[targets_ratio <= ratio_thres] = 0
     targets = point_form(targets, img_ratio)
-    priors = point_form(priors, img_ratio)
-    inter = intersect(targets, priors)
-    prior_size = get_box_size(priors).unsqueeze(0).expand_as(inter)
-    targets_ratio = (targets[:, 2] / targets[:, 3]).unsqueeze(1).expand_as(inter)
-    prior_ratio = (priors[:, 2] / priors[:, 3]).unsqueeze(0).expand_as(inter)
+    inter = intersect(targets, priors.point)
+    prior_size = priors.area.unsqueeze(-2).expand_as(inter)
+    targets_ratio = (targets[..., 2] / targets[..., 3]).unsqueeze(-1).expand_as(inter)
+    prior_ratio = priors.point_ratio.unsqueeze(-2).expand_as(inter)
 
     # suppress the prior boxes both too small or too big than the target boxes
     ratio = mutate_quad(targets_ratio / prior_ratio)
@@ -125,62 +288,184 @@ def super_wide_jaccard(targets, priors, img_ratio):
     targets_penelizer = mutate_sigmoid(targets_ratio)
     
     # Calculate the overlaps for super wide boxes
-    super_wide_jac = inter / prior_size * calibrate_prior(prior_ratio)
+    super_wide_jac = inter / prior_size * priors.point_calibration.unsqueeze(-2).expand_as(inter)
     #super_wide_overlaps = super_wide_jac * targets_penelizer
     super_wide_overlaps = super_wide_jac * ratio * targets_penelizer
     return super_wide_overlaps
     
 
-def match(cfg, threshold, truths, priors, variances, labels, loc_t, conf_t, idx, img_ratio,
-          visualize=False, jaccard=jaccard):
+def is_padded(targets):
+    """Whether targets are (padded targets, number of boxes) of tb_data.PinnedCollector"""
+    return len(targets) == 2 and torch.is_tensor(targets[0]) and targets[0].dim() == 3
+
+
+def unpad_targets(padded, counts):
+    """The list of targets of each image from the padded targets and the number of boxes"""
+    return [target[:count] for target, count in zip(padded, counts.tolist())]
+
+
+def pad_targets(targets):
+    """Stack a list of variable-length targets into one padded tensor.
+    Args:
+        targets: (list) Ground truth of each image, each of Shape: [num_obj, 5],
+            or (padded targets, number of boxes of each image) which is already padded.
+    Return:
+        padded targets (tensor), Shape: [batch, max_obj, 5]
+        valid mask of the padded targets (tensor), Shape: [batch, max_obj]
+    """
+    if is_padded(targets):
+        padded, counts = targets
+        index = torch.arange(padded.size(1), device=padded.device)
+        return padded, index.unsqueeze(0) < counts.to(padded.device).unsqueeze(1)
+    num = len(targets)
+    max_obj = max([target.size(0) for target in targets] + [1])
+    padded = targets[0].new_zeros(num, max_obj, targets[0].size(-1))
+    valid = torch.zeros(num, max_obj, dtype=torch.bool, device=targets[0].device)
+    for i, target in enumerate(targets):
+        padded[i, :target.size(0)] = target
+        valid[i, :target.size(0)] = 1
+    return padded, valid
+
+
+def match_overlaps(cfg, truths, valid, priors, img_ratio, super_wide):
+    """The overlap between truths and priors used by the matcher.
+    Args:
+        truths: (tensor) Padded ground truth boxes, Shape: [batch, max_obj, 4].
+        valid: (tensor) Mask of the real (not padded) truths, Shape: [batch, max_obj].
+        priors: (Priors) Prior boxes (or a chunk of them) of n_priors.
+        super_wide: (tensor) Whether to add the super wide overlap, Shape: [batch].
+    Return:
+        overlaps (tensor), Shape: [batch, max_obj, n_priors], padded truths are -1.
+    """
+    if cfg['clip']:
+        prior_point, prior_area = priors.point_clip, priors.area_clip
+    else:
+        prior_point, prior_area = priors.point, priors.area
+    inter = intersect(truths, prior_point)
+    union = get_box_size(truths).unsqueeze(-1) + prior_area - inter
+    overlaps = inter / union * priors.calibration
+    if super_wide.any():
+        overlaps[super_wide] += (super_wide_jaccard(truths[super_wide], priors, img_ratio)
+                                 * cfg["super_wide_coeff"])
+    # Padded truths should never be the best match of any prior
+    overlaps.masked_fill_(~valid.unsqueeze(-1), -1)
+    return overlaps
+
+
+def tiled_best_overlaps(cfg, truths, valid, priors, img_ratio, super_wide, tile=None):
+    """Walk over the priors chunk by chunk and only keep the running reductions
+    of the overlaps, so the full [batch, max_obj, num_priors] overlap matrix is
+    never allocated. The chunk is sized so that one tile holds about tile
+    elements, which keeps the peak memory flat as the number of truths grows.
+    Args:
+        priors: (Priors) Prior boxes of num_priors.
+        tile: (int) Max elements of one overlap tile, None means a single tile.
+    Return:
+        best_prior_overlap, best_prior_idx: (tensor) best prior of each truth,
+            Shape: [batch, max_obj]
+        best_truth_overlap, best_truth_idx: (tensor) best truth of each prior,
+            Shape: [batch, num_priors]
+    """
+    num, num_obj = truths.size(0), truths.size(1)
+    num_priors = len(priors)
+    if tile is None:
+        chunk = num_priors
+    else:
+        chunk = max(1, int(tile) // (num * num_obj))
+    best_prior_overlap, best_prior_idx = None, None
+    best_truth_overlap, best_truth_idx = [], []
+    for start in range(0, num_priors, chunk):
+        overlaps = match_overlaps(cfg, truths, valid, priors[start: start + chunk], img_ratio, super_wide)
+        truth_overlap, truth_idx = overlaps.max(1)
+        best_truth_overlap.append(truth_overlap)
+        best_truth_idx.append(truth_idx)
+        prior_overlap, prior_idx = overlaps.max(2)
+        prior_idx += start
+        if best_prior_overlap is None:
+            best_prior_overlap, best_prior_idx = prior_overlap, prior_idx
+        else:
+            better = prior_overlap > best_prior_overlap
+            best_prior_overlap = torch.where(better, prior_overlap, best_prior_overlap)
+            best_prior_idx = torch.where(better, prior_idx, best_prior_idx)
+        del overlaps
+    return best_prior_overlap, best_prior_idx, torch.cat(best_truth_overlap, 1), torch.cat(best_truth_idx, 1)
+
+
+def sparse_best_overlaps(cfg, truths, valid, priors, img_ratio, super_wide, tile=None):
+    """Same result as tiled_best_overlaps, but the overlaps are only computed for the
+    priors found in the grid cells covered by the truths. Every other prior cannot
+    overlap any truth, so its overlap is 0 and its best truth is the first one.
+    Args:
+        priors: (Priors) Prior boxes of num_priors with the spatial index built.
+    """
+    num, num_priors = truths.size(0), len(priors)
+    candidates = priors.query_grid(truths[valid])
+    # Images without any truth have -1 overlaps everywhere, as padded truths do
+    best_truth_overlap = torch.where(valid.any(1), truths.new_zeros(num), -truths.new_ones(num))
+    best_truth_overlap = best_truth_overlap.unsqueeze(1).repeat(1, num_priors)
+    best_truth_idx = valid.new_zeros(num, num_priors, dtype=torch.long)
+    if candidates.numel() == 0:
+        # No truth in the batch (or no prior near them), the overlaps are the defaults
+        best_prior_overlap = torch.where(valid, truths.new_zeros(valid.shape), -truths.new_ones(valid.shape))
+        return best_prior_overlap, best_truth_idx.new_zeros(valid.shape), best_truth_overlap, best_truth_idx
+    best_prior_overlap, best_prior_idx, truth_overlap, truth_idx = \
+        tiled_best_overlaps(cfg, truths, valid, priors[candidates], img_ratio, super_wide, tile)
+    best_prior_idx = candidates[best_prior_idx]
+    best_truth_overlap[:, candidates] = truth_overlap
+    best_truth_idx[:, candidates] = truth_idx
+    return best_prior_overlap, best_prior_idx, best_truth_overlap, best_truth_idx
+
+
+def match_batch(cfg, threshold, truths, labels, valid, priors, variances, img_ratio):
     """Match each prior box with the ground truth box of the highest jaccard
-    overlap, encode the bounding boxes, then return the matched indices
-    corresponding to both confidence and location preds.
+    overlap and encode the bounding boxes, every image in the batch is matched
+    at once on the device where the truths are.
     Args:
         threshold: (float) The overlap threshold used when mathing boxes.
-        truths: (tensor) Ground truth boxes, Shape: [num_obj, num_priors].
-        priors: (tensor) Prior boxes from priorbox layers, Shape: [n_priors,4].
-        variances: (tensor) Variances corresponding to each prior coord,
-            Shape: [num_priors, 4].
-        labels: (tensor) All the class labels for the image, Shape: [num_obj].
-        loc_t: (tensor) Tensor to be filled w/ endcoded location targets.
-        conf_t: (tensor) Tensor to be filled w/ matched indices for conf preds.
-        idx: (int) current batch index
+        truths: (tensor) Padded ground truth boxes, Shape: [batch, max_obj, 4].
+        labels: (tensor) Padded class labels, Shape: [batch, max_obj].
+        valid: (tensor) Mask of the real (not padded) truths, Shape: [batch, max_obj].
+        priors: (Priors) Prior boxes from priorbox layers, a tensor of Shape: [n_priors,4]
+            will be converted into Priors.
+        variances: (list[float]) Variances of priorboxes
     Return:
-        The matched indices corresponding to 1)location and 2)confidence preds.
+        loc_t: (tensor) encoded location targets, Shape: [batch, num_priors, 4]
+        conf_t: (tensor) top class label for each prior, Shape: [batch, num_priors]
     """
-    if cfg['clip']:
-        overlaps = jaccard(truths, point_form(priors, img_ratio).clamp_(max=1, min=0))
+    if not isinstance(priors, Priors):
+        priors = Priors(priors, img_ratio)
+    if cfg.get('match_grid'):
+        priors.build_grid(cfg['match_grid'])
+    num, num_obj = truths.size(0), truths.size(1)
+    num_priors = len(priors)
+    # Draw the super wide decision for each image
+    super_wide = torch.tensor([cfg["super_wide"] > random.random() for _ in range(num)],
+                              dtype=torch.bool, device=truths.device)
+    if cfg.get('match_grid'):
+        best_overlaps = sparse_best_overlaps
     else:
-        overlaps = jaccard(truths, point_form(priors, img_ratio))
-    #overlaps = box_jaccard(center_size(truths, 1), priors)
-    prior_ratios = calibrate_prior(priors[:, 2] / priors[:, 3]).unsqueeze(0).repeat(truths.size(0), 1)
-    overlaps = overlaps * prior_ratios
-    if cfg["super_wide"] > random.random():
-        overlaps += (super_wide_jaccard(truths, priors, img_ratio) * cfg["super_wide_coeff"])
-
-    # 找到与每个ground truth boxes最接近的prior boxes的IOU和index, length = num_gt
-    best_prior_overlap, best_prior_idx = overlaps.max(1, keepdim=True)
-    # 找到与每个prior boxes最接近的ground truth boxes的IOU和index, length = num_prior
-    best_truth_overlap, best_truth_idx = overlaps.max(0, keepdim=True)
-    best_truth_idx.squeeze_(0)
-    best_truth_overlap.squeeze_(0)
-    best_prior_idx.squeeze_(1)
-    best_prior_overlap.squeeze_(1)
-    # 剔除一些匹配度低的prior_idx
-    _best_prior_idx = best_prior_idx[best_prior_overlap > cfg['overlap_thresh'] * 0.75]
-    # 将剔除后的_best_prior_idx中所对应的overlap变为2
-    best_truth_overlap.index_fill_(0, _best_prior_idx, 2)
-    for j in range(best_prior_idx.size(0)):
-        best_truth_idx[best_prior_idx[j]] = j
-    matches = truths[best_truth_idx]          # Shape: [num_priors,4]
-    conf = labels[best_truth_idx] + 1         # Shape: [num_priors]
+        best_overlaps = tiled_best_overlaps
+    best_prior_overlap, best_prior_idx, best_truth_overlap, best_truth_idx = \
+        best_overlaps(cfg, truths, valid, priors, img_ratio, super_wide, cfg.get('match_tile'))
+    # Work on flattened [batch * num_priors] index so that the whole batch is updated at once
+    flat_prior_idx = best_prior_idx + torch.arange(num, device=truths.device).unsqueeze(1) * num_priors
+    keep_best = valid & (best_prior_overlap > cfg['overlap_thresh'] * 0.75)
+    best_truth_overlap.view(-1)[flat_prior_idx[keep_best]] = 2
+    # Force each truth onto its best prior, when several truths share the same
+    # best prior the one with the largest index wins
+    obj_idx = torch.arange(num_obj, device=truths.device).unsqueeze(0).expand_as(best_prior_idx)
+    flat_prior_idx, obj_idx = flat_prior_idx[valid], obj_idx[valid]
+    order = torch.argsort(flat_prior_idx * num_obj + obj_idx)
+    flat_prior_idx, obj_idx = flat_prior_idx[order], obj_idx[order]
+    last = torch.ones_like(flat_prior_idx, dtype=torch.bool)
+    last[:-1] = flat_prior_idx[1:] != flat_prior_idx[:-1]
+    best_truth_idx.view(-1)[flat_prior_idx[last]] = obj_idx[last]
+
+    matches = truths.gather(1, best_truth_idx.unsqueeze(-1).expand(num, num_priors, 4))
+    conf = labels.gather(1, best_truth_idx).long() + 1
     conf[best_truth_overlap < threshold] = 0  # label as background
-    if visualize:
-        return overlaps, conf
-    loc = encode(matches, priors, variances)
-    loc_t[idx] = loc    # [num_priors,4] encoded offsets to learn
-    conf_t[idx] = conf  # [num_priors] top class label for each prior
+    loc = encode(matches, priors.center, variances)
+    return loc, conf
 
 
 def encode(matched, priors, variances):
@@ -195,16 +480,18 @@ def encode(matched, priors, variances):
     Return:
         encoded boxes (tensor), Shape: [num_priors, 4]
     """
+    if _kernel_backend == "script":
+        return tb_kernels.encode(matched, priors, [float(v) for v in variances])
 
     # dist b/t match center and prior's center
-    g_cxcy = (matched[:, :2] + matched[:, 2:])/2 - priors[:, :2]
+    g_cxcy = (matched[..., :2] + matched[..., 2:])/2 - priors[..., :2]
     # encode variance
-    g_cxcy /= (variances[0] * priors[:, 2:])
+    g_cxcy /= (variances[0] * priors[..., 2:])
     # match wh / prior wh
-    g_wh = (matched[:, 2:] - matched[:, :2]) / priors[:, 2:]
+    g_wh = (matched[..., 2:] - matched[..., :2]) / priors[..., 2:]
     g_wh = torch.log(g_wh) / variances[1]
     # return target for smooth_l1_loss
-    return torch.cat([g_cxcy, g_wh], 1)  # [num_priors,4]
+    return torch.cat([g_cxcy, g_wh], -1)  # [num_priors,4]
 
 
 # Adapted from https://github.com/Hakuyume/chainer-ssd
@@ -213,19 +500,21 @@ def decode(loc, priors, variances):
     the encoding we did for offset regression at train time.
     Args:
         loc (tensor): location predictions for loc layers,
-            Shape: [num_priors,4]
+            Shape: [num_priors,4] or [batch,num_priors,4]
         priors (tensor): Prior boxes in center-offset form.
             Shape: [num_priors,4].
         variances: (list[float]) Variances of priorboxes
     Return:
         decoded bounding box predictions
     """
+    if _kernel_backend == "script":
+        return tb_kernels.decode(loc, priors, [float(v) for v in variances])
 
     boxes = torch.cat((
-        priors[:, :2] + loc[:, :2] * variances[0] * priors[:, 2:],
-        priors[:, 2:] * torch.exp(loc[:, 2:] * variances[1])), 1)
-    boxes[:, :2] -= boxes[:, 2:] / 2
-    boxes[:, 2:] += boxes[:, :2]
+        priors[..., :2] + loc[..., :2] * variances[0] * priors[..., 2:],
+        priors[..., 2:] * torch.exp(loc[..., 2:] * variances[1])), -1)
+    boxes[..., :2] -= boxes[..., 2:] / 2
+    boxes[..., 2:] += boxes[..., :2]
     return boxes
 
 
@@ -240,10 +529,130 @@ def log_sum_exp(x):
     return torch.log(torch.sum(torch.exp(x-x_max), 1, keepdim=True)) + x_max
 
 
+def cluster_nms(boxes, valid, overlap=0.5):
+    """Solve the non-maximum suppression of candidates which are already sorted
+    by descending score. The pairwise IoU is computed in one shot and the
+    suppression is solved as a fixed point (Cluster-NMS): a box is kept when no
+    kept box with higher score overlaps it by more than the threshold. The fixed
+    point is exactly the result of the greedy NMS and usually converges in a few
+    iterations.
+    Args:
+        boxes: (tensor) Sorted candidate boxes, Shape: [batch, k, 4].
+        valid: (tensor) Candidates that take part in the NMS, Shape: [batch, k].
+        overlap: (float) The overlap thresh for suppressing unnecessary boxes.
+    Return:
+        keep: (tensor) Mask of the candidates that survive, Shape: [batch, k].
+    """
+    if _kernel_backend == "script":
+        return tb_kernels.cluster_nms(boxes, valid, float(overlap))
+    # suppress[b, i, j] is True when box i can suppress box j (i has higher score)
+    iou = jaccard(boxes, boxes)
+    suppress = (~iou.le(overlap)).triu(1) & valid.unsqueeze(2)
+    suppress = suppress.float()
+    keep = valid
+    while True:
+        suppressed = torch.bmm(keep.float().unsqueeze(1), suppress).squeeze(1) > 0
+        new_keep = valid & ~suppressed
+        if torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+    return keep
+
+
+def greedy_nms(boxes, valid, overlap=0.5):
+    """Same input and result as cluster_nms, solved by the greedy NMS of torchvision
+    for each candidate set. The pairwise IoU of cluster_nms costs O(k^2) per iteration,
+    which is much slower on CPU than the greedy NMS once there are hundreds of candidates.
+    """
+    keep = torch.zeros_like(valid)
+    area = get_box_size(boxes)
+    for b in range(boxes.size(0)):
+        if torchvision_nms is None:
+            idx = valid[b].nonzero().squeeze(1)
+            while idx.numel() > 0:
+                keep[b, idx[0]] = True
+                iou = jaccard(boxes[b, idx[:1]], boxes[b, idx[1:]])[0]
+                idx = idx[1:][iou.le(overlap)]
+            continue
+        idx = (valid[b] & (area[b] != 0)).nonzero().squeeze(1)
+        if idx.numel() > 0:
+            # The candidates are sorted already, the score only keeps their order
+            kept = torchvision_nms(boxes[b, idx], -idx.to(boxes.dtype), overlap)
+            keep[b, idx[kept]] = True
+        # Two boxes without area have a NaN overlap, which suppresses in cluster_nms,
+        # so only the first of them survives
+        empty = (valid[b] & (area[b] == 0)).nonzero().squeeze(1)
+        if empty.numel() > 0:
+            keep[b, empty[0]] = True
+    return keep
+
+
+# Above this number of candidates, NMS on CPU is solved by greedy_nms instead of cluster_nms
+CLUSTER_NMS_CPU_LIMIT = 64
+
+
+def solve_nms(boxes, valid, overlap=0.5):
+    """Dispatch the NMS of sorted candidates (see cluster_nms) by device and size: the
+    cluster form runs the whole batch at once and suits the GPU or a few candidates,
+    the greedy form is faster on CPU when there are many candidates.
+    """
+    if boxes.is_cuda or boxes.size(1) <= CLUSTER_NMS_CPU_LIMIT:
+        return cluster_nms(boxes, valid, overlap)
+    return greedy_nms(boxes, valid, overlap)
+
+
+def batched_nms(boxes, scores, overlap=0.5, top_k=200, conf_thresh=None):
+    """Apply non-maximum suppression to a batch of candidate sets at once,
+    the cluster form or the greedy form is picked by solve_nms.
+    Args:
+        boxes: (tensor) The location preds, Shape: [batch, num_priors, 4].
+            The batch dimension can fold images and classes together.
+        scores: (tensor) The class predscores, Shape: [batch, num_priors].
+        overlap: (float) The overlap thresh for suppressing unnecessary boxes.
+        top_k: (int) The Maximum number of box preds to consider.
+        conf_thresh: (float) If not None, boxes whose score is not greater
+            than conf_thresh will neither be kept nor suppress other boxes.
+    Return:
+        idx: (tensor) Indices w.r.t. num_priors of the candidates in descending
+            score order, Shape: [batch, min(top_k, num_priors)].
+        keep: (tensor) Mask of the candidates that survive, same shape as idx.
+    """
+    k = min(top_k, scores.size(1))
+    v, idx = scores.topk(k, dim=1)
+    if conf_thresh is None:
+        valid = torch.ones_like(v, dtype=torch.bool)
+    else:
+        valid = v > conf_thresh
+    cand = boxes.gather(1, idx.unsqueeze(-1).expand(idx.size(0), k, 4))
+    return idx, solve_nms(cand, valid, overlap)
+
+
+def nms(boxes, scores, overlap=0.5, top_k=200):
+    """Apply non-maximum suppression at test time to avoid detecting too many
+    overlapping bounding boxes for a given object.
+    Drop-in replacement of nms_legacy built on top of batched_nms.
+    Args:
+        boxes: (tensor) The location preds for the img, Shape: [num_priors,4].
+        scores: (tensor) The class predscores for the img, Shape:[num_priors].
+        overlap: (float) The overlap thresh for suppressing unnecessary boxes.
+        top_k: (int) The Maximum number of box preds to consider.
+    Return:
+        The indices of the kept boxes with respect to num_priors.
+    """
+    keep = scores.new(scores.size(0)).zero_().long()
+    if boxes.numel() == 0:
+        return keep, 0
+    idx, mask = batched_nms(boxes.unsqueeze(0), scores.unsqueeze(0), overlap, top_k)
+    kept = idx[0][mask[0]]
+    count = kept.size(0)
+    keep[:count] = kept
+    return keep, count
+
+
 # Original author: Francisco Massa:
 # https://github.com/fmassa/object-detection.torch
 # Ported to PyTorch by Max deGroot (02/01/2017)
-def nms(boxes, scores, overlap=0.5, top_k=200):
+def nms_legacy(boxes, scores, overlap=0.5, top_k=200):
     """Apply non-maximum suppression at test time to avoid detecting too many
     overlapping bounding boxes for a given object.
     Args:
@@ -310,44 +719,40 @@ def nms(boxes, scores, overlap=0.5, top_k=200):
     return keep, count
 
 
+def batch_measure(pred_boxes, gt_boxes):
+    """Measure the detection result of a batch of images at once.
+    Args:
+        pred_boxes: (list) Predicted boxes of each image, each of Shape: [num_pred, 4].
+        gt_boxes: (list) Ground truth boxes of each image, each of Shape: [num_gt, 4].
+    Return:
+        accuracy, precision and recall of each image (tensor), Shape: [batch, 3]
+    """
+    pred, pred_valid = pad_targets([box.view(-1, 4) for box in pred_boxes])
+    gt, gt_valid = pad_targets([box.view(-1, 4) for box in gt_boxes])
+    gt, gt_valid = gt.to(pred.device), gt_valid.to(pred.device)
+    # The intersection is computed only once and shared by all the metrics
+    inter = intersect(pred, gt)
+    pred_area = get_box_size(pred)
+    gt_area = get_box_size(gt)
+    pair_valid = pred_valid.unsqueeze(2) & gt_valid.unsqueeze(1)
+    iou = (inter / (pred_area.unsqueeze(2) + gt_area.unsqueeze(1) - inter)).masked_fill(~pair_valid, 0)
+    inter = inter.masked_fill(~pair_valid, 0)
+    num_pred = pred_valid.sum(1)
+    num_gt = gt_valid.sum(1)
+    num_sample = torch.max(num_pred, num_gt).clamp(min=1).to(inter.dtype)
+    accuracy = torch.sum(iou.max(1)[0] * gt_valid, 1) / num_sample
+    precision = torch.sum((inter.max(2)[0] / pred_area).masked_fill(~pred_valid, 0), 1) / num_sample
+    recall = torch.sum((inter.max(1)[0] / gt_area).masked_fill(~gt_valid, 0), 1) / num_sample
+    result = torch.stack([accuracy, precision, recall], dim=1)
+    # Perfect score when both are empty and zero when only one of them is empty
+    result[(num_pred == 0) & (num_gt == 0)] = 1.0
+    result[(num_pred == 0) != (num_gt == 0)] = 0.0
+    return result
+
+
 def measure(pred_boxes, gt_boxes, width, height):
-    if gt_boxes.size(0) == 0 and pred_boxes.size(0) == 0:
-        return 1.0, 1.0, 1.0
-    elif gt_boxes.size(0) == 0 and pred_boxes.size(0) != 0:
-        return 0.0, 0.0, 0.0
-    elif gt_boxes.size(0) != 0 and pred_boxes.size(0) == 0:
-        return 0.0, 0.0, 0.0
-    else:
-        """
-        scale = torch.Tensor([width, height, width, height])
-        canvas_p, canvas_g = [torch.zeros(height, width).byte()] * 2
-        if pred_boxes.is_cuda or gt_boxes.is_cuda:
-            scale = scale.cuda()
-            canvas_p = canvas_p.cuda()
-            canvas_g = canvas_g.cuda()
-        max_size = max(width, height)
-        scaled_p = (scale.unsqueeze(0).expand_as(pred_boxes) * pred_boxes).long().clamp_(0, max_size)
-        scaled_g = (scale.unsqueeze(0).expand_as(gt_boxes) * gt_boxes).long().clamp_(0, max_size)
-        for g in scaled_g:
-            canvas_g[g[0]:g[2], g[1]:g[3]] = 1
-        for p in scaled_p:
-            canvas_p[p[0]:p[2], p[1]:p[3]] = 1
-        inter = canvas_g * canvas_p
-        union = canvas_g + canvas_p >= 1
-
-        vb.plot_tensor(args, inter.permute(1, 0).unsqueeze(0).unsqueeze(0), margin=0, path=PIC+"tmp_inter.jpg")
-        vb.plot_tensor(args, union.permute(1, 0).unsqueeze(0).unsqueeze(0), margin=0, path=PIC+"tmp_union.jpg")
-        vb.plot_tensor(args, canvas_g.permute(1, 0).unsqueeze(0).unsqueeze(0), margin=0, path=PIC+"tmp_gt.jpg")
-        vb.plot_tensor(args, canvas_p.permute(1, 0).unsqueeze(0).unsqueeze(0), margin=0, path=PIC+"tmp_pd.jpg")
-        """
-        inter = intersect(pred_boxes, gt_boxes)
-        text_area = get_box_size(pred_boxes)
-        gt_area = get_box_size(gt_boxes)
-        num_sample = max(text_area.size(0),  gt_area.size(0))
-        accuracy = torch.sum(jaccard(pred_boxes, gt_boxes).max(0)[0]) / num_sample
-        precision = torch.sum(inter.max(1)[0] / text_area) / num_sample
-        recall = torch.sum(inter.max(0)[0] / gt_area) / num_sample
-        return float(accuracy), float(precision), float(recall)
+    accuracy, precision, recall = batch_measure([pred_boxes], [gt_boxes])[0].tolist()
+    return accuracy, precision, recall
 
 
 def coord_to_rect(coord, height, width):
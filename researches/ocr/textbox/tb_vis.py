@@ -77,8 +77,10 @@ def visualize_overlaps(cfg, target, label, prior, ratio):
     images, subtitle, coords = [], [], []
 
     # conf中的1代表所有当前设置下与ground truth匹配的default box及其相应的index
-    overlaps, conf = match(cfg, cfg['overlap_thresh'], target, prior,
-                           None, label, None, None, 0, ratio, visualize=True)
+    valid = torch.ones(1, target.size(0), dtype=torch.bool, device=target.device)
+    _, conf = match_batch(cfg, cfg['overlap_thresh'], target.unsqueeze(0), label.unsqueeze(0),
+                          valid, prior, cfg['variance'], ratio)
+    conf = conf[0]
     summary = "%s of %s positive samples"%(int(torch.sum(conf)), prior.size(0))
     crop_start = 0
 
@@ -92,12 +94,6 @@ def visualize_overlaps(cfg, target, label, prior, ratio):
 
         # Get the index of matched prior boxes and collect these boxes
         _conf = conf[crop_start: crop_start + prior_num]
-        _overlaps = overlaps[crop_start: crop_start + prior_num]
-        best_prior_overlap, best_prior_idx = overlaps.max(1, keepdim=True)
-        best_prior_idx = best_prior_idx.squeeze(1)
-        
-        #points = point_form(prior[best_prior_idx].cpu(), ratio)
-        #print_box(target, shape=? blue_boxes=points, step_by_step_b=True)
         
         matched_priors = int(torch.sum(_conf))
         idx = _conf == 1
@@ -1,4 +1,4 @@
-import os, time, sys, math, random, glob, datetime
+import os, time, sys, math, random, glob, datetime, copy
 sys.path.append(os.path.expanduser("~/Documents/sroie2019"))
 import cv2, torch
 import numpy as np
@@ -8,6 +8,9 @@ import researches.ocr.textbox.tb_data as data
 import researches.ocr.textbox.tb_preset as preset
 import researches.ocr.textbox.tb_model as model
 from researches.ocr.textbox.tb_loss import MultiBoxLoss
+from researches.ocr.textbox.tb_anchor import save_pruned
+from researches.ocr.textbox.tb_prune import prune_heads, head_parameters, measure_latency
+from researches.ocr.textbox.tb_eval import DetectionEvaluator
 from researches.ocr.textbox.tb_utils import *
 from researches.ocr.textbox.tb_preprocess import *
 from researches.ocr.textbox.tb_augment import *
@@ -47,25 +50,34 @@ def fit(args, cfg, net, detector, dataset, optimizer, is_train):
             visualize = True
         start_time = time.time()
         criterion = MultiBoxLoss(cfg, neg_pos=3)
+        batch_aug = batch_aug_sroie(args) if args.fix_size and args.batch_augmentation else None
         # Update variance and balance of loc_loss and conf_loss
         cfg['variance'] = [var * cfg['var_updater'] if var <= 0.95 else 1 for var in cfg['variance']]
         cfg['alpha'] *= cfg['alpha_updater']
-        for batch_idx, (images, targets) in enumerate(dataset):
+        for batch_idx, batch in enumerate(dataset):
+            images, targets = batch[0], batch[1]
             #if not net.fix_size:
                 #assert images.size(0) == 1, "batch size for dynamic input shape can only be 1 for 1 GPU RIGHT NOW!"
-            if len(targets) == 0:
+            if len(targets) == 0 or images.size(0) == 0:
                 continue
-            images = images.cuda()
+            images = images.cuda(non_blocking=True)
+            if batch_aug is not None:
+                images, targets = batch_aug(images, targets, batch[2])
+                if len(targets) == 0:
+                    continue
             ratios = images.size(3) / images.size(2)
             if ratios != 1.0:
                 print(ratios)
-            targets = [ann.cuda() for ann in targets]
+            if is_padded(targets):
+                targets = (targets[0].cuda(non_blocking=True), targets[1])
+            else:
+                targets = [ann.cuda() for ann in targets]
             out = net(images, is_train)
             if args.curr_epoch == 0 and batch_idx == 0:
                 #visualize_bbox(args, cfg, images, targets, net.module.prior, batch_idx)
                 pass
             if is_train:
-                loss_l, loss_c = criterion(out, targets, ratios)
+                loss_l, loss_c = criterion(out, targets, ratios, input_size=tuple(images.shape[2:]))
                 loss = loss_l + loss_c
                 Loss_L.append(float(loss_l.data))
                 Loss_C.append(float(loss_c.data))
@@ -78,25 +90,16 @@ def fit(args, cfg, net, detector, dataset, optimizer, is_train):
                 for _i, top_k in enumerate([1500]):
                     for _j, conf_thres in enumerate([0.05]):
                         for _k, nms_thres in enumerate([0.3]):
-                            eval_thres = [0.1]
                             key = "%s_%s_%s"%(top_k, conf_thres, nms_thres)
-                            if key in epoch_eval_results:
-                                batch_result = epoch_eval_results[key]
-                            else:
-                                batch_result = {}
+                            if key not in epoch_eval_results:
+                                epoch_eval_results[key] = DetectionEvaluator(keys=[0.1])
                             if detector is None:
                                 detector = model.Detect(num_classes=2, bkg_label=0, top_k=top_k,
                                                         conf_thresh=conf_thres, nms_thresh=nms_thres)
                             loc_data, conf_data, prior_data = out
                             det_result = detector(loc_data, conf_data, prior_data)
-                            eval_result = evaluate(images, det_result.data, targets, batch_idx, eval_thres,
-                                                   visualize=visualize, post_combine=True)
-                            for _key in eval_result.keys():
-                                if _key in batch_result:
-                                    batch_result[_key] += eval_result[_key]
-                                else:
-                                    batch_result.update({_key: eval_result[_key]})
-                            epoch_eval_results.update({key: batch_result})
+                            evaluate(images, det_result, targets, batch_idx, epoch_eval_results[key],
+                                     visualize=visualize, post_combine=True)
         if is_train:
             args.curr_epoch += 1
             print(" --- loc loss: %.4f, conf loss: %.4f, at epoch %04d, cost %.2f seconds ---" %
@@ -105,10 +108,8 @@ def fit(args, cfg, net, detector, dataset, optimizer, is_train):
         for key in sorted(epoch_eval_results.keys()):
             keys = key.split("_")
             print("top_k: %s, conf_thres: %s, nms_thres: %s"%(keys[0], keys[1], keys[2]))
-            for _key in sorted(epoch_eval_results[key]):
-                eval = np.mean(np.asarray(epoch_eval_results[key][_key]).reshape((-1, 4)), axis=0)
-                print(" --- Conf=%s: accuracy=%.4f, precision=%.4f, recall=%.4f, f1-score=%.4f  ---" %
-                  (_key, eval[0], eval[1], eval[2], eval[3]))
+            epoch_eval_results[key].print_summary()
+            eval = epoch_eval_results[key].summary()[0.1]
             print("")
         # represent accuracy, precision, recall, f1_score
         return  eval[0], eval[1], eval[2], eval[3]
@@ -121,55 +122,116 @@ def val(args, cfg, net, dataset, optimizer, prior):
         fit(args, cfg, net, dataset, optimizer, prior, False)
 
 
-def evaluate(img, detections, targets, batch_idx, eval_thres, visualize=False, post_combine=False):
-    eval_result = {}
+def evaluate(img, detections, targets, batch_idx, evaluator, visualize=False, post_combine=False):
+    """
+    Accumulate the detection result of a batch into evaluator, each key of evaluator
+    is a threshold of the detection score
+    """
     save_dir = os.path.expanduser("~/Pictures/")
-    w = img.size(3)
-    h = img.size(2)
-    for threshold in eval_thres:
-        idx = detections[0, 1, :, 0] >= threshold
-        _boxes = detections[0, 1, idx, 1:]
-        gt_boxes = targets[0][:, :-1].data
-        if gt_boxes.size(0) == 0:
-            print("No ground truth box in this patch")
-            break
-        if _boxes.size(0) == 0:
-            print("No predicted box in this patch")
-            break
-        boxes = combine_boxes(_boxes, img=img)
-        jac = jaccard(boxes, gt_boxes)
-        overlap, idx = jac.max(1, keepdim=True)
-        # This is not DetEval
-        positive_pred = boxes[overlap.squeeze(1) > 0.2]
-        negative_pred = boxes[overlap.squeeze(1) <= 0.2]
-        if negative_pred.size(0) == 0:
-            negative_pred = tuple()
-        #print_box(blue_boxes=positive_pred, green_boxes=gt_boxes, red_boxes=negative_pred,
-                  #img=vb.plot_tensor(args, img, margin=0), save_dir=save_dir)
-
-        accuracy, precision, recall = measure(positive_pred, gt_boxes, width=w, height=h)
-        if (recall + precision) < 1e-3:
-            f1_score = 0
-        else:
-            f1_score = 2 * (recall * precision) / (recall + precision)
-        if visualize and threshold == 0.1:
-            pred = [[float(coor) for coor in area] for area in positive_pred]
-            gt = [[float(coor) for coor in area] for area in gt_boxes]
-            print_box(negative_pred, green_boxes=gt, blue_boxes=pred, idx=batch_idx,
-                      img=vb.plot_tensor(args, img, margin=0), save_dir=args.val_log)
-        eval_result.update({threshold: [accuracy, precision, recall, f1_score]})
-    return eval_result
+    if is_padded(targets):
+        targets = unpad_targets(*targets)
+    for threshold in evaluator.keys:
+        pred_boxes, gt_boxes = [], []
+        for i, det in enumerate(detections):
+            # (class, score, xmin, ymin, xmax, ymax)
+            _boxes = det[(det[:, 0] == 1) & (det[:, 1] >= threshold), 2:]
+            gt = targets[i][:, :-1].data
+            if gt.size(0) == 0:
+                print("No ground truth box in this patch")
+                continue
+            if _boxes.size(0) == 0:
+                print("No predicted box in this patch")
+                continue
+            boxes = combine_boxes(_boxes, img=img[i:i + 1])
+            jac = jaccard(boxes, gt)
+            overlap, idx = jac.max(1, keepdim=True)
+            # This is not DetEval
+            positive_pred = boxes[overlap.squeeze(1) > 0.2]
+            negative_pred = boxes[overlap.squeeze(1) <= 0.2]
+            if negative_pred.size(0) == 0:
+                negative_pred = tuple()
+            #print_box(blue_boxes=positive_pred, green_boxes=gt, red_boxes=negative_pred,
+                      #img=vb.plot_tensor(args, img[i:i + 1], margin=0), save_dir=save_dir)
+            if visualize and threshold == 0.1 and i == 0:
+                pred = [[float(coor) for coor in area] for area in positive_pred]
+                _gt = [[float(coor) for coor in area] for area in gt]
+                print_box(negative_pred, green_boxes=_gt, blue_boxes=pred, idx=batch_idx,
+                          img=vb.plot_tensor(args, img[i:i + 1], margin=0), save_dir=args.val_log)
+            pred_boxes.append(positive_pred)
+            gt_boxes.append(gt)
+        evaluator.update(pred_boxes, gt_boxes, key=threshold)
 
 
-def main():
-    if args.fix_size:
-        aug = aug_sroie(args)
+def fetch_data():
+    if args.fix_size and args.batch_augmentation:
+        # The workers only decode, the images are augmented batch by batch in fit
+        aug = None
+        collate_fn = data.RawCollector(args.img_mean, args.img_std)
+    elif args.fix_size:
+        aug = FusedSroieAug(args) if args.fused_augmentation else aug_sroie(args)
+        collate_fn = data.PinnedCollector()
     else:
         aug = aug_sroie_dynamic_2()
-        args.batch_size_per_gpu = 1
-    datasets = data.fetch_detection_data(args, sources=args.train_sources, k_fold=1,
-                                         batch_size=args.batch_size_per_gpu, batch_size_val=1,
-                                         auxiliary_info=args.train_aux, split_val=0.1, aug=aug)
+        # Images of different width are padded to a few buckets, so batch size can be larger than 1
+        collate_fn = data.BucketCollector(sroie_dynamic_2_buckets())
+    batch_size = args.batch_size_per_gpu if args.fix_size else args.batch_size_per_gpu_dynamic
+    # With dynamic input shape, a training batch holds the images which aug_sroie_dynamic_2
+    # turns into the same bucket, so BucketCollector pads them to it instead of the widest one
+    return data.fetch_detection_data(args, sources=args.train_sources, k_fold=1,
+                                     batch_size=batch_size, batch_size_val=1,
+                                     auxiliary_info=args.train_aux, split_val=0.1, aug=aug,
+                                     collate_fn=collate_fn, shard_root=args.shard_root,
+                                     batch_ratio=None if args.fix_size else sroie_dynamic_2_ratio,
+                                     ratio_boundaries=sroie_dynamic_2_boundaries(),
+                                     shard_max_height=args.shard_max_height)
+
+
+def prune():
+    """
+    Prune the channels of the loc and conf heads of the -mpf model with each ratio in -pr,
+    fine tune the pruned model for -pfe epochs, save it (can be loaded by tb_test.py -pm)
+    and report the latency / f1-score trade-off.
+    """
+    train_set, val_set = fetch_data()[0]
+    detector = model.Detect(num_classes=2, bkg_label=0, top_k=1500, conf_thresh=0.05, nms_thresh=0.3)
+    base = model.SSD(cfg, connect_loc_to_conf=True, fix_size=args.fix_size,
+                     incep_conf=True, incep_loc=True, nms_thres=args.nms_threshold)
+    base = torch.nn.DataParallel(base).cuda()
+    if args.fix_size:
+        base.module.prior = base.module.prior.cuda()
+    base = util.load_latest_model(args, base, prefix=args.model_prefix_finetune)
+    report = []
+    # fit runs args.epoches_per_phase epochs and moves args.curr_epoch and the variance
+    # and alpha of cfg, every ratio is evaluated and fine tuned from the same state with
+    # single epoch phases, which is restored afterwards
+    state = (args.epoches_per_phase, args.curr_epoch, list(cfg['variance']), cfg['alpha'])
+    args.epoches_per_phase = 1
+    try:
+        for ratio in [0.0] + args.prune_ratios:
+            args.curr_epoch, cfg['variance'], cfg['alpha'] = state[1], list(state[2]), state[3]
+            net = copy.deepcopy(base)
+            removed = prune_heads(net.module, ratio, criterion=args.prune_criterion)
+            f1_pruned = fit(args, cfg, net, detector, val_set, None, is_train=False)[3]
+            if ratio > 0:
+                print("%d channels are removed with ratio %.2f, fine tuning..."%(removed, ratio))
+                optimizer = AdaBound(net.parameters(), lr=args.learning_rate, weight_decay=args.weight_decay,)
+                for epoch in range(args.prune_finetune_epochs):
+                    fit(args, cfg, net, detector, train_set, optimizer, is_train=True)
+                save_pruned(net.module, os.path.join(os.path.expanduser(args.path), args.code_name,
+                                                     "%s_pruned_%.2f.pth"%(args.model_prefix, ratio)))
+            f1_score = fit(args, cfg, net, detector, val_set, None, is_train=False)[3]
+            report.append((ratio, head_parameters(net.module), measure_latency(net, val_set), f1_pruned, f1_score))
+            del net
+    finally:
+        args.epoches_per_phase, args.curr_epoch = state[0], state[1]
+        cfg['variance'], cfg['alpha'] = state[2], state[3]
+    print("%6s | %12s | %12s | %15s | %16s"%("ratio", "head params", "latency (s)", "f1 (pruned)", "f1 (fine tuned)"))
+    for ratio, params, latency, f1_pruned, f1_score in report:
+        print("%6.2f | %12d | %12.4f | %15.4f | %16.4f"%(ratio, params, latency, f1_pruned, f1_score))
+
+
+def main():
+    datasets = fetch_data()
     model_prefix = "768"
     for idx, (train_set, val_set) in enumerate(datasets):
         loc_loss, conf_loss = [], []
@@ -217,6 +279,9 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if args.prune_ratios:
+        prune()
+    else:
+        main()
 
 